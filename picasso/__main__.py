@@ -120,17 +120,21 @@ def _cluster_combine(files):
             io.save_locs(base + '_comb.hdf5', combined_locs, info)
 
 
-def _cluster_combine_dist(files):
+def _cluster_combine_dist(files, pixelsize=None):
     import glob
     paths = glob.glob(files)
     if paths:
-        from . import io, postprocess
+        from . import io, postprocess, lib
         for path in paths:
             try:
                 locs, info = io.load_locs(path)
             except io.NoMetadataFileError:
                 continue
-            combinedist_locs = postprocess.cluster_combine_dist(locs)
+            if pixelsize is None:
+                file_pixelsize = lib.get_from_metadata(info, 'Pixelsize', lib.get_from_metadata(info, 'Camera.Pixelsize'))
+            else:
+                file_pixelsize = pixelsize
+            combinedist_locs = postprocess.cluster_combine_dist(locs, file_pixelsize)
             base, ext = os.path.splitext(path)
             cluster_combine_dist_info = {'Generated by': 'Picasso Combineidst'}
             info.append(cluster_combine_dist_info)
@@ -266,30 +270,58 @@ def _density(files, radius):
             io.save_locs(base + '_density.hdf5', locs, info)
 
 
-def _dbscan(files, radius, min_density):
+def _pick(files, picks_path):
     import glob
+    import yaml
+    import numpy as np
     paths = glob.glob(files)
     if paths:
         from . import io, postprocess
+        with open(picks_path, 'r') as f:
+            picks = yaml.load(f)
+        d = picks['Diameter']
+        x, y = np.array(picks['Centers']).T
+        for path in paths:
+            print('Picking {} ...'.format(path))
+            locs, info = io.load_locs(path)
+            locs = postprocess.picked_locs(locs, info, x, y, d / 2)
+            base, ext = os.path.splitext(path)
+            pick_info = {'Generated by': 'Picasso Pick',
+                         'Pick Diameter': d,
+                         'Picks': picks_path}
+            info.append(pick_info)
+            io.save_locs(base + '_picked.hdf5', locs, info)
+
+
+def _dbscan(files, radius, min_density, pixelsize=None):
+    import glob
+    paths = glob.glob(files)
+    if paths:
+        from . import io, postprocess, lib
         from h5py import File
         for path in paths:
             print('Loading {} ...'.format(path))
             locs, info = io.load_locs(path)
-            clusters, locs = postprocess.dbscan(locs, radius, min_density)
+            if pixelsize is None:
+                file_pixelsize = lib.get_from_metadata(info, 'Pixelsize', lib.get_from_metadata(info, 'Camera.Pixelsize'))
+            else:
+                file_pixelsize = pixelsize
+            clusters, locs = postprocess.dbscan(locs, radius, min_density, file_pixelsize)
             base, ext = os.path.splitext(path)
             dbscan_info = {'Generated by': 'Picasso DBSCAN',
                            'Radius': radius,
                            'Minimum local density': min_density}
+            if file_pixelsize is not None:
+                dbscan_info['Pixelsize'] = file_pixelsize
             info.append(dbscan_info)
             io.save_locs(base + '_dbscan.hdf5', locs, info)
             with File(base + '_clusters.hdf5', 'w') as clusters_file:
                 clusters_file.create_dataset('clusters', data=clusters)
 
-def _nneighbor(files):
+def _nneighbor(files, k=1):
     import glob
     import h5py as _h5py
     import numpy as np
-    from scipy.spatial import distance
     paths = glob.glob(files)
     if paths:
         from . import io, postprocess
@@ -299,10 +331,10 @@ def _nneighbor(files):
             with _h5py.File(path, 'r') as locs_file:
                 locs = locs_file['clusters'][...]
             clusters = np.rec.array(locs, dtype=locs.dtype)
-            points = np.array(clusters[['com_x','com_y']].tolist())
-            alldist = distance.cdist(points,points)
-            alldist[alldist==0]=float('inf')
-            minvals = np.amin(alldist,axis=0)
+            points = np.stack((clusters.com_x, clusters.com_y), axis=1)
+            minvals = postprocess.nearest_neighbors(points, k, exclude_duplicates=True)[0]
+            if k == 1:
+                minvals = minvals[:, 0]
             base, ext = os.path.splitext(path)
             out_path = base + '_minval.txt'
             #np.savetxt(base + '_minval.txt', minvals, header='dx\tdy', newline='\r\n')
@@ -398,14 +430,40 @@ def _pair_correlation(files, bin_size, r_max):
             show()
 
 
+def _ripley(files, bin_size, r_max, pixelsize=None, edge_correction=True):
+    from glob import glob
+    paths = glob(files)
+    if paths:
+        import numpy as np
+        from .io import load_locs
+        from .lib import get_from_metadata
+        from .postprocess import spatial_statistics
+        for path in paths:
+            print('Loading {}...'.format(path))
+            locs, info = load_locs(path)
+            file_pixelsize = None
+            if hasattr(locs, 'z'):
+                if pixelsize is None:
+                    file_pixelsize = get_from_metadata(info, 'Pixelsize', get_from_metadata(info, 'Camera.Pixelsize'))
+                else:
+                    file_pixelsize = pixelsize
+                if file_pixelsize is None:
+                    print('No pixel size found, analyzing x and y only.')
+            print('Calculating spatial statistics...')
+            stats = spatial_statistics(locs, info, bin_size, r_max, file_pixelsize, edge_correction)
+            base, ext = os.path.splitext(path)
+            out_path = base + '_ripley.txt'
+            np.savetxt(out_path, np.array(stats.tolist()), delimiter='\t', header='\t'.join(stats.dtype.names), newline='\r\n')
+            print('Saved to: {}'.format(out_path))
+
+
 def _localize(args):
     files = args.files
     from glob import glob
     from .io import load_movie, save_locs
-    from .localize import get_spots, identify_async, identifications_from_futures, fit_async, locs_from_fits
+    from .localize import localize_chunks
     from os.path import splitext, isdir
-    from time import sleep
-    from . import gausslq, gaussmle, avgroi, lib
+    import numpy as np
     import os.path as _ospath
     import re as _re
     import os as _os
@@ -482,6 +540,10 @@ def _localize(args):
             #use default settings
             convergence = 0.001
             max_iterations = 1000
+        elif args.fit_method == 'lq':
+            from .gausslq import LM_CONVERGENCE, LM_MAX_ITERATIONS
+            convergence = LM_CONVERGENCE
+            max_iterations = LM_MAX_ITERATIONS
         else:
             convergence = 0
             max_iterations = 0
@@ -503,58 +565,23 @@ def _localize(args):
         print('Processing {}'.format(path))
         print('------------------------------------------')
         movie, info = load_movie(path)
-        current, futures = identify_async(movie, min_net_gradient, box)
         n_frames = len(movie)
-        while current[0] < n_frames:
-            print('Identifying in frame {:,} of {:,}'.format(current[0]+1, n_frames), end='\r')
-            sleep(0.2)
-        print('Identifying in frame {:,} of {:,}'.format(n_frames, n_frames))
-        ids = identifications_from_futures(futures)
-
-        """
-        current, thetas, CRLBs, likelihoods, iterations = fit_async(movie,
-                                                                    camera_info,
-                                                                    ids,
-                                                                    box,
-                                                                    convergence,
-                                                                    max_iterations)
-        """
-        if args.fit_method == 'lq':
-            spots = get_spots(movie, ids, box, camera_info)
-            theta = gausslq.fit_spots_parallel(spots, async=False)
-            locs = gausslq.locs_from_fits(ids, theta, box, args.gain)
-            #Todo implement gpufit at some point
-        elif args.fit_method == 'mle':
-            current, thetas, CRLBs, likelihoods, iterations = fit_async(movie,
-                                                                    camera_info,
-                                                                    ids,
-                                                                    box,
-                                                                    convergence,
-                                                                    max_iterations)
-            n_spots = len(ids)
-            while current[0] < n_spots:
-                print('Fitting spot {:,} of {:,}'.format(current[0]+1, n_spots), end='\r')
-                sleep(0.2)
-            print('Fitting spot {:,} of {:,}'.format(n_spots, n_spots))
-            locs = locs_from_fits(ids, thetas, CRLBs, likelihoods, iterations, box)
-
-
-        elif args.fit_method == 'avg':
-            spots = get_spots(movie, ids, box, camera_info)
-            theta = avgroi.fit_spots_parallel(spots, async=False)
-            locs = avgroi.locs_from_fits(ids, theta, box, args.gain)
-
-        else:
-            print('This should never happen...')
-
-        """
-        while current[0] < n_spots:
-            print('Fitting spot {:,} of {:,}'.format(current[0]+1, n_spots), end='\r')
-            sleep(0.2)
-        print('Fitting spot {:,} of {:,}'.format(n_spots, n_spots))
-
-        locs = locs_from_fits(ids, thetas, CRLBs, likelihoods, iterations, box)
-        """
+        locs = []
+        n_locs = 0
+        for n_frames_done, locs_ in localize_chunks(movie, camera_info, min_net_gradient, box,
+                                                    method=args.fit_method,
+                                                    eps=convergence,
+                                                    max_it=max_iterations,
+                                                    max_memory=args.max_memory * 1e9,
+                                                    maxima_method=args.maxima_method):
+            locs.append(locs_)
+            n_locs += len(locs_)
+            print('Localized {:,} spots in frame {:,} of {:,}'.format(n_locs, n_frames_done, n_frames), end='\r')
+        print('Localized {:,} spots in frame {:,} of {:,}'.format(n_locs, n_frames, n_frames))
+        if n_locs == 0:
+            print('No spots identified in {}'.format(path))
+            continue
+        locs = np.hstack(locs).view(np.recarray)
 
         localize_info = {'Generated by': 'Picasso Localize',
                          'ROI': None,
@@ -633,6 +660,7 @@ def main():
 
     cluster_combine_dist_parser = subparsers.add_parser('cluster_combine_dist', help='calculate the nearest neighbor for each combined cluster')
     cluster_combine_dist_parser.add_argument('files', help='one or multiple hdf5 localization files specified by a unix style path pattern')
+    cluster_combine_dist_parser.add_argument('-p', '--pixelsize', type=float, help='camera pixel size in nm, to scale z of 3D localizations (default: from metadata)')
 
     clusterfilter_parser = subparsers.add_parser('clusterfilter', help='filter localizations by properties of their clusters')
     clusterfilter_parser.add_argument('files', help='one or multiple hdf5 localization files specified by a unix style path pattern')
@@ -655,11 +683,17 @@ def main():
     density_parser.add_argument('files', help='one or multiple hdf5 localization files specified by a unix style path pattern')
     density_parser.add_argument('radius', type=float, help='maximal distance between to localizations to be considered local')
 
+    # pick
+    pick_parser = subparsers.add_parser('pick', help='extract the localizations in circular picks')
+    pick_parser.add_argument('files', help='one or multiple hdf5 localization files specified by a unix style path pattern')
+    pick_parser.add_argument('picks', help='yaml file with pick centers and diameter, as saved by Picasso Render')
+
     # DBSCAN
     dbscan_parser = subparsers.add_parser('dbscan', help='cluster localizations with the dbscan clustering algorithm')
     dbscan_parser.add_argument('files', help='one or multiple hdf5 localization files specified by a unix style path pattern')
     dbscan_parser.add_argument('radius', type=float, help='maximal distance between to localizations to be considered local')
     dbscan_parser.add_argument('density', type=int, help='minimum local density for localizations to be assigned to a cluster')
+    dbscan_parser.add_argument('-p', '--pixelsize', type=float, help='camera pixel size in nm, to scale z of 3D localizations (default: from metadata)')
 
     # Dark time
     dark_parser = subparsers.add_parser('dark', help='compute the dark time for grouped localizations')
@@ -685,21 +719,35 @@ def main():
     pc_parser.add_argument('-r', '--rmax', type=float, default=10, help='The maximum distance to calculate the pair-correlation')
     pc_parser.add_argument('files', help='one or multiple hdf5 localization files specified by a unix style path pattern')
 
+    # Ripley's functions
+    ripley_parser = subparsers.add_parser('ripley', help="calculate the pair-correlation and Ripley's K, L and H functions of localizations")
+    ripley_parser.add_argument('-b', '--binsize', type=float, default=0.1, help='the bin size')
+    ripley_parser.add_argument('-r', '--rmax', type=float, default=10, help='the maximum distance')
+    ripley_parser.add_argument('-p', '--pixelsize', type=float, help='camera pixel size in nm, to include z of 3D localizations (default: from metadata)')
+    ripley_parser.add_argument('-n', '--no-edge-correction', action='store_true', help='do not correct for edge effects')
+    ripley_parser.add_argument('files', help='one or multiple hdf5 localization files specified by a unix style path pattern')
+
     # localize
     localize_parser = subparsers.add_parser('localize', help='identify and fit single molecule spots')
     localize_parser.add_argument('files', nargs='?', help='one movie file or a folder containing movie files specified by a unix style path pattern')
     localize_parser.add_argument('-b', '--box-side-length', type=int, default=7, help='box side length')
-    localize_parser.add_argument('-a', '--fit-method', choices=['mle', 'lq', 'avg'], default='mle')
+    localize_parser.add_argument('-a', '--fit-method', choices=['mle', 'lq', 'lq-gpufit', 'avg'], default='mle',
+                                 help='lq-gpufit fits in batches with Gpufit, or on the CPU if it is not installed')
     localize_parser.add_argument('-g', '--gradient', type=int, default=5000, help='minimum net gradient')
     localize_parser.add_argument('-d', '--drift', type=int, default=1000, help='segmentation size for subsequent RCC, 0 to deactivate')
     localize_parser.add_argument('-bl', '--baseline', type=int, default=0, help='camera baseline')
     localize_parser.add_argument('-s', '--sensitivity', type=int, default=1, help='camera sensitivity')
     localize_parser.add_argument('-ga', '--gain', type=int, default=1, help='camera gain')
     localize_parser.add_argument('-qe', '--qe', type=int, default=1, help='camera quantum efficiency')
+    localize_parser.add_argument('-mm', '--maxima-method', choices=['filter', 'scan'], default='filter',
+                                 help='local maxima search: separable maximum filter or box scan (same result)')
+    localize_parser.add_argument('-mem', '--max-memory', type=float, default=2.0,
+                                 help='maximum memory for spots in flight in GB (default=2)')
 
     # nneighbors
-    nneighbor_parser = subparsers.add_parser('nneighbor', help='calculate nearest neighbor of a clustered dataset')
+    nneighbor_parser = subparsers.add_parser('nneighbor', help='calculate nearest neighbor of a clustered dataset (clusters at the same position are not neighbors)')
     nneighbor_parser.add_argument('files', nargs='?', help='one or multiple hdf5 clustered files specified by a unix style path pattern')
+    nneighbor_parser.add_argument('-k', type=int, default=1, help='number of nearest neighbors (one column each)')
 
     # render
     render_parser = subparsers.add_parser('render', help='render localization based images')
@@ -766,17 +814,19 @@ def main():
         elif args.command == 'cluster_combine':
             _cluster_combine(args.files)
         elif args.command == 'cluster_combine_dist':
-            _cluster_combine_dist(args.files)
+            _cluster_combine_dist(args.files, args.pixelsize)
         elif args.command == 'clusterfilter':
             _clusterfilter(args.files, args.clusterfile, args.parameter, args.minval, args.maxval)
         elif args.command == 'undrift':
             _undrift(args.files, args.segmentation, args.nodisplay, args.fromfile)
         elif args.command == 'density':
             _density(args.files, args.radius)
+        elif args.command == 'pick':
+            _pick(args.files, args.picks)
         elif args.command == 'dbscan':
-            _dbscan(args.files, args.radius, args.density)
+            _dbscan(args.files, args.radius, args.density, args.pixelsize)
         elif args.command == 'nneighbor':
-            _nneighbor(args.files)
+            _nneighbor(args.files, args.k)
         elif args.command == 'dark':
             _dark(args.files)
         elif args.command == 'align':
@@ -787,6 +837,8 @@ def main():
             _groupprops(args.files)
         elif args.command == 'pc':
             _pair_correlation(args.files, args.binsize, args.rmax)
+        elif args.command == 'ripley':
+            _ripley(args.files, args.binsize, args.rmax, args.pixelsize, not args.no_edge_correction)
         elif args.command == 'simulate':
             from .gui import simulate
             simulate.main()
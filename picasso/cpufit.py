@@ -0,0 +1,252 @@
+"""
+    picasso/cpufit
+    ~~~~~~~~~~~~~~
+
+    CPU replacement for the pygpufit fit interface, so that the batch fitting code path
+    runs without a GPU. Only the 2D elliptic Gaussian model with least squares estimation is available.
+"""
+import numpy as _np
+import numba as _numba
+import multiprocessing as _multiprocessing
+import threading as _threading
+import time as _time
+from concurrent import futures as _futures
+
+
+class ModelID():
+    GAUSS_1D = 0
+    GAUSS_2D = 1
+    GAUSS_2D_ELLIPTIC = 2
+    GAUSS_2D_ROTATED = 3
+    CAUCHY_2D_ELLIPTIC = 4
+    LINEAR_1D = 5
+
+
+class EstimatorID():
+    LSE = 0
+    MLE = 1
+
+
+class State():
+    CONVERGED = 0
+    MAX_ITERATION = 1
+    SINGULAR_HESSIAN = 2
+    NEG_CURVATURE_MLE = 3
+    GPU_NOT_READY = 4
+
+
+# States as plain ints for the compiled code
+_CONVERGED = State.CONVERGED
+_MAX_ITERATION = State.MAX_ITERATION
+_SINGULAR_HESSIAN = State.SINGULAR_HESSIAN
+
+# Number of fits that a worker runs in one compiled call
+BLOCK_SIZE = 1000
+
+_N_PARAMETERS = 6
+
+
+@_numba.jit(nopython=True, nogil=True)
+def solve(A, b, x):
+    ''' Solves A x = b in place by Gaussian elimination with partial pivoting. Returns False if A is singular. '''
+    n = len(b)
+    for k in range(n):
+        pivot = k
+        for i in range(k + 1, n):
+            if abs(A[i, k]) > abs(A[pivot, k]):
+                pivot = i
+        if A[pivot, k] == 0.0:
+            return False
+        if pivot != k:
+            for j in range(n):
+                A[k, j], A[pivot, j] = A[pivot, j], A[k, j]
+            b[k], b[pivot] = b[pivot], b[k]
+        for i in range(k + 1, n):
+            f = A[i, k] / A[k, k]
+            for j in range(k, n):
+                A[i, j] -= f * A[k, j]
+            b[i] -= f * b[k]
+    for k in range(n - 1, -1, -1):
+        x[k] = b[k]
+        for j in range(k + 1, n):
+            x[k] -= A[k, j] * x[j]
+        x[k] /= A[k, k]
+    return True
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _gauss_2d_elliptic_factors(p, size, gx, gy):
+    ''' p is [amplitude, x0, y0, sx, sy, offset]. The model is amplitude * gy[i] * gx[j] + offset. '''
+    for k in range(size):
+        gx[k] = _np.exp(-0.5 * ((k - p[1]) / p[3])**2)
+        gy[k] = _np.exp(-0.5 * ((k - p[2]) / p[4])**2)
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _chi_square(data, weights, use_weights, index, p, size, gx, gy):
+    _gauss_2d_elliptic_factors(p, size, gx, gy)
+    chi2 = 0.0
+    for i in range(size):
+        for j in range(size):
+            point = i * size + j
+            residual = data[index, point] - (p[0] * gy[i] * gx[j] + p[5])
+            if use_weights:
+                chi2 += weights[index, point] * residual**2
+            else:
+                chi2 += residual**2
+    return chi2
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _normal_equations(data, weights, use_weights, index, p, to_fit, size, gx, gy, jacobian, alpha, beta):
+    ''' Fills J^T W J and J^T W r and returns the chi-square '''
+    _gauss_2d_elliptic_factors(p, size, gx, gy)
+    alpha[:, :] = 0.0
+    beta[:] = 0.0
+    chi2 = 0.0
+    for i in range(size):
+        for j in range(size):
+            point = i * size + j
+            g = gy[i] * gx[j]
+            residual = data[index, point] - (p[0] * g + p[5])
+            w = weights[index, point] if use_weights else 1.0
+            chi2 += w * residual**2
+            dx = j - p[1]
+            dy = i - p[2]
+            jacobian[0] = g
+            jacobian[1] = p[0] * g * dx / p[3]**2
+            jacobian[2] = p[0] * g * dy / p[4]**2
+            jacobian[3] = p[0] * g * dx**2 / p[3]**3
+            jacobian[4] = p[0] * g * dy**2 / p[4]**3
+            jacobian[5] = 1.0
+            for k in range(_N_PARAMETERS):
+                if to_fit[k] == 0:
+                    jacobian[k] = 0.0
+            for k in range(_N_PARAMETERS):
+                beta[k] += w * jacobian[k] * residual
+                for l in range(k + 1):
+                    alpha[k, l] += w * jacobian[k] * jacobian[l]
+    for k in range(_N_PARAMETERS):
+        for l in range(k):
+            alpha[l, k] = alpha[k, l]
+        if to_fit[k] == 0:
+            alpha[k, k] = 1.0
+    return chi2
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _fit_gauss_2d_elliptic(data, weights, use_weights, to_fit, size, tolerance, max_it, start, end,
+                           parameters, states, chi_squares, n_iterations):
+    ''' Levenberg-Marquardt least squares fits of the fits start to end. parameters holds the initial parameters. '''
+    gx = _np.empty(size)
+    gy = _np.empty(size)
+    p = _np.empty(_N_PARAMETERS)
+    trial = _np.empty(_N_PARAMETERS)
+    jacobian = _np.empty(_N_PARAMETERS)
+    alpha = _np.empty((_N_PARAMETERS, _N_PARAMETERS))
+    beta = _np.empty(_N_PARAMETERS)
+    A = _np.empty((_N_PARAMETERS, _N_PARAMETERS))
+    b = _np.empty(_N_PARAMETERS)
+    delta = _np.empty(_N_PARAMETERS)
+    for index in range(start, end):
+        p[:] = parameters[index]
+        lambda_ = 1e-3
+        state = _MAX_ITERATION
+        chi2 = _normal_equations(data, weights, use_weights, index, p, to_fit, size, gx, gy, jacobian, alpha, beta)
+        it = 0
+        while it < max_it:
+            it += 1
+            A[:, :] = alpha
+            for k in range(_N_PARAMETERS):
+                A[k, k] *= 1.0 + lambda_
+            b[:] = beta
+            if not solve(A, b, delta):
+                state = _SINGULAR_HESSIAN
+                break
+            trial[:] = p + delta
+            if trial[3] <= 0.0 or trial[4] <= 0.0:
+                lambda_ *= 10.0
+                continue
+            trial_chi2 = _chi_square(data, weights, use_weights, index, trial, size, gx, gy)
+            if trial_chi2 <= chi2:
+                p[:] = trial
+                converged = chi2 - trial_chi2 < tolerance * max(1.0, trial_chi2)
+                chi2 = _normal_equations(data, weights, use_weights, index, p, to_fit, size, gx, gy,
+                                         jacobian, alpha, beta)
+                if converged:
+                    state = _CONVERGED
+                    break
+                lambda_ *= 0.1
+            else:
+                lambda_ *= 10.0
+        parameters[index] = p
+        states[index] = state
+        chi_squares[index] = chi2
+        n_iterations[index] = it
+
+
+def _worker(data, weights, use_weights, to_fit, size, tolerance, max_it, parameters, states, chi_squares,
+            n_iterations, next_block, block_size, lock):
+    ''' Takes blocks of fits until none are left '''
+    N = len(data)
+    while True:
+        with lock:
+            start = next_block[0]
+            if start >= N:
+                return
+            end = min(start + block_size, N)
+            next_block[0] = end
+        _fit_gauss_2d_elliptic(data, weights, use_weights, to_fit, size, tolerance, max_it, start, end,
+                               parameters, states, chi_squares, n_iterations)
+
+
+def fit(data, weights, model_id, initial_parameters, tolerance=None, max_number_iterations=None,
+        parameters_to_fit=None, estimator_id=None, user_info=None):
+    '''
+    Fits the model to each row of data, like pygpufit.gpufit.fit.
+    data has shape (number of fits, number of points) with square fit windows in row-major order.
+    Returns parameters, states, chi_squares, number_iterations and execution_time (seconds).
+    '''
+    if model_id != ModelID.GAUSS_2D_ELLIPTIC:
+        raise ValueError('Model not available.')
+    if estimator_id not in (None, EstimatorID.LSE):
+        raise ValueError('Estimator not available.')
+    if user_info is not None:
+        raise ValueError('User info not supported.')
+    if tolerance is None:
+        tolerance = 1e-4
+    if max_number_iterations is None:
+        max_number_iterations = 25
+    data = _np.ascontiguousarray(data, dtype=_np.float32)
+    n_fits, n_points = data.shape
+    size = int(round(_np.sqrt(n_points)))
+    if size * size != n_points:
+        raise ValueError('Number of points must be a square number.')
+    if initial_parameters.shape != (n_fits, _N_PARAMETERS):
+        raise ValueError('Initial parameters must have shape (number of fits, {}).'.format(_N_PARAMETERS))
+    if parameters_to_fit is None:
+        parameters_to_fit = _np.ones(_N_PARAMETERS, dtype=_np.int32)
+    parameters_to_fit = _np.ascontiguousarray(parameters_to_fit, dtype=_np.int32)
+    use_weights = weights is not None
+    if use_weights:
+        weights = _np.ascontiguousarray(weights, dtype=_np.float32)
+    else:
+        weights = _np.ones((1, 1), dtype=_np.float32)
+
+    t0 = _time.time()
+    parameters = _np.array(initial_parameters, dtype=_np.float32)
+    states = _np.zeros(n_fits, dtype=_np.int32)
+    chi_squares = _np.zeros(n_fits, dtype=_np.float32)
+    number_iterations = _np.zeros(n_fits, dtype=_np.int32)
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    block_size = max(1, min(BLOCK_SIZE, int(_np.ceil(n_fits / (4 * n_workers)))))
+    lock = _threading.Lock()
+    next_block = [0]
+    with _futures.ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(_worker, data, weights, use_weights, parameters_to_fit, size, tolerance,
+                              max_number_iterations, parameters, states, chi_squares, number_iterations,
+                              next_block, block_size, lock) for _ in range(n_workers)]
+    for f in fs:
+        f.result()
+    execution_time = _time.time() - t0
+    return parameters, states, chi_squares, number_iterations, execution_time
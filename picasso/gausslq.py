@@ -3,13 +3,17 @@ import numpy as _np
 from tqdm import tqdm as _tqdm
 import numba as _numba
 import multiprocessing as _multiprocessing
+import threading as _threading
 from concurrent import futures as _futures
 from . import postprocess as _postprocess
+from . import cpufit as _cpufit
 
 try:
     from pygpufit import gpufit as gf
     gpufit_installed = True
 except ImportError:
+    # The batch fits of fit_spots_gpufit run on the CPU
+    from . import cpufit as gf
     gpufit_installed = False
 
 
@@ -159,14 +163,182 @@ def fit_spots_parallel(spots, async=False):
     return fits_from_futures(fs)
 
 
+# Number of spots that a worker fits in one compiled call
+LM_BLOCK_SIZE = 1000
+# Default relative chi-square change and iteration limit of the Levenberg-Marquardt fit
+LM_CONVERGENCE = 1e-2
+LM_MAX_ITERATIONS = 100
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _lm_model(theta, grid, size, model_x, model_y, dmodel_x, dmodel_y, smodel_x, smodel_y):
+    ''' The separable model of _compute_model and its x and y factors' derivatives '''
+    for k in range(size):
+        dx = (grid[k] - theta[0]) / theta[4]
+        dy = (grid[k] - theta[1]) / theta[5]
+        model_x[k] = 0.3989422804014327 / theta[4] * _np.exp(-0.5 * dx**2)
+        model_y[k] = 0.3989422804014327 / theta[5] * _np.exp(-0.5 * dy**2)
+        dmodel_x[k] = model_x[k] * dx / theta[4]
+        dmodel_y[k] = model_y[k] * dy / theta[5]
+        smodel_x[k] = model_x[k] * (dx**2 - 1.0) / theta[4]
+        smodel_y[k] = model_y[k] * (dy**2 - 1.0) / theta[5]
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _lm_normal_equations(spot, theta, grid, size, model_x, model_y, dmodel_x, dmodel_y, smodel_x, smodel_y,
+                         jacobian, alpha, beta):
+    ''' Fills J^T J and J^T r of the residuals and returns the sum of squared residuals '''
+    _lm_model(theta, grid, size, model_x, model_y, dmodel_x, dmodel_y, smodel_x, smodel_y)
+    alpha[:, :] = 0.0
+    beta[:] = 0.0
+    chi2 = 0.0
+    n = theta[2]
+    for i in range(size):
+        for j in range(size):
+            residual = spot[i, j] - (n * model_y[i] * model_x[j] + theta[3])
+            chi2 += residual**2
+            jacobian[0] = n * model_y[i] * dmodel_x[j]
+            jacobian[1] = n * dmodel_y[i] * model_x[j]
+            jacobian[2] = model_y[i] * model_x[j]
+            jacobian[3] = 1.0
+            jacobian[4] = n * model_y[i] * smodel_x[j]
+            jacobian[5] = n * smodel_y[i] * model_x[j]
+            for k in range(6):
+                beta[k] += jacobian[k] * residual
+                for l in range(k + 1):
+                    alpha[k, l] += jacobian[k] * jacobian[l]
+    for k in range(6):
+        for l in range(k):
+            alpha[l, k] = alpha[k, l]
+    return chi2
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _lm_chi2(spot, theta, grid, size, model_x, model_y):
+    for k in range(size):
+        model_x[k] = 0.3989422804014327 / theta[4] * _np.exp(-0.5 * ((grid[k] - theta[0]) / theta[4])**2)
+        model_y[k] = 0.3989422804014327 / theta[5] * _np.exp(-0.5 * ((grid[k] - theta[1]) / theta[5])**2)
+    chi2 = 0.0
+    for i in range(size):
+        for j in range(size):
+            chi2 += (spot[i, j] - (theta[2] * model_y[i] * model_x[j] + theta[3]))**2
+    return chi2
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _fit_spot_lm(spot, theta, eps, max_it):
+    '''
+    Levenberg-Marquardt least squares fit of the model of fit_spot with an analytic Jacobian.
+    theta holds the initial parameters and is overwritten with the fit: [x, y, photons, bg, sx, sy]
+    '''
+    size = spot.shape[0]
+    size_half = int(size / 2)
+    grid = _np.arange(-size_half, size_half + 1).astype(_np.float64)
+    model_x = _np.empty(size)
+    model_y = _np.empty(size)
+    dmodel_x = _np.empty(size)
+    dmodel_y = _np.empty(size)
+    smodel_x = _np.empty(size)
+    smodel_y = _np.empty(size)
+    jacobian = _np.empty(6)
+    alpha = _np.empty((6, 6))
+    beta = _np.empty(6)
+    A = _np.empty((6, 6))
+    b = _np.empty(6)
+    delta = _np.empty(6)
+    trial = _np.empty(6)
+    lambda_ = 1e-3
+    chi2 = _lm_normal_equations(spot, theta, grid, size, model_x, model_y, dmodel_x, dmodel_y,
+                                smodel_x, smodel_y, jacobian, alpha, beta)
+    n_iterations = 0
+    for it in range(max_it):
+        n_iterations = it + 1
+        A[:, :] = alpha
+        for k in range(6):
+            A[k, k] += lambda_ * alpha[k, k]
+        b[:] = beta
+        if not _cpufit.solve(A, b, delta):
+            lambda_ *= 10.0
+            continue
+        trial[:] = theta + delta
+        if trial[4] <= 0.0 or trial[5] <= 0.0:
+            lambda_ *= 10.0
+            continue
+        trial_chi2 = _lm_chi2(spot, trial, grid, size, model_x, model_y)
+        if trial_chi2 < chi2:
+            theta[:] = trial
+            chi2 = _lm_normal_equations(spot, theta, grid, size, model_x, model_y, dmodel_x, dmodel_y,
+                                        smodel_x, smodel_y, jacobian, alpha, beta)
+            # Converged when an undamped (Gauss-Newton) step would reduce chi2 by less than eps * chi2.
+            # A small decrease alone is not enough, it may come from a strongly damped step.
+            A[:, :] = alpha
+            b[:] = beta
+            if _cpufit.solve(A, b, delta):
+                predicted = 0.0
+                for k in range(6):
+                    predicted += delta[k] * beta[k]
+                if predicted <= eps * chi2:
+                    break
+            lambda_ /= 10.0
+        else:
+            lambda_ *= 10.0
+            if lambda_ > 1e10:
+                break
+    return n_iterations
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _fit_spots_lm_block(spots, start, end, thetas, eps, max_it):
+    size = spots.shape[1]
+    size_half = int(size / 2)
+    theta = _np.empty(6)
+    for index in range(start, end):
+        theta[:] = _initial_parameters(spots[index], size, size_half)
+        _fit_spot_lm(spots[index], theta, eps, max_it)
+        thetas[index] = theta
+
+
+def _lm_worker(spots, thetas, eps, max_it, next_block, block_size, lock):
+    ''' Takes blocks of spots until none are left '''
+    N = len(spots)
+    while True:
+        with lock:
+            start = next_block[0]
+            if start >= N:
+                return
+            end = min(start + block_size, N)
+            next_block[0] = end
+        _fit_spots_lm_block(spots, start, end, thetas, eps, max_it)
+
+
+def fit_spots_lm(spots, eps=LM_CONVERGENCE, max_it=LM_MAX_ITERATIONS):
+    '''
+    Fits the spots like fit_spots_parallel, but with a compiled Levenberg-Marquardt solver in threads.
+    Returns theta as [x, y, photons, bg, sx, sy] per spot, the layout of fit_spot. Worker errors are raised.
+    '''
+    N = len(spots)
+    thetas = _np.empty((N, 6), dtype=_np.float32)
+    thetas.fill(_np.nan)
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    block_size = max(1, min(LM_BLOCK_SIZE, int(_np.ceil(N / (4 * n_workers)))))
+    lock = _threading.Lock()
+    next_block = [0]
+    with _futures.ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(_lm_worker, spots, thetas, eps, max_it, next_block, block_size, lock)
+              for _ in range(n_workers)]
+    for f in fs:
+        f.result()
+    return thetas
+
+
 def fit_spots_gpufit(spots):
     size = spots.shape[1]
     initial_parameters = initial_parameters_gpufit(spots, size)
-    spots.shape = (len(spots), (size * size))
+    data = spots.reshape((len(spots), size * size))
     model_id = gf.ModelID.GAUSS_2D_ELLIPTIC
 
     parameters, states, chi_squares, number_iterations, execution_time \
-        = gf.fit(spots, None, model_id, initial_parameters, tolerance=1e-2, max_number_iterations=20)
+        = gf.fit(data, None, model_id, initial_parameters, tolerance=1e-2, max_number_iterations=20)
 
     parameters[:, 0] *= 2.0 * _np.pi * parameters[:, 3] * parameters[:, 4]
 
@@ -134,88 +134,148 @@ def _gaussian_integral(x, mu, sigma):
     return 0.5 * (_math.erf((d + 0.5) * sq_norm) - _math.erf((d - 0.5) * sq_norm))
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
-def _derivative_gaussian_integral(x, mu, sigma, photons, PSFc):
-    d = x - mu
-    a = _np.exp(-0.5 * ((d + 0.5) / sigma)**2)
-    b = _np.exp(-0.5 * ((d - 0.5) / sigma)**2)
+# Rows of the per-axis terms computed by _axis_terms
+_PSF, _D, _A, _B, _P, _M, _AP, _BM = range(8)
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _axis_terms(size, mu, sigma, terms):
+    '''
+    The PSF and its derivatives factorize into x and y terms. This computes the expensive
+    erf and exp terms once per axis pixel instead of once per box pixel.
+    '''
+    for k in range(size):
+        terms[_PSF, k] = _gaussian_integral(k, mu, sigma)
+        # For the position derivatives
+        d = k - mu
+        terms[_D, k] = d
+        terms[_A, k] = _np.exp(-0.5 * ((d + 0.5) / sigma)**2)
+        terms[_B, k] = _np.exp(-0.5 * ((d - 0.5) / sigma)**2)
+        # For the sigma derivatives
+        p = k + 0.5 - mu
+        m = k - 0.5 - mu
+        terms[_P, k] = p
+        terms[_M, k] = m
+        terms[_AP, k] = _np.exp(-0.5 * (p / sigma)**2)
+        terms[_BM, k] = _np.exp(-0.5 * (m / sigma)**2)
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _derivative_position(terms, k, sigma, photons, PSFc):
+    ''' First and second derivative of the model by the center along one axis, from precomputed axis terms '''
+    d = terms[_D, k]
+    a = terms[_A, k]
+    b = terms[_B, k]
     dudt = -photons * PSFc * (a - b) / (_np.sqrt(2.0 * _np.pi) * sigma)
     d2udt2 = -photons * ((d + 0.5) * a - (d - 0.5) * b) * PSFc / (_np.sqrt(2.0 * _np.pi) * sigma**3)
     return dudt, d2udt2
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
-def _derivative_gaussian_integral_1d_sigma(x, mu, sigma, photons, PSFc):
-    ax = _np.exp(-0.5 * ((x + 0.5 - mu) / sigma)**2)
-    bx = _np.exp(-0.5 * ((x - 0.5 - mu) / sigma)**2)
-    dudt = -photons * (ax * (x + 0.5 - mu) - bx * (x - 0.5 - mu)) * PSFc / (_np.sqrt(2.0 * _np.pi) * sigma**2)
-    d2udt2 = -2.0 * dudt / sigma - photons * (ax * (x + 0.5 - mu)**3 - bx * (x - 0.5 - mu)**3) * PSFc / (_np.sqrt(2.0 * _np.pi) * sigma**5)
+@_numba.jit(nopython=True, nogil=True)
+def _derivative_sigma(terms, k, sigma, photons, PSFc):
+    ''' First and second derivative of the model by sigma along one axis, from precomputed axis terms '''
+    p = terms[_P, k]
+    m = terms[_M, k]
+    ax = terms[_AP, k]
+    bx = terms[_BM, k]
+    dudt = -photons * (ax * p - bx * m) * PSFc / (_np.sqrt(2.0 * _np.pi) * sigma**2)
+    d2udt2 = -2.0 * dudt / sigma - photons * (ax * p**3 - bx * m**3) * PSFc / (_np.sqrt(2.0 * _np.pi) * sigma**5)
     return dudt, d2udt2
 
 
-@_numba.jit(nopython=True, nogil=True)
-def _derivative_gaussian_integral_2d_sigma(x, y, mu, nu, sigma, photons, PSFx, PSFy):
-    dSx, ddSx = _derivative_gaussian_integral_1d_sigma(x, mu, sigma, photons, PSFy)
-    dSy, ddSy = _derivative_gaussian_integral_1d_sigma(y, nu, sigma, photons, PSFx)
-    dudt = dSx + dSy
-    d2udt2 = ddSx + ddSy
-    return dudt, d2udt2
+# Number of spots that a worker fits in one compiled call
+BLOCK_SIZE = 1000
 
 
-def _worker(func, spots, thetas, CRLBs, likelihoods, iterations, eps, max_it, current, lock):
+def _worker(func, spots, thetas, CRLBs, likelihoods, iterations, eps, max_it, current, next_block, block_size, lock):
+    ''' Takes blocks of spots until none are left. current counts the fitted spots. '''
     N = len(spots)
     while True:
         with lock:
-            index = current[0]
-            if index == N:
+            start = next_block[0]
+            if start >= N:
                 return
-            current[0] += 1
-        func(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+            end = min(start + block_size, N)
+            next_block[0] = end
+        func(spots, start, end, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+        with lock:
+            current[0] += end - start
 
 
-def gaussmle(spots, eps, max_it, method='sigma'):
-    N = len(spots)
-    thetas = _np.zeros((N, 6), dtype=_np.float32)
-    CRLBs = _np.inf * _np.ones((N, 6), dtype=_np.float32)
-    likelihoods = _np.zeros(N, dtype=_np.float32)
-    iterations = _np.zeros(N, dtype=_np.int32)
+def _block_func(method):
     if method == 'sigma':
-        func = _mlefit_sigma
+        return _mlefit_sigma_block
     elif method == 'sigmaxy':
-        func = _mlefit_sigmaxy
+        return _mlefit_sigmaxy_block
     else:
         raise ValueError('Method not available.')
-    for i in range(N):
-        func(spots, i, thetas, CRLBs, likelihoods, iterations, eps, max_it)
-    return thetas, CRLBs, likelihoods, iterations
 
 
-def gaussmle_async(spots, eps, max_it, method='sigma'):
-    N = len(spots)
+def _allocate(N):
     thetas = _np.zeros((N, 6), dtype=_np.float32)
     CRLBs = _np.inf * _np.ones((N, 6), dtype=_np.float32)
     likelihoods = _np.zeros(N, dtype=_np.float32)
     iterations = _np.zeros(N, dtype=_np.int32)
+    return thetas, CRLBs, likelihoods, iterations
+
+
+def _submit_workers(spots, eps, max_it, method, block_size):
+    N = len(spots)
+    thetas, CRLBs, likelihoods, iterations = _allocate(N)
+    func = _block_func(method)
     n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    if block_size is None:
+        # Small enough for progress and load balancing, large enough that the lock is rarely taken
+        block_size = max(1, min(BLOCK_SIZE, int(_np.ceil(N / (4 * n_workers)))))
     lock = _threading.Lock()
     current = [0]
-    if method == 'sigma':
-        func = _mlefit_sigma
-    elif method == 'sigmaxy':
-        func = _mlefit_sigmaxy
-    else:
-        raise ValueError('Method not available.')
+    next_block = [0]
     executor = _futures.ThreadPoolExecutor(n_workers)
-    for i in range(n_workers):
-        executor.submit(_worker, func, spots, thetas, CRLBs, likelihoods, iterations, eps, max_it, current, lock)
+    fs = [executor.submit(_worker, func, spots, thetas, CRLBs, likelihoods, iterations, eps, max_it,
+                          current, next_block, block_size, lock) for _ in range(n_workers)]
+    return executor, fs, current, thetas, CRLBs, likelihoods, iterations
+
+
+def gaussmle(spots, eps, max_it, method='sigma'):
+    N = len(spots)
+    thetas, CRLBs, likelihoods, iterations = _allocate(N)
+    func = _block_func(method)
+    func(spots, 0, N, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+    return thetas, CRLBs, likelihoods, iterations
+
+
+def gaussmle_parallel(spots, eps, max_it, method='sigma', block_size=None):
+    ''' Fits blocks of spots in parallel threads and returns when all spots are fitted. Worker errors are raised. '''
+    executor, fs, current, thetas, CRLBs, likelihoods, iterations = _submit_workers(spots, eps, max_it, method,
+                                                                                    block_size)
+    executor.shutdown(wait=True)
+    for f in fs:
+        f.result()
+    return thetas, CRLBs, likelihoods, iterations
+
+
+def gaussmle_async(spots, eps, max_it, method='sigma', block_size=None):
+    ''' Like gaussmle_parallel, but returns immediately. current[0] reaches len(spots) when all spots are fitted. '''
+    executor, fs, current, thetas, CRLBs, likelihoods, iterations = _submit_workers(spots, eps, max_it, method,
+                                                                                    block_size)
     executor.shutdown(wait=False)
     # A synchronous single-threaded version for debugging:
-    # for i in range(N):
-    #     print('Spot', i)
-    #     func(spots, i, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+    # thetas, CRLBs, likelihoods, iterations = gaussmle(spots, eps, max_it, method=method)
     return current, thetas, CRLBs, likelihoods, iterations
 
 
+@_numba.jit(nopython=True, nogil=True)
+def _mlefit_sigma_block(spots, start, end, thetas, CRLBs, likelihoods, iterations, eps, max_it):
+    for index in range(start, end):
+        _mlefit_sigma(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _mlefit_sigmaxy_block(spots, start, end, thetas, CRLBs, likelihoods, iterations, eps, max_it):
+    for index in range(start, end):
+        _mlefit_sigmaxy(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+
+
 @_numba.jit(nopython=True, nogil=True)
 def _mlefit_sigma(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it):
     n_params = 5
@@ -235,6 +295,8 @@ def _mlefit_sigma(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max
     d2udt2 = _np.zeros(n_params, dtype=_np.float32)
     numerator = _np.zeros(n_params, dtype=_np.float32)
     denominator = _np.zeros(n_params, dtype=_np.float32)
+    x_terms = _np.zeros((8, size))
+    y_terms = _np.zeros((8, size))
 
     old_x = theta[0]
     old_y = theta[1]
@@ -246,19 +308,24 @@ def _mlefit_sigma(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max
         numerator[:] = 0.0
         denominator[:] = 0.0
 
+        _axis_terms(size, theta[0], theta[4], x_terms)
+        _axis_terms(size, theta[1], theta[4], y_terms)
         for ii in range(size):
             for jj in range(size):
-                PSFx = _gaussian_integral(ii, theta[0], theta[4])
-                PSFy = _gaussian_integral(jj, theta[1], theta[4])
+                PSFx = x_terms[_PSF, ii]
+                PSFy = y_terms[_PSF, jj]
 
                 # Derivatives
-                dudt[0], d2udt2[0] = _derivative_gaussian_integral(ii, theta[0], theta[4], theta[2], PSFy)
-                dudt[1], d2udt2[1] = _derivative_gaussian_integral(jj, theta[1], theta[4], theta[2], PSFx)
+                dudt[0], d2udt2[0] = _derivative_position(x_terms, ii, theta[4], theta[2], PSFy)
+                dudt[1], d2udt2[1] = _derivative_position(y_terms, jj, theta[4], theta[2], PSFx)
                 dudt[2] = PSFx * PSFy
                 d2udt2[2] = 0.0
                 dudt[3] = 1.0
                 d2udt2[3] = 0.0
-                dudt[4], d2udt2[4] = _derivative_gaussian_integral_2d_sigma(ii, jj, theta[0], theta[1], theta[4], theta[2], PSFx, PSFy)
+                dSx, ddSx = _derivative_sigma(x_terms, ii, theta[4], theta[2], PSFy)
+                dSy, ddSy = _derivative_sigma(y_terms, jj, theta[4], theta[2], PSFx)
+                dudt[4] = dSx + dSy
+                d2udt2[4] = ddSx + ddSy
 
                 model = theta[2] * dudt[2] + theta[3]
                 cf = df = 0.0
@@ -303,16 +370,21 @@ def _mlefit_sigma(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max
     # Calculating the CRLB and LogLikelihood
     Div = 0.0
     M = _np.zeros((n_params, n_params), dtype=_np.float32)
+    _axis_terms(size, theta[0], theta[4], x_terms)
+    _axis_terms(size, theta[1], theta[4], y_terms)
     for ii in range(size):
         for jj in range(size):
-            PSFx = _gaussian_integral(ii, theta[0], theta[4])
-            PSFy = _gaussian_integral(jj, theta[1], theta[4])
+            PSFx = x_terms[_PSF, ii]
+            PSFy = y_terms[_PSF, jj]
             model = theta[3] + theta[2] * PSFx * PSFy
 
             # Calculating derivatives
-            dudt[0], d2udt2[0] = _derivative_gaussian_integral(ii, theta[0], theta[4], theta[2], PSFy)
-            dudt[1], d2udt2[1] = _derivative_gaussian_integral(jj, theta[1], theta[4], theta[2], PSFx)
-            dudt[4], d2udt2[4] = _derivative_gaussian_integral_2d_sigma(ii, jj, theta[0], theta[1], theta[4], theta[2], PSFx, PSFy)
+            dudt[0], d2udt2[0] = _derivative_position(x_terms, ii, theta[4], theta[2], PSFy)
+            dudt[1], d2udt2[1] = _derivative_position(y_terms, jj, theta[4], theta[2], PSFx)
+            dSx, ddSx = _derivative_sigma(x_terms, ii, theta[4], theta[2], PSFy)
+            dSy, ddSy = _derivative_sigma(y_terms, jj, theta[4], theta[2], PSFx)
+            dudt[4] = dSx + dSy
+            d2udt2[4] = ddSx + ddSy
             dudt[2] = PSFx * PSFy
             dudt[3] = 1.0
 
@@ -362,6 +434,8 @@ def _mlefit_sigmaxy(spots, index, thetas, CRLBs, likelihoods, iterations, eps, m
     d2udt2 = _np.zeros(n_params, dtype=_np.float32)
     numerator = _np.zeros(n_params, dtype=_np.float32)
     denominator = _np.zeros(n_params, dtype=_np.float32)
+    x_terms = _np.zeros((8, size))
+    y_terms = _np.zeros((8, size))
 
     old_x = theta[0]
     old_y = theta[1]
@@ -375,20 +449,22 @@ def _mlefit_sigmaxy(spots, index, thetas, CRLBs, likelihoods, iterations, eps, m
         numerator[:] = 0.0
         denominator[:] = 0.0
 
+        _axis_terms(size, theta[0], theta[4], x_terms)
+        _axis_terms(size, theta[1], theta[5], y_terms)
         for ii in range(size):
             for jj in range(size):
-                PSFx = _gaussian_integral(ii, theta[0], theta[4])
-                PSFy = _gaussian_integral(jj, theta[1], theta[5])
+                PSFx = x_terms[_PSF, ii]
+                PSFy = y_terms[_PSF, jj]
 
                 # Derivatives
-                dudt[0], d2udt2[0] = _derivative_gaussian_integral(ii, theta[0], theta[4], theta[2], PSFy)
-                dudt[1], d2udt2[1] = _derivative_gaussian_integral(jj, theta[1], theta[5], theta[2], PSFx)
+                dudt[0], d2udt2[0] = _derivative_position(x_terms, ii, theta[4], theta[2], PSFy)
+                dudt[1], d2udt2[1] = _derivative_position(y_terms, jj, theta[5], theta[2], PSFx)
                 dudt[2] = PSFx * PSFy
                 d2udt2[2] = 0.0
                 dudt[3] = 1.0
                 d2udt2[3] = 0.0
-                dudt[4], d2udt2[4] = _derivative_gaussian_integral_1d_sigma(ii, theta[0], theta[4], theta[2], PSFy)
-                dudt[5], d2udt2[5] = _derivative_gaussian_integral_1d_sigma(jj, theta[1], theta[5], theta[2], PSFx)
+                dudt[4], d2udt2[4] = _derivative_sigma(x_terms, ii, theta[4], theta[2], PSFy)
+                dudt[5], d2udt2[5] = _derivative_sigma(y_terms, jj, theta[5], theta[2], PSFx)
 
                 model = theta[2] * dudt[2] + theta[3]
                 cf = df = 0.0
@@ -433,17 +509,19 @@ def _mlefit_sigmaxy(spots, index, thetas, CRLBs, likelihoods, iterations, eps, m
     # Calculating the CRLB and LogLikelihood
     Div = 0.0
     M = _np.zeros((n_params, n_params), dtype=_np.float32)
+    _axis_terms(size, theta[0], theta[4], x_terms)
+    _axis_terms(size, theta[1], theta[5], y_terms)
     for ii in range(size):
         for jj in range(size):
-            PSFx = _gaussian_integral(ii, theta[0], theta[4])
-            PSFy = _gaussian_integral(jj, theta[1], theta[5])
+            PSFx = x_terms[_PSF, ii]
+            PSFy = y_terms[_PSF, jj]
             model = theta[3] + theta[2] * PSFx * PSFy
 
             # Calculating derivatives
-            dudt[0], d2udt2[0] = _derivative_gaussian_integral(ii, theta[0], theta[4], theta[2], PSFy)
-            dudt[1], d2udt2[1] = _derivative_gaussian_integral(jj, theta[1], theta[5], theta[2], PSFx)
-            dudt[4], d2udt2[4] = _derivative_gaussian_integral_1d_sigma(ii, theta[0], theta[4], theta[2], PSFy)
-            dudt[5], d2udt2[5] = _derivative_gaussian_integral_1d_sigma(jj, theta[1], theta[5], theta[2], PSFx)
+            dudt[0], d2udt2[0] = _derivative_position(x_terms, ii, theta[4], theta[2], PSFy)
+            dudt[1], d2udt2[1] = _derivative_position(y_terms, jj, theta[5], theta[2], PSFx)
+            dudt[4], d2udt2[4] = _derivative_sigma(x_terms, ii, theta[4], theta[2], PSFy)
+            dudt[5], d2udt2[5] = _derivative_sigma(y_terms, jj, theta[5], theta[2], PSFx)
             dudt[2] = PSFx * PSFy
             dudt[3] = 1.0
 
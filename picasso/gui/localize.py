@@ -452,7 +452,8 @@ class ParametersDialog(QtGui.QDialog):
         self.gpufit_checkbox.stateChanged.connect(self.on_gpufit_changed)
 
         if not gpufit_installed:
-            self.gpufit_checkbox.hide()
+            # Batch fits run on the CPU
+            self.gpufit_checkbox.setText('Batch fit (CPU)')
         lq_grid.addWidget(self.gpufit_checkbox)
 
         fit_stack.addWidget(lq_widget)
@@ -1144,8 +1145,13 @@ class Window(QtGui.QMainWindow):
             self.status_bar.showMessage('Preparing fit...')
             method = self.parameters_dialog.fit_method.currentText()
             method = {'MLE, integrated Gaussian': 'mle', 'LQ, Gaussian': 'lq', 'Average of ROI': 'avg'}[method]
-            eps = self.parameters_dialog.convergence_criterion.value()
-            max_it = self.parameters_dialog.max_it.value()
+            if method == 'lq':
+                # The convergence settings of the dialog are those of MLE
+                eps = gausslq.LM_CONVERGENCE
+                max_it = gausslq.LM_MAX_ITERATIONS
+            else:
+                eps = self.parameters_dialog.convergence_criterion.value()
+                max_it = self.parameters_dialog.max_it.value()
             fit_z = self.parameters_dialog.fit_z_checkbox.isChecked()
             use_gpufit = self.parameters_dialog.gpufit_checkbox.isChecked()
             self.fit_worker = FitWorker(self.movie, self.camera_info, self.identifications, self.parameters['Box Size'],
@@ -1162,11 +1168,8 @@ class Window(QtGui.QMainWindow):
         self.fit_z_worker.start()
 
     def on_fit_progress(self, current, total):
-        if self.parameters_dialog.gpufit_checkbox.isChecked():
-            self.status_bar.showMessage('Fitting spots by GPUfit...')
-        else:
-            message = 'Fitting spot {:,} / {:,} ...'.format(current, total)
-            self.status_bar.showMessage(message)
+        message = 'Fitting spot {:,} / {:,} ...'.format(current, total)
+        self.status_bar.showMessage(message)
 
     def on_fit_finished(self, locs, elapsed_time, fit_z, calibrate_z):
         self.status_bar.showMessage('Fitted {:,} spots in {:.2f} seconds.'.format(len(locs), elapsed_time))
@@ -1291,41 +1294,20 @@ class FitWorker(QtCore.QThread):
     def run(self):
         N = len(self.identifications)
         t0 = time.time()
-        spots = localize.get_spots(self.movie, self.identifications, self.box, self.camera_info)
-        if self.method == 'lq':
-            if self.use_gpufit:
-                self.progressMade.emit(1, 1)
-                theta = gausslq.fit_spots_gpufit(spots)
-                em = self.camera_info['gain'] > 1
-                locs = gausslq.locs_from_fits_gpufit(self.identifications, theta, self.box, em)
-            else:
-                fs = gausslq.fit_spots_parallel(spots, async=True)
-                n_tasks = len(fs)
-                while lib.n_futures_done(fs) < n_tasks:
-                    self.progressMade.emit(round(N * lib.n_futures_done(fs) / n_tasks), N)
-                    time.sleep(0.2)
-                theta = gausslq.fits_from_futures(fs)
-                em = self.camera_info['gain'] > 1
-                locs = gausslq.locs_from_fits(self.identifications, theta, self.box, em)
-        elif self.method == 'mle':
-            current, thetas, CRLBs, likelihoods, iterations = gaussmle.gaussmle_async(spots, self.eps, self.max_it, method='sigmaxy')
-            while current[0] < N:
-                self.progressMade.emit(current[0], N)
-                time.sleep(0.2)
-            locs = gaussmle.locs_from_fits(self.identifications, thetas, CRLBs, likelihoods, iterations, self.box)
-        elif self.method == 'avg':
-            print('Average intensity')
-            #just get out the average intensity
-            fs = avgroi.fit_spots_parallel(spots, async=True)
-            n_tasks = len(fs)
-            while lib.n_futures_done(fs) < n_tasks:
-                self.progressMade.emit(round(N * lib.n_futures_done(fs) / n_tasks), N)
-                time.sleep(0.2)
-            theta = avgroi.fits_from_futures(fs)
-            em = self.camera_info['gain'] > 1
-            locs = avgroi.locs_from_fits(self.identifications, theta, self.box, em)
+        method = self.method
+        if method == 'lq' and self.use_gpufit:
+            method = 'lq-gpufit'
+        # Spots are cut and fitted in blocks to bound memory
+        locs = []
+        for n_fitted, locs_ in localize.fit_chunks(self.movie, self.camera_info, self.identifications, self.box,
+                                                   method=method, eps=self.eps, max_it=self.max_it,
+                                                   mle_method='sigmaxy'):
+            locs.append(locs_)
+            self.progressMade.emit(n_fitted, N)
+        if locs:
+            locs = np.hstack(locs).view(np.recarray)
         else:
-            print('This should never happen...')
+            locs = localize.empty_locs(self.identifications, self.box, self.camera_info, method, 'sigmaxy')
         self.progressMade.emit(N+1, N)
         dt = time.time() - t0
         self.finished.emit(locs, dt, self.fit_z, self.calibrate_z)
@@ -56,6 +56,38 @@ def get_colors(n_channels):
     return colors
 
 
+def render_locs(locs, kwargs, tile_cache=None):
+    ''' Renders locs with the render kwargs, from tile_cache if it is given and no blur is set. '''
+    if tile_cache is not None and kwargs['blur_method'] is None:
+        rendering = tile_cache.render(kwargs['oversampling'], kwargs['viewport'])
+        if rendering is not None:
+            return rendering
+    return render.render(locs, **kwargs)
+
+
+def render_jobs(jobs, kwargs, stacked, cancelled=None):
+    '''
+    Renders scene jobs (tile cache, locs, select), see View.scene_jobs.
+    Returns the number of locs and the image, or the stack of images if stacked.
+    Returns None if cancelled() turns true before an image is rendered.
+    '''
+    renderings = []
+    for tile_cache, locs, select in jobs:
+        if cancelled is not None and cancelled():
+            return None
+        if select is not None:
+            locs = select(locs)
+        renderings.append(render_locs(locs, kwargs, tile_cache))
+    return stack_renderings(renderings, stacked)
+
+
+def stack_renderings(renderings, stacked):
+    n_locs = sum([_[0] for _ in renderings])
+    if stacked:
+        return n_locs, np.array([_[1] for _ in renderings])
+    return n_locs, renderings[0][1]
+
+
 def fit_cum_exp(data):
     data.sort()
     n = len(data)
@@ -1669,6 +1701,52 @@ class SlicerDialog(QtGui.QDialog):
                     progress.set_value(i)
                 progress.close()
 
+class RenderWorker(QtCore.QThread):
+    '''
+    Renders the images of a scene. If a blur is set and the tile caches of all images serve
+    the view, their histogram is emitted first as a preview.
+    Cancellation is checked between images, so an image that is being rendered is finished first.
+    '''
+
+    rendered = QtCore.pyqtSignal(int, object, object, bool)
+
+    def __init__(self, request, jobs, stacked, kwargs, autoscale):
+        super().__init__()
+        self.request = request
+        self.jobs = jobs
+        self.stacked = stacked
+        self.kwargs = kwargs
+        self.autoscale = autoscale
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def preview(self):
+        ''' Histograms of the jobs from their tile caches, or None if any image is not served by one '''
+        renderings = []
+        for tile_cache, locs, select in self.jobs:
+            if self.cancelled or tile_cache is None:
+                return None
+            rendering = tile_cache.render(self.kwargs['oversampling'], self.kwargs['viewport'])
+            if rendering is None:
+                return None
+            renderings.append(rendering)
+        return stack_renderings(renderings, self.stacked)
+
+    def run(self):
+        if self.kwargs['blur_method'] is not None:
+            rendering = self.preview()
+            if rendering is not None:
+                self.rendered.emit(self.request, rendering[0], rendering[1], self.autoscale)
+        rendering = render_jobs(self.jobs, self.kwargs, self.stacked, self.is_cancelled)
+        if rendering is not None:
+            self.rendered.emit(self.request, rendering[0], rendering[1], self.autoscale)
+
+
 class View(QtGui.QLabel):
 
     def __init__(self, window):
@@ -1693,10 +1771,14 @@ class View(QtGui.QLabel):
         self._picks = []
         self._points = []
         self.index_blocks = []
+        self.tile_caches = []
         self._drift = []
         self.currentdrift = []
         self.x_render_cache = []
         self.x_render_state = False
+        self._render_request = 0
+        self._render_worker = None
+        self._pending_render = None
 
     def is_consecutive(l):
         setl = set(l)
@@ -1712,6 +1794,7 @@ class View(QtGui.QLabel):
         self.infos.append(info)
         self.locs_paths.append(path)
         self.index_blocks.append(None)
+        self.tile_caches.append(None)
         self._drift.append(None)
         self.currentdrift.append(None)
         if len(self.locs) == 1:
@@ -1817,12 +1900,14 @@ class View(QtGui.QLabel):
             print('Shift {}'.format(shift))
             sp = lib.ProgressDialog('Shifting channels', 0, len(self.locs), self)
             sp.set_value(0)
+            self.cancel_rendering()
             for i, locs_ in enumerate(self.locs):
                 locs_.y -= shift[0][i]
                 locs_.x -= shift[1][i]
                 if len(shift) == 3:
                     locs_.z -= shift[2][i]
                 sp.set_value(i+1)
+            self.tile_caches = [None for _ in self.tile_caches]
             self.update_scene()
         else:
             max_iterations = 4
@@ -1846,6 +1931,7 @@ class View(QtGui.QLabel):
                 temp_shift_x = []
                 temp_shift_y = []
                 temp_shift_z = []
+                self.cancel_rendering()
                 for i, locs_ in enumerate(self.locs):
                     if np.absolute(shift[0][i]) + np.absolute(shift[1][i]) > convergence:
                         completed = False
@@ -1864,6 +1950,7 @@ class View(QtGui.QLabel):
                 if len(shift) == 3:
                     shift_z.append(np.mean(temp_shift_z))
                 iteration+=1 
+                self.tile_caches = [None for _ in self.tile_caches]
                 self.update_scene()
 
                 #Skip when converged:
@@ -2074,15 +2161,21 @@ class View(QtGui.QLabel):
             painter.drawRect(x+x_vp, y+y_vp, length + 0, height + 0)
         return image
 
-    def draw_scene(self, viewport, autoscale=False, use_cache=False, picks_only=False, points_only=False):
+    def draw_scene(self, viewport, autoscale=False, use_cache=False, picks_only=False, points_only=False, background=True):
         if not picks_only:
             self.viewport = self.adjust_viewport_to_view(viewport)
+            if background and not (use_cache and hasattr(self, 'image')):
+                # Drawn again by on_rendered once the images are rendered
+                self.render_in_background(autoscale=autoscale)
+                return
             qimage = self.render_scene(autoscale=autoscale, use_cache=use_cache)
             qimage = qimage.scaled(self.width(), self.height(), QtCore.Qt.KeepAspectRatioByExpanding)
             self.qimage_no_picks = self.draw_scalebar(qimage)
             self.qimage_no_picks = self.draw_minimap(self.qimage_no_picks)
             dppvp = self.display_pixels_per_viewport_pixels()
             self.window.display_settings_dialog.set_zoom_silently(dppvp)
+        elif not hasattr(self, 'qimage_no_picks'):
+            return
         self.qimage = self.draw_picks(self.qimage_no_picks)
         self.qimage = self.draw_points(self.qimage)
         self.pixmap = QtGui.QPixmap.fromImage(self.qimage)
@@ -2094,7 +2187,7 @@ class View(QtGui.QLabel):
         pixmap = self.window.slicer_dialog.slicer_cache.get(slicerposition)
 
         if pixmap is None:
-            self.draw_scene(viewport, autoscale=autoscale, use_cache=use_cache, picks_only=picks_only,points_only=points_only)
+            self.draw_scene(viewport, autoscale=autoscale, use_cache=use_cache, picks_only=picks_only,points_only=points_only, background=False)
             self.window.slicer_dialog.slicer_cache[slicerposition] = self.pixmap
         else:
             self.setPixmap(pixmap)
@@ -3002,20 +3095,8 @@ class View(QtGui.QLabel):
 
             if self._picks:
                 removelist = []
-                loccount = []
-                progress = lib.ProgressDialog('Counting in picks..', 0, len(self._picks)-1, self)
-                progress.set_value(0)
-                progress.show()
-                for i, pick in enumerate(self._picks):
-                    x, y = pick
-                    block_locs = postprocess.get_block_locs_at(x, y, index_blocks)
-                    pick_locs = lib.locs_at(x, y, block_locs, r)
-                    locs = stack_arrays(pick_locs, asrecarray=True, usemask=False)
-                    print(len(locs))
-                    loccount.append(len(locs))
-                    progress.set_value(i)
-
-                progress.close()
+                x, y = np.array(self._picks).T
+                loccount = list(index_blocks.count_in_radius(x, y, r))
                 fig = plt.figure()
                 fig.canvas.set_window_title('Localizations in Picks')
                 ax = fig.add_subplot(111)
@@ -3052,12 +3133,12 @@ class View(QtGui.QLabel):
                             elif loccount[i] < minlocs:
                                 removelist.append(pick)
                             progress.set_value(i)
+                        progress.close()
 
                 for pick in removelist:
                     self._picks.remove(pick)
                 self.n_picks = len(self._picks)
                 self.update_pick_info_short()
-                progress.close()
                 self.update_scene()
 
     def rmsd_at_com(self, locs):
@@ -3071,18 +3152,21 @@ class View(QtGui.QLabel):
         info = self.infos[channel]
         d = self.window.tools_settings_dialog.pick_diameter.value()
         size = d / 2
-        K, L = postprocess.index_blocks_shape(info, size)
-        progress = lib.ProgressDialog('Indexing localizations', 0, K, self)
-        progress.show()
-        progress.set_value(0)
-        index_blocks = postprocess.get_index_blocks(locs, info, size, progress.set_value)
-        self.index_blocks[channel] = index_blocks
+        self.index_blocks[channel] = postprocess.SpatialIndex(locs, info, size)
 
     def get_index_blocks(self, channel):
         if self.index_blocks[channel] is None:
             self.index_locs(channel)
         return self.index_blocks[channel]
 
+    def get_tile_cache(self, channel):
+        ''' The histogram tile pyramid of the channel, rebuilt if its locs were replaced. '''
+        tile_cache = self.tile_caches[channel]
+        if tile_cache is None or tile_cache.locs is not self.locs[channel]:
+            tile_cache = render.TileCache(self.locs[channel])
+            self.tile_caches[channel] = tile_cache
+        return tile_cache
+
     def pick_similar(self):
         channel = self.get_channel('Pick similar')
         if channel is not None:
@@ -3096,8 +3180,7 @@ class View(QtGui.QLabel):
             rmsd = []
             for i, pick in enumerate(self._picks):
                 x, y = pick
-                block_locs = postprocess.get_block_locs_at(x, y, index_blocks)
-                pick_locs = lib.locs_at(x, y, block_locs, r)
+                pick_locs = index_blocks.locs_in_radius(x, y, r)
                 n_locs.append(len(pick_locs))
                 rmsd.append(self.rmsd_at_com(pick_locs))
             mean_n_locs = np.mean(n_locs)
@@ -3117,7 +3200,6 @@ class View(QtGui.QLabel):
             y_range_shift = y_range_base + d / 2
             d2 = d**2
             nx = len(x_range)
-            locs, size, x_index, y_index, block_starts, block_ends, K, L = index_blocks
             progress = lib.ProgressDialog('Pick similar', 0, nx, self)
             progress.set_value(0)
             for i, x_grid in enumerate(x_range):
@@ -3127,9 +3209,9 @@ class View(QtGui.QLabel):
                 else:
                     y_range = y_range_base
                 for y_grid in y_range:
-                    n_block_locs = postprocess.n_block_locs_at(x_grid, y_grid, size, K, L, block_starts, block_ends)
+                    n_block_locs = index_blocks.n_block_locs_at(x_grid, y_grid)[0]
                     if n_block_locs > min_n_locs:
-                        block_locs = postprocess.get_block_locs_at(x_grid, y_grid, index_blocks)
+                        block_locs = index_blocks.block_locs_at(x_grid, y_grid)
                         picked_locs = lib.locs_at(x_grid, y_grid, block_locs, r)
                         if len(picked_locs) > 1:
                             # Move to COM peak
@@ -3159,19 +3241,8 @@ class View(QtGui.QLabel):
             d = self.window.tools_settings_dialog.pick_diameter.value()
             r = d / 2
             index_blocks = self.get_index_blocks(channel)
-            picked_locs = []
-            progress = lib.ProgressDialog('Creating localization list', 0, len(self._picks), self)
-            progress.set_value(0)
-            for i, pick in enumerate(self._picks):
-                x, y = pick
-                block_locs = postprocess.get_block_locs_at(x, y, index_blocks)
-                group_locs = lib.locs_at(x, y, block_locs, r)
-                if add_group:
-                    group = i * np.ones(len(group_locs), dtype=np.int32)
-                    group_locs = lib.append_to_rec(group_locs, group, 'group')
-                picked_locs.append(group_locs)
-                progress.set_value(i + 1)
-            return picked_locs
+            x, y = np.array(self._picks).T
+            return postprocess.picked_locs(None, None, x, y, r, index=index_blocks, add_group=add_group, split=True)
 
     def remove_picks(self, position):
         x, y = position
@@ -3188,13 +3259,79 @@ class View(QtGui.QLabel):
         self._points = []
         self.update_scene()
 
+    def scene_jobs(self):
+        '''
+        The images of the scene as rendered by render_scene, as a list of (tile cache, locs, select)
+        and whether the images are stacked. select is None or picks the displayed locs from locs.
+        '''
+        slicer_dialog = self.window.slicer_dialog
+        if slicer_dialog.slicerRadioButton.isChecked():
+            z_min = slicer_dialog.slicermin
+            z_max = slicer_dialog.slicermax
+            select_z = lambda locs: locs[(locs.z > z_min) & (locs.z <= z_max)]
+        else:
+            select_z = None
+        if len(self.locs) == 1:
+            if self.x_render_state:
+                return [(None, _, None) for _ in self.x_locs], True
+            if hasattr(self.locs[0], 'group'):
+                group_color = self.group_color
+                return [(None, self.locs[0], lambda locs, i=i: locs[group_color == i]) for i in range(N_GROUP_COLORS)], True
+        jobs = []
+        for channel, locs in enumerate(self.locs):
+            if select_z is not None and hasattr(locs, 'z'):
+                jobs.append((None, locs, select_z))
+            else:
+                jobs.append((self.get_tile_cache(channel), locs, None))
+        return jobs, len(self.locs) > 1
+
+    def render_jobs(self, kwargs):
+        ''' Renders the scene in this thread. Returns the number of locs and the image, or stack of images. '''
+        jobs, stacked = self.scene_jobs()
+        return render_jobs(jobs, kwargs, stacked)
+
+    def render_in_background(self, autoscale=False):
+        ''' Renders the scene in a worker thread, cancelling the rendering of any earlier scene. '''
+        kwargs = self.get_render_kwargs()
+        jobs, stacked = self.scene_jobs()
+        self._render_request += 1
+        self._pending_render = (self._render_request, jobs, stacked, kwargs, autoscale)
+        if self._render_worker is not None and self._render_worker.isRunning():
+            self._render_worker.cancel()
+        else:
+            self.start_pending_render()
+
+    def start_pending_render(self):
+        if self._pending_render is None:
+            return
+        if self._render_worker is not None and self._render_worker.isRunning():
+            return
+        self._render_worker = RenderWorker(*self._pending_render)
+        self._pending_render = None
+        self._render_worker.rendered.connect(self.on_rendered)
+        self._render_worker.finished.connect(self.start_pending_render)
+        self._render_worker.start()
+
+    def on_rendered(self, request, n_locs, image, autoscale):
+        if request == self._render_request:
+            self.n_locs = n_locs
+            self.image = image
+            self.draw_scene(self.viewport, autoscale=autoscale, use_cache=True)
+
+    def cancel_rendering(self):
+        ''' Stops the background rendering and waits for it, e.g. before locs are changed in place. '''
+        self._pending_render = None
+        if self._render_worker is not None:
+            self._render_worker.cancel()
+            self._render_worker.wait()
+
     def render_scene(self, autoscale=False, use_cache=False, cache=True, viewport=None):
         kwargs = self.get_render_kwargs(viewport=viewport)
         n_channels = len(self.locs)
         if n_channels == 1:
             self.render_single_channel(kwargs, autoscale=autoscale, use_cache=use_cache, cache=cache)
         else:
-            self.render_multi_channel(kwargs, autoscale=autoscale, use_cache=use_cache, cache=cache,  plot_channels = True)
+            self.render_multi_channel(kwargs, autoscale=autoscale, use_cache=use_cache, cache=cache)
         self._bgra[:, :, 3].fill(255)
         Y, X = self._bgra.shape[:2]
         qimage = QtGui.QImage(self._bgra.data, X, Y, QtGui.QImage.Format_RGB32)
@@ -3210,52 +3347,14 @@ class View(QtGui.QLabel):
         self._bgra[:, :, 3].fill(255)
         return self._bgra.data
 
-    def render_multi_channel(self, kwargs, autoscale=False, locs=None, use_cache=False, cache=True, plot_channels = False):
-        if locs is None:
-            locs = self.locs
-        #Plot each channel
-        if plot_channels:
-            locsall = locs.copy()
-            for i in range(len(locs)):
-                if hasattr(locs[i], 'z'):
-                    if self.window.slicer_dialog.slicerRadioButton.isChecked():
-                        z_min = self.window.slicer_dialog.slicermin
-                        z_max = self.window.slicer_dialog.slicermax
-                        in_view = (locsall[i].z > z_min) & (locsall[i].z <= z_max)
-                        locsall[i] = locsall[i][in_view]
-            n_channels = len(locs)
-            colors = get_colors(n_channels)
-            if use_cache:
-                n_locs = self.n_locs
-                image = self.image
-            else:
-                renderings = []
-                for i in range(len(self.locs)):
-                    #We render all images first, and later decide to keep them or not
-                    renderings.append(render.render(locsall[i], **kwargs))
-                renderings = [render.render(_, **kwargs) for _ in locsall]
-                n_locs = sum([_[0] for _ in renderings])
-                image = np.array([_[1] for _ in renderings])
+    def render_multi_channel(self, kwargs, autoscale=False, use_cache=False, cache=True):
+        if use_cache:
+            n_locs = self.n_locs
+            image = self.image
         else:
-            n_channels = len(locs)
-            colors = get_colors(n_channels)
-            if use_cache:
-                n_locs = self.n_locs
-                image = self.image
-            else:
-
-                pb = lib.ProgressDialog('Rendering.. ', 0, n_channels, self)
-                pb.set_value(0)
-                renderings = []
-                for i in tqdm(range(n_channels)):
-                    renderings.append(render.render(locs[i], **kwargs))
-                    pb.set_value(i+1)
-                pb.close()
-
-                #renderings = [render.render(_, **kwargs) for _ in locs]
-                n_locs = sum([_[0] for _ in renderings])
-                image = np.array([_[1] for _ in renderings])
-
+            n_locs, image = self.render_jobs(kwargs)
+        n_channels = len(image)
+        colors = get_colors(n_channels)
         if cache:
             self.n_locs = n_locs
             self.image = image
@@ -3308,28 +3407,13 @@ class View(QtGui.QLabel):
         return self._bgra
 
     def render_single_channel(self, kwargs, autoscale=False, use_cache=False, cache=True):
-        locs = self.locs[0]
-
-        if self.x_render_state:
-            locs = self.x_locs
-            return self.render_multi_channel(kwargs, autoscale=autoscale, locs=locs, use_cache=use_cache)
-
-        if hasattr(locs, 'group'):
-            locs = [locs[self.group_color == _] for _ in range(N_GROUP_COLORS)]
-            return self.render_multi_channel(kwargs, autoscale=autoscale, locs=locs, use_cache=use_cache)
-
-        if hasattr(locs, 'z'):
-            if self.window.slicer_dialog.slicerRadioButton.isChecked():
-                z_min = self.window.slicer_dialog.slicermin
-                z_max = self.window.slicer_dialog.slicermax
-                in_view = (locs.z > z_min) & (locs.z <= z_max)
-                locs = locs[in_view]
-     
+        if self.x_render_state or hasattr(self.locs[0], 'group'):
+            return self.render_multi_channel(kwargs, autoscale=autoscale, use_cache=use_cache)
         if use_cache:
             n_locs = self.n_locs
             image = self.image
         else:
-            n_locs, image = render.render(locs, **kwargs)
+            n_locs, image = self.render_jobs(kwargs)
         if cache:
             self.n_locs = n_locs
             self.image = image
@@ -3664,9 +3748,11 @@ class View(QtGui.QLabel):
                 seg_progress = lib.ProgressDialog('Generating segments', 0, n_segments, self)
                 n_pairs = int(n_segments * (n_segments - 1) / 2)
                 rcc_progress = lib.ProgressDialog('Correlating image pairs', 0, n_pairs, self)
+                self.cancel_rendering()
                 drift, _ = postprocess.undrift(locs, info, segmentation, True, seg_progress.set_value, rcc_progress.set_value)
                 self.locs[channel] = lib.ensure_sanity(locs, info)
                 self.index_blocks[channel] = None
+                self.tile_caches[channel] = None
                 self.add_drift(channel, drift)
                 self.update_scene()
 
@@ -3722,6 +3808,7 @@ class View(QtGui.QLabel):
         drift_y = self._undrift_from_picked_coordinate(channel, picked_locs, 'y')
 
         # Apply drift
+        self.cancel_rendering()
         self.locs[channel].x -= drift_x[self.locs[channel].frame]
         self.locs[channel].y -= drift_y[self.locs[channel].frame]
 
@@ -3737,6 +3824,7 @@ class View(QtGui.QLabel):
 
         # Cleanup
         self.index_blocks[channel] = None
+        self.tile_caches[channel] = None
         self.add_drift(channel, drift)
         status.close()
         self.update_scene()
@@ -3749,6 +3837,7 @@ class View(QtGui.QLabel):
         drift_y = self._undrift_from_picked_coordinate(channel, picked_locs, 'y')
 
         # Apply drift
+        self.cancel_rendering()
         self.locs[channel].x -= drift_x[self.locs[channel].frame]
         self.locs[channel].y -= drift_y[self.locs[channel].frame]
 
@@ -3758,6 +3847,7 @@ class View(QtGui.QLabel):
 
         # Cleanup
         self.index_blocks[channel] = None
+        self.tile_caches[channel] = None
         self.add_drift(channel, drift)
         status.close()
         self.update_scene()
@@ -3772,8 +3862,10 @@ class View(QtGui.QLabel):
         drift.x = -drift.x
         drift.y = -drift.y
         self.add_drift(channel, drift)
+        self.cancel_rendering()
         self.locs[channel].x -= drift.x[self.locs[channel].frame]
         self.locs[channel].y -= drift.y[self.locs[channel].frame]
+        self.tile_caches[channel] = None
         self.update_scene()
 
     def unfold_groups(self):
@@ -3781,7 +3873,9 @@ class View(QtGui.QLabel):
             self.unfold_status = 'folded'
         if self.unfold_status == 'folded':
             if hasattr(self.locs[0], 'group'):
+                self.cancel_rendering()
                 self.locs[0].x += self.locs[0].group*2
+                self.tile_caches[0] = None
             groups = np.unique(self.locs[0].group)
 
             if self._picks:
@@ -3808,6 +3902,7 @@ class View(QtGui.QLabel):
         n_square, ok = QtGui.QInputDialog.getInteger(self, 'Input Dialog',
         'Set number of elements per row and column:',100)
         if hasattr(self.locs[0], 'group'):
+            self.cancel_rendering()
             self.locs[0].x += np.mod(self.locs[0].group,n_square)*2
             self.locs[0].y += np.floor(self.locs[0].group/n_square)*2
 
@@ -3816,6 +3911,7 @@ class View(QtGui.QLabel):
 
             self.locs[0].x += np.absolute(np.min(self.locs[0].x))
             self.locs[0].y += np.absolute(np.min(self.locs[0].y))
+            self.tile_caches[0] = None
 
         groups = np.unique(self.locs[0].group)
         #Update width information
@@ -3825,7 +3921,9 @@ class View(QtGui.QLabel):
 
     def refold_groups(self):
         if hasattr(self.locs[0], 'group'):
+            self.cancel_rendering()
             self.locs[0].x -= self.locs[0].group*2
+            self.tile_caches[0] = None
         groups = np.unique(self.locs[0].group)
         self.fit_in_view()
         self.infos[0][0]['Width'] = self.oldwidth
@@ -4150,6 +4248,7 @@ class Window(QtGui.QMainWindow):
         if self.view.locs_paths != []:
             settings['Render']['PWD'] = os.path.dirname(self.view.locs_paths[0])
         io.save_user_settings(settings)
+        self.view.cancel_rendering()
         QtGui.qApp.closeAllWindows()
 
     def export_current(self):
@@ -4160,6 +4259,9 @@ class Window(QtGui.QMainWindow):
         out_path = base + '.png'
         path = QtGui.QFileDialog.getSaveFileName(self, 'Save image', out_path, filter="*.png;;*.tif")
         if path:
+            # The displayed image can be a preview or lag behind the viewport while rendering in the background
+            self.view.cancel_rendering()
+            self.view.draw_scene(self.view.viewport, background=False)
             self.view.qimage.save(path)
         self.view.setMinimumSize(1, 1)
 
@@ -4303,6 +4405,8 @@ class Window(QtGui.QMainWindow):
     def open_apply_dialog(self):
         cmd, channel, ok = ApplyDialog.getCmd(self)
         if ok:
+            # The expressions change the locs in place
+            self.view.cancel_rendering()
             input = cmd.split()
             if input[0] == 'flip' and len(input) == 3:
                 #Distinguis flipping in xy and z
@@ -4357,6 +4461,7 @@ class Window(QtGui.QMainWindow):
                 exec(cmd, {k: self.view.locs[channel][k] for k in vars})
             lib.ensure_sanity(self.view.locs[channel], self.view.infos[channel])
             self.view.index_blocks[channel] = None
+            self.view.tile_caches[channel] = None
             self.view.update_scene()
 
     def open_file_dialog(self):
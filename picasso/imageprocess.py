@@ -10,13 +10,19 @@
 import matplotlib.pyplot as _plt
 import numpy as _np
 from numpy import fft as _fft
-import lmfit as _lmfit
+import numba as _numba
 from tqdm import tqdm as _tqdm
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from concurrent.futures import as_completed as _as_completed
+import multiprocessing as _multiprocessing
 from . import lib as _lib
 
 
 _plt.style.use('ggplot')
 
+# Maximum number of correlation pixels that an RCC batch holds at once
+RCC_BATCH_PIXELS = 2**24
+
 
 def xcorr(imageA, imageB):
     FimageA = _fft.fft2(imageA)
@@ -32,47 +38,11 @@ def get_image_shift(imageA, imageB, box, roi=None, display=False):
     XCorr = xcorr(imageA, imageB)
     # Cut out center roi
     Y, X = imageA.shape
-    if roi is not None:
-        Y_ = int((Y - roi) / 2)
-        X_ = int((X - roi) / 2)
-        if Y_ > 0:
-            XCorr = XCorr[Y_:-Y_, :]
-        else:
-            Y_ = 0
-        if X_ > 0:
-            XCorr = XCorr[:, X_:-X_]
-        else:
-            X_ = 0
-    else:
-        Y_ = X_ = 0
-    # A quarter of the fit ROI
-    fit_X = int(box / 2)
-    # A coordinate grid for the fitting ROI
-    y, x = _np.mgrid[-fit_X:fit_X+1, -fit_X:fit_X+1]
-    # Find the brightest pixel and cut out the fit ROI
-    y_max_, x_max_ = _np.unravel_index(XCorr.argmax(), XCorr.shape)
-    FitROI = XCorr[y_max_ - fit_X:y_max_ + fit_X + 1, x_max_ - fit_X:x_max_ + fit_X + 1]
-
-    # The fit model
-    def flat_2d_gaussian(a, xc, yc, s, b):
-        A = a * _np.exp(-0.5 * ((x - xc)**2 + (y - yc)**2) / s**2) + b
-        return A.flatten()
-    gaussian2d = _lmfit.Model(flat_2d_gaussian, name='2D Gaussian', independent_vars=[])
-
-    # Set up initial parameters and fit
-    params = _lmfit.Parameters()
-    params.add('a', value=FitROI.max(), vary=True, min=0)
-    params.add('xc', value=0, vary=True)
-    params.add('yc', value=0, vary=True)
-    params.add('s', value=1, vary=True, min=0)
-    params.add('b', value=FitROI.min(), vary=True, min=0)
-    results = gaussian2d.fit(FitROI.flatten(), params)
-
-    # Get maximum coordinates and add offsets
-    xc = results.best_values['xc']
-    yc = results.best_values['yc']
-    xc += X_ + x_max_
-    yc += Y_ + y_max_
+    Y_, X_ = _roi_offsets(Y, X, roi)
+    XCorr = XCorr[Y_:Y-Y_, X_:X-X_]
+    yc, xc = _xcorr_peak(XCorr, box)
+    xc += X_
+    yc += Y_
 
     if display:
         _plt.figure(figsize=(17, 10))
@@ -90,20 +60,132 @@ def get_image_shift(imageA, imageB, box, roi=None, display=False):
     return -yc, -xc
 
 
-def rcc(segments, max_shift=None, callback=None):
-    n_segments = len(segments)
+def _roi_offsets(Y, X, roi):
+    """ Rows and columns cut from each side of a centered correlation to keep the center roi """
+    if roi is None:
+        return 0, 0
+    return max(int((Y - roi) / 2), 0), max(int((X - roi) / 2), 0)
+
+
+def _xcorr_peak(XCorr, box):
+    """ Sub-pixel position (y, x) of the correlation peak """
+    peaks = _np.zeros((1, 2))
+    _xcorr_peaks(_np.ascontiguousarray(XCorr[_np.newaxis], dtype=_np.float64), box, peaks)
+    return peaks[0, 0], peaks[0, 1]
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _gaussian_peak_offset(left, center, right, background):
+    """
+    Peak offset of a Gaussian through three equally spaced samples above background.
+    If a sample is not above background, falls back to a parabola through the raw samples.
+    """
+    l = left - background
+    c = center - background
+    r = right - background
+    if l > 0 and c > 0 and r > 0:
+        l = _np.log(l)
+        c = _np.log(c)
+        r = _np.log(r)
+    else:
+        l = left
+        c = center
+        r = right
+    curvature = l - 2 * c + r
+    if curvature >= 0:
+        return 0.0
+    return 0.5 * (l - r) / curvature
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _xcorr_peaks(XCorrs, box, peaks):
+    """
+    Sub-pixel peak positions (y, x) of a stack of correlations: a three point Gaussian estimate in y and x
+    around the brightest pixel, above the minimum of the border of the box around it as background.
+    """
+    n, Y, X = XCorrs.shape
+    half = int(box / 2)
+    for k in range(n):
+        XCorr = XCorrs[k]
+        i_max = 0
+        j_max = 0
+        for i in range(Y):
+            for j in range(X):
+                if XCorr[i, j] > XCorr[i_max, j_max]:
+                    i_max = i
+                    j_max = j
+        # The border only, so that the direct neighbours of the peak stay above background
+        background = XCorr[i_max, j_max]
+        for i in range(max(i_max - half, 0), min(i_max + half + 1, Y)):
+            for j in range(max(j_max - half, 0), min(j_max + half + 1, X)):
+                if abs(i - i_max) == half or abs(j - j_max) == half:
+                    background = min(background, XCorr[i, j])
+        center = XCorr[i_max, j_max]
+        peaks[k, 0] = i_max
+        peaks[k, 1] = j_max
+        if 0 < i_max < Y - 1:
+            peaks[k, 0] += _gaussian_peak_offset(XCorr[i_max - 1, j_max], center, XCorr[i_max + 1, j_max],
+                                                 background)
+        if 0 < j_max < X - 1:
+            peaks[k, 1] += _gaussian_peak_offset(XCorr[i_max, j_max - 1], center, XCorr[i_max, j_max + 1],
+                                                 background)
+
+
+def rcc(segments, max_shift=None, callback=None, n_segments=None):
+    """
+    Redundant cross-correlation: the shifts between all pairs of images, minimized to one shift per image.
+    segments is an image stack or any iterable of images, e.g. a stream of rendered segments.
+    Iterables without len need n_segments.
+    The real FFT of each image is computed once into a preallocated stack; the pair correlations are formed
+    from these spectra in parallel batches and only their center max_shift window is searched for the peak.
+    """
+    if n_segments is None:
+        n_segments = len(segments)
+    spectra = None
+    is_empty = _np.zeros(n_segments, dtype=bool)
+    for k, image in enumerate(segments):
+        if spectra is None:
+            shape = _np.shape(image)
+            spectra = _np.empty((n_segments, shape[0], shape[1] // 2 + 1), dtype=_np.complex64)
+        is_empty[k] = _np.sum(image) == 0
+        spectra[k] = _fft.rfft2(image)
     shifts_x = _np.zeros((n_segments, n_segments))
     shifts_y = _np.zeros((n_segments, n_segments))
+    if n_segments < 2:
+        return _lib.minimize_shifts(shifts_x, shifts_y)
+    Y, X = shape
+    Y_, X_ = _roi_offsets(Y, X, max_shift)
+    # Window rows and columns of the (not fft-shifted) correlations
+    rows = (_np.arange(Y_, Y - Y_) - Y // 2) % Y
+    columns = (_np.arange(X_, X - X_) - X // 2) % X
+    pairs = [(i, j) for i in range(n_segments - 1) for j in range(i + 1, n_segments)
+             if not (is_empty[i] or is_empty[j])]
     n_pairs = int(n_segments * (n_segments - 1) / 2)
-    flag = 0
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    batch_size = max(1, min(int(_np.ceil(len(pairs) / (4 * n_workers))), RCC_BATCH_PIXELS // (Y * X)))
+    batches = [pairs[_:_ + batch_size] for _ in range(0, len(pairs), batch_size)]
+
+    def correlate(batch):
+        i, j = _np.array(batch).T
+        XCorr = _fft.irfft2(spectra[i] * _np.conj(spectra[j]), s=shape) / _np.sqrt(Y * X)
+        XCorr = _np.ascontiguousarray(XCorr[:, rows][:, :, columns])
+        peaks = _np.zeros((len(batch), 2))
+        _xcorr_peaks(XCorr, 5, peaks)
+        return peaks
+
     with _tqdm(total=n_pairs, desc='Correlating image pairs', unit='pairs') as progress_bar:
         if callback is not None:
             callback(0)
-        for i in range(n_segments-1):
-            for j in range(i+1, n_segments):
-                progress_bar.update()
-                shifts_y[i, j], shifts_x[i, j] = get_image_shift(segments[i], segments[j], 5, max_shift)
-                flag += 1
+        progress_bar.update(n_pairs - len(pairs))
+        flag = n_pairs - len(pairs)
+        with _ThreadPoolExecutor(n_workers) as executor:
+            futures = {executor.submit(correlate, _): _ for _ in batches}
+            for future in _as_completed(futures):
+                for (i, j), (yc, xc) in zip(futures[future], future.result()):
+                    shifts_y[i, j] = -(yc + Y_ - _np.floor(Y / 2))
+                    shifts_x[i, j] = -(xc + X_ - _np.floor(X / 2))
+                progress_bar.update(len(futures[future]))
+                flag += len(futures[future])
                 if callback is not None:
                     callback(flag)
     return _lib.minimize_shifts(shifts_x, shifts_y)
@@ -101,6 +101,28 @@ def calculate_optimal_bins(data, max_n_bins=None):
     return _np.linspace(bin_min, data.max(), n_bins)
 
 
+def frame_moments(frame, values, n_frames):
+    '''
+    Per-frame count, mean and (population) variance of values in one pass over the data.
+    Frames without values have mean and variance nan.
+    '''
+    frame = _np.asarray(frame, dtype=_np.intp)
+    values = _np.asarray(values, dtype=_np.float64)
+    count = _np.bincount(frame, minlength=n_frames)[:n_frames]
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        mean = _np.bincount(frame, values, minlength=n_frames)[:n_frames] / count
+        var = _np.bincount(frame, (values - mean[frame])**2, minlength=n_frames)[:n_frames] / count
+    return count, mean, var
+
+
+def get_from_metadata(info, key, default=None):
+    ''' The most recent value of key in the metadata list, or default if no entry has it '''
+    for inf in reversed(info):
+        if key in inf:
+            return inf[key]
+    return default
+
+
 def append_to_rec(rec_array, data, name):
     if hasattr(rec_array, name):
         rec_array = remove_from_rec(rec_array, name)
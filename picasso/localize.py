@@ -13,6 +13,7 @@ import multiprocessing as _multiprocessing
 import ctypes as _ctypes
 from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 import threading as _threading
+import queue as _queue
 from itertools import chain as _chain
 import matplotlib.pyplot as _plt
 from . import gaussmle as _gaussmle
@@ -24,6 +25,10 @@ LOCS_DTYPE = [('frame', 'u4'), ('x', 'f4'), ('y', 'f4'),
               ('photons', 'f4'), ('sx', 'f4'), ('sy', 'f4'),
               ('bg', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'),
               ('net_gradient', 'f4'), ('likelihood', 'f4'), ('iterations', 'i4')]
+# Default memory ceiling (bytes) for the spots in flight of a streaming localization
+MAX_MEMORY = 2e9
+# Fit results, identifications and locs per spot (bytes, generous)
+_FIT_BYTES_PER_SPOT = 256
 
 
 _plt.style.use('ggplot')
@@ -48,6 +53,67 @@ def local_maxima(frame, box):
     return y, x
 
 
+@_numba.jit(nopython=True, nogil=True, cache=False)
+def _running_max_x(frame, box_half, out):
+    ''' Maximum over the horizontal window [j - box_half, j + box_half] of each pixel '''
+    Y, X = frame.shape
+    for i in range(Y):
+        for j in range(box_half, X - box_half):
+            max_ = frame[i, j - box_half]
+            for l in range(j - box_half + 1, j + box_half + 1):
+                if frame[i, l] > max_:
+                    max_ = frame[i, l]
+            out[i, j] = max_
+
+
+@_numba.jit(nopython=True, nogil=True, cache=False)
+def local_maxima_filter(frame, box):
+    '''
+    Finds the same maxima as local_maxima, but with a separable maximum filter:
+    A horizontal running maximum is computed once per frame and reduced vertically.
+    Pixels equal to the filtered frame are candidates. Like np.argmax in local_maxima,
+    ties are resolved in favor of the first pixel of the box in row-major order.
+    '''
+    Y, X = frame.shape
+    box_half = int(box / 2)
+    box_half_1 = box_half + 1
+    row_max = _np.zeros(frame.shape, frame.dtype)
+    _running_max_x(frame, box_half, row_max)
+    maxima_map = _np.zeros(frame.shape, _np.uint8)
+    for i in range(box_half, Y - box_half_1):
+        for j in range(box_half, X - box_half_1):
+            value = frame[i, j]
+            # Rows above (must be strictly smaller) and below
+            is_max = True
+            for k in range(i - box_half, i):
+                if row_max[k, j] >= value:
+                    is_max = False
+                    break
+            if not is_max:
+                continue
+            for k in range(i + 1, i + box_half_1):
+                if row_max[k, j] > value:
+                    is_max = False
+                    break
+            if not is_max:
+                continue
+            # Center row: left of the center must be strictly smaller
+            for l in range(j - box_half, j):
+                if frame[i, l] >= value:
+                    is_max = False
+                    break
+            if not is_max:
+                continue
+            for l in range(j + 1, j + box_half_1):
+                if frame[i, l] > value:
+                    is_max = False
+                    break
+            if is_max:
+                maxima_map[i, j] = 1
+    y, x = _np.where(maxima_map)
+    return y, x
+
+
 @_numba.jit(nopython=True, nogil=True, cache=False)
 def gradient_at(frame, y, x, i):
     gy = frame[y+1, x] - frame[y-1, x]
@@ -69,8 +135,7 @@ def net_gradient(frame, y, x, box, uy, ux):
 
 
 @_numba.jit(nopython=True, nogil=True, cache=False)
-def identify_in_image(image, minimum_ng, box):
-    y, x = local_maxima(image, box)
+def _unit_vectors(box):
     box_half = int(box / 2)
     # Now comes basically a meshgrid
     ux = _np.zeros((box, box), dtype=_np.float32)
@@ -81,6 +146,17 @@ def identify_in_image(image, minimum_ng, box):
     unorm = _np.sqrt(ux**2 + uy**2)
     ux /= unorm
     uy /= unorm
+    return uy, ux
+
+
+def identify_in_image(image, minimum_ng, box, maxima_method='filter'):
+    if maxima_method == 'filter':
+        y, x = local_maxima_filter(image, box)
+    elif maxima_method == 'scan':
+        y, x = local_maxima(image, box)
+    else:
+        raise ValueError('Maxima method not available.')
+    uy, ux = _unit_vectors(box)
     ng = net_gradient(image, y, x, box, uy, ux)
     positives = ng > minimum_ng
     y = y[positives]
@@ -89,25 +165,25 @@ def identify_in_image(image, minimum_ng, box):
     return y, x, ng
 
 
-def identify_in_frame(frame, minimum_ng, box, roi=None):
+def identify_in_frame(frame, minimum_ng, box, roi=None, maxima_method='filter'):
     if roi is not None:
         frame = frame[roi[0][0]:roi[1][0], roi[0][1]:roi[1][1]]
     image = _np.float32(frame)      # otherwise numba goes crazy
-    y, x, net_gradient = identify_in_image(image, minimum_ng, box)
+    y, x, net_gradient = identify_in_image(image, minimum_ng, box, maxima_method)
     if roi is not None:
         y += roi[0][0]
         x += roi[0][1]
     return y, x, net_gradient
 
 
-def identify_by_frame_number(movie, minimum_ng, box, frame_number, roi=None):
+def identify_by_frame_number(movie, minimum_ng, box, frame_number, roi=None, maxima_method='filter'):
     frame = movie[frame_number]
-    y, x, net_gradient = identify_in_frame(frame, minimum_ng, box, roi)
+    y, x, net_gradient = identify_in_frame(frame, minimum_ng, box, roi, maxima_method)
     frame = frame_number * _np.ones(len(x))
     return _np.rec.array((frame, x, y, net_gradient), dtype=[('frame', 'i'), ('x', 'i'), ('y', 'i'), ('net_gradient', 'f4')])
 
 
-def _identify_worker(movie, current, minimum_ng, box, roi, lock):
+def _identify_worker(movie, current, minimum_ng, box, roi, lock, maxima_method='filter'):
     n_frames = len(movie)
     identifications = []
     while True:
@@ -116,7 +192,7 @@ def _identify_worker(movie, current, minimum_ng, box, roi, lock):
             if index == n_frames:
                 return identifications
             current[0] += 1
-        identifications.append(identify_by_frame_number(movie, minimum_ng, box, index, roi))
+        identifications.append(identify_by_frame_number(movie, minimum_ng, box, index, roi, maxima_method))
     return identifications
 
 
@@ -128,7 +204,7 @@ def identifications_from_futures(futures):
     return ids
 
 
-def identify_async(movie, minimum_ng, box, roi=None):
+def _n_identify_workers():
     "Use the user settings to define the number of workers that are being used"
     settings = _io.load_user_settings()
     try:
@@ -139,74 +215,92 @@ def identify_async(movie, minimum_ng, box, roi=None):
         cpu_utilization = 0.8
         settings['Localize']['cpu_utilization'] = cpu_utilization
         _io.save_user_settings(settings)
+    return max(1, int(cpu_utilization * _multiprocessing.cpu_count()))
 
-    n_workers = max(1, int(cpu_utilization * _multiprocessing.cpu_count()))
 
+def identify_async(movie, minimum_ng, box, roi=None, maxima_method='filter'):
+    n_workers = _n_identify_workers()
     current = [0]
     executor = _ThreadPoolExecutor(n_workers)
     lock = _threading.Lock()
-    f = [executor.submit(_identify_worker, movie, current, minimum_ng, box, roi, lock) for _ in range(n_workers)]
+    f = [executor.submit(_identify_worker, movie, current, minimum_ng, box, roi, lock, maxima_method)
+         for _ in range(n_workers)]
     executor.shutdown(wait=False)
     return current, f
 
 
-def identify(movie, minimum_ng, box, threaded=True):
+def identify(movie, minimum_ng, box, threaded=True, maxima_method='filter'):
     if threaded:
-        current, futures = identify_async(movie, minimum_ng, box)
+        current, futures = identify_async(movie, minimum_ng, box, maxima_method=maxima_method)
         identifications = [_.result() for _ in futures]
         identifications = [_np.hstack(_) for _ in identifications]
     else:
-        identifications = [identify_by_frame_number(movie, minimum_ng, box, i) for i in range(len(movie))]
+        identifications = [identify_by_frame_number(movie, minimum_ng, box, i, maxima_method=maxima_method)
+                           for i in range(len(movie))]
     return _np.hstack(identifications).view(_np.recarray)
 
 
-@_numba.jit(nopython=True, cache=False)
-def _cut_spots_numba(movie, ids_frame, ids_x, ids_y, box):
-    n_spots = len(ids_x)
+@_numba.jit(nopython=True, nogil=True, cache=False)
+def _cut_photons_frame(frame, ids_x, ids_y, box, baseline, sensitivity, gain_qe, start, end, spots):
+    ''' Cuts the spots start:end from one frame and converts the camera counts to photons '''
     r = int(box/2)
-    spots = _np.zeros((n_spots, box, box), dtype=movie.dtype)
-    for id, (frame, xc, yc) in enumerate(zip(ids_frame, ids_x, ids_y)):
-        spots[id] = movie[frame, yc-r:yc+r+1, xc-r:xc+r+1]
-    return spots
-
-
-@_numba.jit(nopython=True, cache=False)
-def _cut_spots_frame(frame, frame_number, ids_frame, ids_x, ids_y, r, start, N, spots):
-    for j in range(start, N):
-        if ids_frame[j] > frame_number:
-            break
-        yc = ids_y[j]
-        xc = ids_x[j]
-        spots[j] = frame[yc-r:yc+r+1, xc-r:xc+r+1]
-    return j
-
+    for id in range(start, end):
+        i0 = ids_y[id] - r
+        j0 = ids_x[id] - r
+        for i in range(box):
+            for j in range(box):
+                spots[id, i, j] = (_np.float32(frame[i0 + i, j0 + j]) - baseline) * sensitivity / gain_qe
 
-def _cut_spots(movie, ids, box):
-    if isinstance(movie, _np.ndarray):
-        return _cut_spots_numba(movie, ids.frame, ids.x, ids.y, box)
-    else:
-        ''' Assumes that identifications are in order of frames! '''
-        r = int(box/2)
-        N = len(ids.frame)
-        spots = _np.zeros((N, box, box), dtype=movie.dtype)
-        start = 0
-        for frame_number, frame in enumerate(movie):
-            start = _cut_spots_frame(frame, frame_number, ids.frame, ids.x, ids.y, r, start, N, spots)
-        return spots
 
-
-def _to_photons(spots, camera_info):
-    spots = _np.float32(spots)
-    baseline = camera_info['baseline']
-    sensitivity = camera_info['sensitivity']
-    gain = camera_info['gain']
-    qe = camera_info['qe']
-    return (spots - baseline) * sensitivity / (gain * qe)
+@_numba.jit(nopython=True, nogil=True, cache=False)
+def _cut_photons(movie, ids_frame, ids_x, ids_y, box, baseline, sensitivity, gain_qe, start, end, spots):
+    ''' Like _cut_photons_frame, for spots from any frame of a movie array '''
+    r = int(box/2)
+    for id in range(start, end):
+        frame = ids_frame[id]
+        i0 = ids_y[id] - r
+        j0 = ids_x[id] - r
+        for i in range(box):
+            for j in range(box):
+                spots[id, i, j] = (_np.float32(movie[frame, i0 + i, j0 + j]) - baseline) * sensitivity / gain_qe
 
 
 def get_spots(movie, identifications, box, camera_info):
-    spots = _cut_spots(movie, identifications, box)
-    return _to_photons(spots, camera_info)
+    '''
+    Cuts the spots of the identifications and writes them in photons directly to a float32 array.
+    Array movies (including memmaps) are split into spot chunks, other movies (e.g. TiffMap) are
+    read frame by frame. Both run in parallel threads. Identifications must be in order of frames.
+    '''
+    N = len(identifications)
+    spots = _np.empty((N, box, box), dtype=_np.float32)
+    if N == 0:
+        return spots
+    ids_frame = identifications.frame
+    ids_x = identifications.x
+    ids_y = identifications.y
+    # The same float32 arithmetic as (float32(spots) - baseline) * sensitivity / (gain * qe)
+    baseline = _np.float32(camera_info['baseline'])
+    sensitivity = _np.float32(camera_info['sensitivity'])
+    gain_qe = _np.float32(camera_info['gain'] * camera_info['qe'])
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    with _ThreadPoolExecutor(n_workers) as executor:
+        if isinstance(movie, _np.ndarray):
+            bounds = _np.linspace(0, N, n_workers + 1, dtype=_np.int64)
+            fs = [executor.submit(_cut_photons, movie, ids_frame, ids_x, ids_y, box, baseline, sensitivity, gain_qe,
+                                  start, end, spots)
+                  for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        else:
+            frame_numbers = _np.unique(ids_frame)
+            starts = _np.searchsorted(ids_frame, frame_numbers, side='left')
+            ends = _np.searchsorted(ids_frame, frame_numbers, side='right')
+
+            def cut_frame(frame_number, start, end):
+                _cut_photons_frame(movie[frame_number], ids_x, ids_y, box, baseline, sensitivity, gain_qe,
+                                   start, end, spots)
+            fs = [executor.submit(cut_frame, *_) for _ in zip(frame_numbers, starts, ends)]
+    for f in fs:
+        f.result()
+    return spots
 
 
 def fit(movie, camera_info, identifications, box, eps=0.001, max_it=100, method='sigma'):
@@ -236,6 +330,164 @@ def locs_from_fits(identifications, theta, CRLBs, likelihoods, iterations, box):
     return locs
 
 
+def _spots_per_block(box, max_memory):
+    '''
+    Number of spots per block such that the blocks in flight stay below max_memory (bytes).
+    Up to three blocks are alive at once: one being fitted, one queued and one being cut.
+    '''
+    bytes_per_spot = 4 * box * box + _FIT_BYTES_PER_SPOT
+    return max(1, int(max_memory / (3 * bytes_per_spot)))
+
+
+def _block_end(frame, start, block_size):
+    '''
+    End index of a block of at most block_size spots from start on which does not split a frame,
+    so that the locs sorted per block are in the same order as if sorted at once.
+    A single frame with more spots than block_size becomes its own block.
+    '''
+    N = len(frame)
+    if start + block_size >= N:
+        return N
+    end = start + _np.searchsorted(frame[start:], frame[start + block_size], side='left')
+    if end == start:
+        end = start + _np.searchsorted(frame[start:], frame[start], side='right')
+    return end
+
+
+def _fit_block(spots, identifications, box, camera_info, method, eps, max_it, mle_method):
+    ''' Fits one block of spots with the chosen backend and returns its locs '''
+    em = camera_info['gain'] > 1
+    if method == 'mle':
+        thetas, CRLBs, likelihoods, iterations = _gaussmle.gaussmle_parallel(spots, eps, max_it, method=mle_method)
+        if mle_method == 'sigma':
+            return locs_from_fits(identifications, thetas, CRLBs, likelihoods, iterations, box)
+        return _gaussmle.locs_from_fits(identifications, thetas, CRLBs, likelihoods, iterations, box)
+    elif method == 'lq':
+        from . import gausslq
+        theta = gausslq.fit_spots_lm(spots, eps, max_it)
+        return gausslq.locs_from_fits(identifications, theta, box, em)
+    elif method == 'lq-gpufit':
+        # Gpufit if installed, otherwise its CPU replacement
+        from . import gausslq
+        theta = gausslq.fit_spots_gpufit(spots)
+        return gausslq.locs_from_fits_gpufit(identifications, theta, box, em)
+    elif method == 'avg':
+        from . import avgroi
+        fs = avgroi.fit_spots_parallel(spots, True)
+        theta = avgroi.fits_from_futures(fs)
+        return avgroi.locs_from_fits(identifications, theta, box, em)
+    else:
+        raise ValueError('Method not available.')
+
+
+def empty_locs(identifications, box, camera_info, method='mle', mle_method='sigma'):
+    ''' The locs of no spots, with the columns that the fit method gives '''
+    spots = _np.zeros((0, box, box), dtype=_np.float32)
+    return _fit_block(spots, identifications[:0], box, camera_info, method, 0, 0, mle_method)
+
+
+def _fit_blocks(movie, camera_info, blocks, box, method, eps, max_it, mle_method):
+    '''
+    Cuts and fits blocks of (progress, identifications). The next block is identified and cut
+    in a background thread while the current one is fitted. If the consumer stops early or fitting
+    fails, the background thread is stopped.
+    '''
+    queue = _queue.Queue(maxsize=1)
+    stop = _threading.Event()
+
+    def produce():
+        try:
+            for progress, identifications in blocks:
+                if stop.is_set():
+                    return
+                spots = get_spots(movie, identifications, box, camera_info)
+                queue.put((progress, identifications, spots))
+        except Exception as e:
+            queue.put(e)
+            return
+        finally:
+            if hasattr(blocks, 'close'):
+                blocks.close()
+        queue.put(None)
+
+    producer = _threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            progress, identifications, spots = item
+            del item
+            locs = _fit_block(spots, identifications, box, camera_info, method, eps, max_it, mle_method)
+            del spots
+            yield progress, locs
+    finally:
+        stop.set()
+        # Drain the queue, so that a producer blocked on put can see the stop event and exit
+        while producer.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except _queue.Empty:
+                pass
+        producer.join()
+
+
+def _identification_blocks(movie, minimum_ng, box, roi, block_size, maxima_method='filter'):
+    ''' Identifies batches of frames in parallel and groups the identifications into blocks of block_size '''
+    n_frames = len(movie)
+    n_workers = _n_identify_workers()
+    frames_per_batch = 4 * n_workers
+    pending = []
+    n_pending = 0
+    with _ThreadPoolExecutor(n_workers) as executor:
+        for start in range(0, n_frames, frames_per_batch):
+            end = min(start + frames_per_batch, n_frames)
+            pending.extend(executor.map(lambda _: identify_by_frame_number(movie, minimum_ng, box, _, roi,
+                                                                           maxima_method),
+                                        range(start, end)))
+            n_pending += sum([len(_) for _ in pending[-(end - start):]])
+            while n_pending > block_size:
+                ids = _np.hstack(pending).view(_np.recarray)
+                block_end = _block_end(ids.frame, 0, block_size)
+                if block_end == n_pending:
+                    break
+                yield end, ids[:block_end]
+                pending = [ids[block_end:]]
+                n_pending = len(pending[0])
+    if n_pending > 0:
+        yield n_frames, _np.hstack(pending).view(_np.recarray)
+
+
+def localize_chunks(movie, camera_info, minimum_ng, box, method='mle', eps=0.001, max_it=100,
+                    roi=None, max_memory=MAX_MEMORY, mle_method='sigma', maxima_method='filter'):
+    '''
+    Streaming identify, cut and fit with bounded memory.
+    Yields (number of identified frames, locs) per block; the locs of all blocks are in frame order.
+    method is 'mle', 'lq', 'lq-gpufit' or 'avg'. max_memory (bytes) limits the spots in flight.
+    maxima_method is 'filter' or 'scan' (see identify_in_image).
+    '''
+    block_size = _spots_per_block(box, max_memory)
+    blocks = _identification_blocks(movie, minimum_ng, box, roi, block_size, maxima_method)
+    return _fit_blocks(movie, camera_info, blocks, box, method, eps, max_it, mle_method)
+
+
+def fit_chunks(movie, camera_info, identifications, box, method='mle', eps=0.001, max_it=100,
+               max_memory=MAX_MEMORY, mle_method='sigma'):
+    ''' Like localize_chunks, for existing identifications. Yields (number of fitted spots, locs) per block. '''
+    block_size = _spots_per_block(box, max_memory)
+
+    def blocks():
+        start = 0
+        while start < len(identifications):
+            end = _block_end(identifications.frame, start, block_size)
+            yield end, identifications[start:end]
+            start = end
+    return _fit_blocks(movie, camera_info, blocks(), box, method, eps, max_it, mle_method)
+
+
 def localize(movie, info, parameters):
     print('localizing')
     identifications = identify(movie, parameters)
@@ -10,14 +10,14 @@
 
 import numpy as _np
 import numba as _numba
-from sklearn.cluster import DBSCAN as _DBSCAN
 from scipy import interpolate as _interpolate
 from scipy.special import iv as _iv
-from scipy.spatial import distance
+from scipy.spatial import cKDTree as _cKDTree
 from scipy.spatial import ConvexHull
 
 from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 import multiprocessing as _multiprocessing
+import time as _time
 import matplotlib.pyplot as _plt
 import itertools as _itertools
 import lmfit as _lmfit
@@ -25,47 +25,11 @@ from collections import OrderedDict as _OrderedDict
 from . import lib as _lib
 from . import render as _render
 from . import imageprocess as _imageprocess
-from threading import Thread as _Thread
-import time as _time
 from tqdm import tqdm as _tqdm
-from numpy.lib.recfunctions import stack_arrays
-
-
 
 
 
 
-def get_index_blocks(locs, info, size, callback=None):
-    locs = _lib.ensure_sanity(locs, info)
-    # Sort locs by indices
-    x_index = _np.uint32(locs.x / size)
-    y_index = _np.uint32(locs.y / size)
-    sort_indices = _np.lexsort([x_index, y_index])
-    locs = locs[sort_indices]
-    x_index = x_index[sort_indices]
-    y_index = y_index[sort_indices]
-    # Allocate block info arrays
-    n_blocks_y, n_blocks_x = index_blocks_shape(info, size)
-    block_starts = _np.zeros((n_blocks_y, n_blocks_x), dtype=_np.uint32)
-    block_ends = _np.zeros((n_blocks_y, n_blocks_x), dtype=_np.uint32)
-    K, L = block_starts.shape
-    # Fill in block starts and ends
-    # We are running this in a thread with a nogil numba function. This helps updating a potential GUI with the callback.
-    if callback is not None:
-        callback(0)
-        counter = [0]
-    else:
-        counter = None
-    thread = _Thread(target=_fill_index_blocks, args=(block_starts, block_ends, x_index, y_index, counter))
-    thread.start()
-    if callback is not None:
-        while counter[0] < K:
-            callback(counter[0])
-            _time.sleep(0.1)
-    thread.join()
-    if callback is not None:
-        callback(counter[0])
-    return locs, size, x_index, y_index, block_starts, block_ends, K, L
 
 
 def index_blocks_shape(info, size):
@@ -75,98 +39,480 @@ def index_blocks_shape(info, size):
     return n_blocks_y, n_blocks_x
 
 
+@_numba.jit(nopython=True, nogil=True)
+def _counting_sort(cells, n_cells):
+    ''' Stable sort by cell. Returns the sort order and the start of each cell in the sorted array. '''
+    starts = _np.zeros(n_cells + 1, dtype=_np.int64)
+    for c in cells:
+        starts[c + 1] += 1
+    for c in range(n_cells):
+        starts[c + 1] += starts[c]
+    position = starts[:-1].copy()
+    order = _np.empty(len(cells), dtype=_np.int64)
+    for i in range(len(cells)):
+        c = cells[i]
+        order[position[c]] = i
+        position[c] += 1
+    return order, starts
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _in_radius(x, y, z, starts, size, z_size, z_min, K, L, M, three_d, qx, qy, qz, r, r_z,
+               counts, offsets, indices, groups, fill):
+    '''
+    Finds the locs within r of each query point (x, y) or, in 3D, within the ellipsoid of radii r and r_z.
+    Writes the number of locs per query to counts, or, if fill, their indices and query numbers at offsets.
+    '''
+    r2 = r**2
+    r_z2 = r_z**2
+    reach = int(_np.ceil(r / size))
+    reach_z = int(_np.ceil(r_z / z_size)) if three_d else 0
+    for q in range(len(qx)):
+        k0 = int(_np.floor(qy[q] / size))
+        l0 = int(_np.floor(qx[q] / size))
+        m0 = int(_np.floor((qz[q] - z_min) / z_size)) if three_d else 0
+        n = 0
+        for m in range(max(m0 - reach_z, 0), min(m0 + reach_z + 1, M)):
+            for k in range(max(k0 - reach, 0), min(k0 + reach + 1, K)):
+                for l in range(max(l0 - reach, 0), min(l0 + reach + 1, L)):
+                    c = (m * K + k) * L + l
+                    for j in range(starts[c], starts[c + 1]):
+                        d2 = (x[j] - qx[q])**2 + (y[j] - qy[q])**2
+                        if three_d:
+                            inside = d2 / r2 + (z[j] - qz[q])**2 / r_z2 < 1
+                        else:
+                            inside = d2 < r2
+                        if inside:
+                            if fill:
+                                indices[offsets[q] + n] = j
+                                groups[offsets[q] + n] = q
+                            n += 1
+        counts[q] = n
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _in_box(x, y, starts, size, K, L, M, x_min, y_min, x_max, y_max, counts, offsets, indices, groups, fill):
+    ''' Like _in_radius, for the boxes x_min <= x < x_max, y_min <= y < y_max (all z) '''
+    for q in range(len(x_min)):
+        n = 0
+        for m in range(M):
+            for k in range(max(int(_np.floor(y_min[q] / size)), 0), min(int(_np.floor(y_max[q] / size)) + 1, K)):
+                for l in range(max(int(_np.floor(x_min[q] / size)), 0), min(int(_np.floor(x_max[q] / size)) + 1, L)):
+                    c = (m * K + k) * L + l
+                    for j in range(starts[c], starts[c + 1]):
+                        if x_min[q] <= x[j] < x_max[q] and y_min[q] <= y[j] < y_max[q]:
+                            if fill:
+                                indices[offsets[q] + n] = j
+                                groups[offsets[q] + n] = q
+                            n += 1
+        counts[q] = n
+
+
+class SpatialIndex():
+    '''
+    Localizations sorted into a grid of cells with side length size (and z_size in z, for 3D indices).
+    The locs of cell c are locs[starts[c]:starts[c+1]], with c = (z_cell * K + y_cell) * L + x_cell.
+    Queries of any radius use the same index, so it only needs to be built once per localization list.
+    '''
+
+    def __init__(self, locs, info, size, z_size=None):
+        locs = _lib.ensure_sanity(locs, info)
+        self.size = size
+        self.K, self.L = index_blocks_shape(info, size)
+        x_index = _np.minimum(_np.uint32(locs.x / size), self.L - 1)
+        y_index = _np.minimum(_np.uint32(locs.y / size), self.K - 1)
+        # The index is 3D whenever z_size is given, even if all locs fall into one z cell
+        self.three_d = z_size is not None
+        if not self.three_d or len(locs) == 0:
+            self.z_size = 1.0 if z_size is None else z_size
+            self.z_min = 0.0
+            self.M = 1
+            z_index = _np.zeros(len(locs), dtype=_np.int64)
+        else:
+            self.z_size = z_size
+            self.z_min = float(locs.z.min())
+            z_index = _np.int64((locs.z - self.z_min) / z_size)
+            self.M = int(z_index.max()) + 1
+        cells = (z_index * self.K + y_index) * self.L + x_index
+        order, self.starts = _counting_sort(cells.astype(_np.int64), self.M * self.K * self.L)
+        self.locs = locs[order]
+        self.x_index = x_index[order]
+        self.y_index = y_index[order]
+        self.z_index = z_index[order]
+        # Contiguous coordinates for the compiled queries
+        self.x = _np.ascontiguousarray(self.locs.x)
+        self.y = _np.ascontiguousarray(self.locs.y)
+        if self.three_d:
+            self.z = _np.ascontiguousarray(self.locs.z)
+        else:
+            self.z = _np.zeros(1, dtype=_np.float32)
+
+    def __len__(self):
+        return len(self.locs)
+
+    @property
+    def block_starts(self):
+        ''' Start of each cell, as a K x L (or M x K x L) grid '''
+        return self._grid(self.starts[:-1])
+
+    @property
+    def block_ends(self):
+        ''' End of each cell, as a K x L (or M x K x L) grid '''
+        return self._grid(self.starts[1:])
+
+    def _grid(self, a):
+        if not self.three_d:
+            return a.reshape(self.K, self.L)
+        return a.reshape(self.M, self.K, self.L)
+
+    def _query_points(self, x, y, z):
+        qx = _np.atleast_1d(_np.asarray(x, dtype=_np.float64))
+        qy = _np.atleast_1d(_np.asarray(y, dtype=_np.float64))
+        if self.three_d:
+            if z is None:
+                raise ValueError('3D index needs z query coordinates.')
+            qz = _np.atleast_1d(_np.asarray(z, dtype=_np.float64))
+        else:
+            qz = _np.zeros(1)
+        return qx, qy, qz
+
+    def _radius_args(self, x, y, r, z, r_z):
+        qx, qy, qz = self._query_points(x, y, z)
+        if r_z is None:
+            r_z = r
+        return (self.x, self.y, self.z, self.starts, self.size, self.z_size, self.z_min, self.K, self.L, self.M,
+                self.three_d, qx, qy, qz, r, r_z)
+
+    @staticmethod
+    def _two_pass(kernel, args, n_queries):
+        counts = _np.zeros(n_queries, dtype=_np.int64)
+        offsets = _np.zeros(n_queries, dtype=_np.int64)
+        empty = _np.zeros(0, dtype=_np.int64)
+        kernel(*args, counts, offsets, empty, empty, False)
+        offsets[1:] = _np.cumsum(counts)[:-1]
+        n = int(counts.sum())
+        indices = _np.empty(n, dtype=_np.int64)
+        groups = _np.empty(n, dtype=_np.int64)
+        kernel(*args, counts, offsets, indices, groups, True)
+        return indices, groups
+
+    def count_in_radius(self, x, y, r, z=None, r_z=None):
+        ''' Number of locs within r of each point (x, y). 3D indices need z and use r_z (default r) in z. '''
+        args = self._radius_args(x, y, r, z, r_z)
+        n_queries = len(args[11])
+        counts = _np.zeros(n_queries, dtype=_np.int64)
+        empty = _np.zeros(0, dtype=_np.int64)
+        _in_radius(*args, counts, empty, empty, empty, False)
+        return counts
+
+    def indices_in_radius(self, x, y, r, z=None, r_z=None):
+        '''
+        Indices into self.locs of the locs within r of each point (x, y), and the number of the point they
+        belong to. Indices are grouped by point and ascending within a point.
+        '''
+        args = self._radius_args(x, y, r, z, r_z)
+        return self._two_pass(_in_radius, args, len(args[11]))
+
+    def locs_in_radius(self, x, y, r, z=None, r_z=None):
+        ''' The locs within r of a single point (x, y) '''
+        indices, groups = self.indices_in_radius(x, y, r, z, r_z)
+        return self.locs[indices]
+
+    def indices_in_box(self, x_min, y_min, x_max, y_max):
+        ''' Like indices_in_radius, for the boxes x_min <= x < x_max, y_min <= y < y_max '''
+        boxes = [_np.atleast_1d(_np.asarray(_, dtype=_np.float64)) for _ in (x_min, y_min, x_max, y_max)]
+        args = (self.x, self.y, self.starts, self.size, self.K, self.L, self.M) + tuple(boxes)
+        return self._two_pass(_in_box, args, len(boxes[0]))
+
+    def block_locs_at(self, x, y):
+        ''' The locs in the 3 x 3 cells around (x, y) '''
+        k = _np.floor(y / self.size)
+        l = _np.floor(x / self.size)
+        indices, groups = self.indices_in_box((l - 1) * self.size, (k - 1) * self.size,
+                                              (l + 2) * self.size, (k + 2) * self.size)
+        return self.locs[indices]
+
+    def n_block_locs_at(self, x, y):
+        ''' Number of locs in the 3 x 3 cells around each point (x, y) '''
+        k = _np.floor(_np.asarray(y) / self.size)
+        l = _np.floor(_np.asarray(x) / self.size)
+        x_min = (l - 1) * self.size
+        y_min = (k - 1) * self.size
+        args = (self.x, self.y, self.starts, self.size, self.K, self.L, self.M,
+                _np.atleast_1d(x_min), _np.atleast_1d(y_min),
+                _np.atleast_1d(x_min + 3 * self.size), _np.atleast_1d(y_min + 3 * self.size))
+        n_queries = len(args[7])
+        counts = _np.zeros(n_queries, dtype=_np.int64)
+        empty = _np.zeros(0, dtype=_np.int64)
+        _in_box(*args, counts, empty, empty, empty, False)
+        return counts
+
+
+def get_index_blocks(locs, info, size, callback=None):
+    '''
+    The 2D index of locs as the tuple (locs, size, x_index, y_index, block_starts, block_ends, K, L).
+    Kept for compatibility, new code should use SpatialIndex.
+    '''
+    if callback is not None:
+        callback(0)
+    index = SpatialIndex(locs, info, size)
+    if callback is not None:
+        callback(index.K)
+    return (index.locs, size, index.x_index, index.y_index, index.block_starts, index.block_ends,
+            index.K, index.L)
+
+
 @_numba.jit(nopython=True, nogil=True)
 def n_block_locs_at(x, y, size, K, L, block_starts, block_ends):
-    x_index = _np.uint32(x / size)
-    y_index = _np.uint32(y / size)
+    ''' Number of locs in the 3 x 3 blocks around (x, y) of an index from get_index_blocks '''
+    x_index = int(x / size)
+    y_index = int(y / size)
     n_block_locs = 0
-    for k in range(y_index - 1, y_index + 2):
-        if 0 < k < K:
-            for l in range(x_index - 1, x_index + 2):
-                if 0 < l < L:
-                    n_block_locs += block_ends[k, l] - block_starts[k, l]
+    for k in range(max(y_index - 1, 0), min(y_index + 2, K)):
+        for l in range(max(x_index - 1, 0), min(x_index + 2, L)):
+            n_block_locs += block_ends[k, l] - block_starts[k, l]
     return n_block_locs
 
 
 def get_block_locs_at(x, y, index_blocks):
+    ''' The locs in the 3 x 3 blocks around (x, y) of an index from get_index_blocks '''
     locs, size, x_index, y_index, block_starts, block_ends, K, L = index_blocks
-    x_index = _np.uint32(x / size)  # is this really necessary?
-    y_index = _np.uint32(y / size)  # is this really necessary?
-    indices = []
-    for k in range(y_index - 1, y_index+2):
-        if 0 < k < K:
-            for l in range(x_index - 1, x_index + 2):
-                if 0 < l < L:
-                    indices.append(list(range(block_starts[k, l], block_ends[k, l])))
-    indices = list(_itertools.chain(*indices))
-    return locs[indices]
-
-
-def _fill_index_blocks(block_starts, block_ends, x_index, y_index, counter=None):
-    Y, X = block_starts.shape
-    N = len(x_index)
-    k = 0
-    if counter is not None:
-        counter[0] = 0
-    for i in range(Y):
-        for j in range(X):
-            k = _fill_index_block(block_starts, block_ends, N, x_index, y_index, i, j, k)
-        if counter is not None:
-            counter[0] = i+1
+    x_index = int(x / size)
+    y_index = int(y / size)
+    k = slice(max(y_index - 1, 0), min(y_index + 2, K))
+    l = slice(max(x_index - 1, 0), min(x_index + 2, L))
+    indices = [_np.arange(start, end) for start, end in zip(block_starts[k, l].ravel(), block_ends[k, l].ravel())]
+    return locs[_np.concatenate(indices + [_np.zeros(0, dtype=_np.int64)])]
 
 
 @_numba.jit(nopython=True, nogil=True)
-def _fill_index_block(block_starts, block_ends, N, x_index, y_index, i, j, k):
-    block_starts[i, j] = k
-    while k < N and y_index[k] == i and x_index[k] == j:
-        k += 1
-    block_ends[i, j] = k
-    return k
+def _pair_histogram(x, y, z, x_index, y_index, z_index, starts, K, L, M, three_d, z_scale, r_max, bin_size,
+                    window, edge_correction, start, end, dh):
+    '''
+    Adds the distances below r_max of locs start to end to all later locs (each pair once) to the histogram dh.
+    The index cells must be at least r_max wide. z is multiplied by z_scale.
+    With edge_correction, pairs are weighted by the translation correction of the rectangular window.
+    '''
+    n_bins = len(dh)
+    r_max_2 = r_max**2
+    volume = window[0] * window[1]
+    if three_d:
+        volume *= window[2]
+    for i in range(start, end):
+        k0 = y_index[i]
+        l0 = x_index[i]
+        m0 = z_index[i]
+        for m in range(max(m0 - 1, 0), min(m0 + 2, M)):
+            for k in range(max(k0 - 1, 0), min(k0 + 2, K)):
+                for l in range(max(l0 - 1, 0), min(l0 + 2, L)):
+                    c = (m * K + k) * L + l
+                    for j in range(max(starts[c], i + 1), starts[c + 1]):
+                        dx = abs(x[i] - x[j])
+                        dy = abs(y[i] - y[j])
+                        d2 = dx**2 + dy**2
+                        dz = 0.0
+                        if three_d:
+                            dz = abs(z[i] - z[j]) * z_scale
+                            d2 += dz**2
+                        if d2 < r_max_2:
+                            bin = int(_np.sqrt(d2) / bin_size)
+                            if bin < n_bins:
+                                if edge_correction:
+                                    overlap = (window[0] - dx) * (window[1] - dy)
+                                    if three_d:
+                                        overlap *= window[2] - dz
+                                    if overlap > 0:
+                                        dh[bin] += volume / overlap
+                                else:
+                                    dh[bin] += 1
 
 
 @_numba.jit(nopython=True, nogil=True)
-def _distance_histogram(locs, bin_size, r_max, x_index, y_index, block_starts, block_ends, start, chunk):
-    x = locs.x
-    y = locs.y
-    dh_len = _np.uint32(r_max / bin_size)
-    dh = _np.zeros(dh_len, dtype=_np.uint32)
-    r_max_2 = r_max**2
-    K, L = block_starts.shape
-    end = min(start+chunk, len(locs))
-    for i in range(start, end):
-        xi = x[i]
-        yi = y[i]
-        ki = y_index[i]
-        li = x_index[i]
-        for k in range(ki, ki+2):
-            if k < K:
-                for l in range(li, li+2):
-                    if l < L:
-                        for j in range(block_starts[k, l], block_ends[k, l]):
-                            if j > i:
-                                dx2 = (xi - x[j])**2
-                                if dx2 < r_max_2:
-                                    dy2 = (yi - y[j])**2
-                                    if dy2 < r_max_2:
-                                        d = _np.sqrt(dx2 + dy2)
-                                        if d < r_max:
-                                            bin = _np.uint32(d / bin_size)
-                                            if bin < dh_len:
-                                                dh[bin] += 1
-    return dh
+def _segment_mean_std(values, bounds, mean, std):
+    for g in range(len(bounds) - 1):
+        start = bounds[g]
+        end = bounds[g + 1]
+        sum_ = 0.0
+        for i in range(start, end):
+            sum_ += values[i]
+        mean[g] = sum_ / (end - start)
+        sum_ = 0.0
+        for i in range(start, end):
+            sum_ += (values[i] - mean[g])**2
+        std[g] = _np.sqrt(sum_ / (end - start))
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _segment_weighted_mean(values, weights, bounds, mean, sum_weights):
+    for g in range(len(bounds) - 1):
+        sum_ = 0.0
+        sum_w = 0.0
+        for i in range(bounds[g], bounds[g + 1]):
+            sum_ += values[i] * weights[i]
+            sum_w += weights[i]
+        mean[g] = sum_ / sum_w
+        sum_weights[g] = sum_w
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _segment_min_max(values, bounds, min_, max_):
+    for g in range(len(bounds) - 1):
+        min_[g] = values[bounds[g]]
+        max_[g] = values[bounds[g]]
+        for i in range(bounds[g] + 1, bounds[g + 1]):
+            if values[i] < min_[g]:
+                min_[g] = values[i]
+            if values[i] > max_[g]:
+                max_[g] = values[i]
+
+
+class GroupSegments():
+    '''
+    Sorts localizations by one or more key columns (e.g. group, or group and cluster) into contiguous segments,
+    for per-group reductions in one compiled pass over a column.
+    ids holds the key values of each segment, counts the number of locs per segment.
+    '''
+
+    def __init__(self, *keys):
+        keys = [_np.asarray(_) for _ in keys]
+        if len(keys) == 1:
+            self.order = _np.argsort(keys[0], kind='mergesort')
+        else:
+            self.order = _np.lexsort(keys[::-1])
+        sorted_keys = [_[self.order] for _ in keys]
+        N = len(self.order)
+        new_segment = _np.zeros(N, dtype=bool)
+        new_segment[:1] = True
+        for key in sorted_keys:
+            new_segment[1:] |= key[1:] != key[:-1]
+        starts = _np.flatnonzero(new_segment)
+        self.bounds = _np.append(starts, N)
+        self.counts = _np.diff(self.bounds)
+        self.ids = [_[starts] for _ in sorted_keys]
+        if len(keys) == 1:
+            self.ids = self.ids[0]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def sort(self, values):
+        ''' values in segment order '''
+        return _np.ascontiguousarray(_np.asarray(values)[self.order])
+
+    def segments(self, values):
+        ''' Iterates over the values of each segment '''
+        values = self.sort(values)
+        for start, end in zip(self.bounds[:-1], self.bounds[1:]):
+            yield values[start:end]
+
+    def mean_std(self, values):
+        ''' Mean and (population) standard deviation per segment '''
+        mean = _np.empty(len(self))
+        std = _np.empty(len(self))
+        _segment_mean_std(self.sort(values), self.bounds, mean, std)
+        return mean, std
+
+    def mean(self, values):
+        return self.mean_std(values)[0]
+
+    def std(self, values):
+        return self.mean_std(values)[1]
+
+    def weighted_mean(self, values, weights):
+        ''' Weighted mean and sum of weights per segment '''
+        mean = _np.empty(len(self))
+        sum_weights = _np.empty(len(self))
+        _segment_weighted_mean(self.sort(values), self.sort(weights), self.bounds, mean, sum_weights)
+        return mean, sum_weights
+
+    def min_max(self, values):
+        values = self.sort(values)
+        min_ = _np.empty(len(self), dtype=values.dtype)
+        max_ = _np.empty(len(self), dtype=values.dtype)
+        _segment_min_max(values, self.bounds, min_, max_)
+        return min_, max_
+
+    def first_last(self, values):
+        ''' The first and last value of each segment, in the original order of the locs '''
+        values = self.sort(values)
+        return values[self.bounds[:-1]], values[self.bounds[1:] - 1]
+
+
+def picked_locs(locs, info, x, y, r, index=None, add_group=True, split=False):
+    '''
+    The locs within r of the pick centers (x, y), found in one pass over a spatial index.
+    A loc in overlapping picks is returned once per pick. With add_group, the column group holds the pick number.
+    Pass index (a SpatialIndex of locs) to reuse it; locs and info are then not used.
+    With split, returns a list with the locs of each pick instead of one array sorted by pick.
+    '''
+    x = _np.atleast_1d(x)
+    y = _np.atleast_1d(y)
+    if index is None:
+        index = SpatialIndex(locs, info, r)
+    indices, groups = index.indices_in_radius(x, y, r)
+    picked = index.locs[indices]
+    if add_group:
+        picked = _lib.append_to_rec(picked, _np.int32(groups), 'group')
+    if split:
+        ends = _np.cumsum(_np.bincount(groups, minlength=len(x)))
+        return _np.split(picked, ends[:-1])
+    return picked
+
+
+def _pair_distance_histogram(locs, info, bin_size, r_max, pixelsize=None, edge_correction=False):
+    '''
+    Histogram of all pair distances below r_max (each pair counted once), computed in parallel chunks
+    with one histogram each. With pixelsize (nm/px), z (in nm) is included in the distance.
+    Returns the histogram, the number of locs and the window (extent in x, y and z) of the locs.
+    '''
+    three_d = pixelsize is not None
+    index = SpatialIndex(locs, info, r_max, r_max * pixelsize if three_d else None)
+    N = len(index)
+    n_bins = int(r_max / bin_size)
+    z_scale = 1 / pixelsize if three_d else 1.0
+    if N == 0:
+        return _np.zeros(n_bins), N, _np.zeros(3)
+    z_extent = (index.locs.z.max() - index.locs.z.min()) * z_scale if three_d else 1.0
+    window = _np.array([index.x.max() - index.x.min(), index.y.max() - index.y.min(), z_extent], dtype=_np.float64)
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    bounds = _np.linspace(0, N, min(4 * n_workers, N) + 1).astype(_np.int64)
+    dh = _np.zeros((len(bounds) - 1, n_bins))
+    with _ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(_pair_histogram, index.x, index.y, index.z, index.x_index, index.y_index, index.z_index,
+                              index.starts, index.K, index.L, index.M, three_d, z_scale, r_max, bin_size, window,
+                              edge_correction, bounds[k], bounds[k + 1], dh[k]) for k in range(len(bounds) - 1)]
+    for f in fs:
+        f.result()
+    return dh.sum(axis=0), N, window
 
 
 def distance_histogram(locs, info, bin_size, r_max):
-    locs, size, x_index, y_index, block_starts, block_ends, K, L = get_index_blocks(locs, info, r_max)
-    N = len(locs)
-    n_threads = _multiprocessing.cpu_count()
-    chunk = int(N / n_threads)
-    starts = range(0, N, chunk)
-    args = [(locs, bin_size, r_max, x_index, y_index, block_starts, block_ends, start, chunk) for start in starts]
-    with _ThreadPoolExecutor() as executor:
-        futures = [executor.submit(_distance_histogram, *_) for _ in args]
-    results = [future.result() for future in futures]
-    return _np.sum(results, axis=0)
+    ''' Number of pairs of locs per distance bin, up to r_max '''
+    dh, N, window = _pair_distance_histogram(locs, info, bin_size, r_max)
+    return _np.int64(dh)
+
+
+def spatial_statistics(locs, info, bin_size, r_max, pixelsize=None, edge_correction=True):
+    '''
+    Pair-correlation g and Ripley's K, L and H functions of the locs, in the bounding box of the locs.
+    With pixelsize (nm/px), 3D locs are analyzed in 3D, with z scaled to pixels.
+    Returns a recarray with one row per distance bin: K, L and H are evaluated at the upper bin edge r,
+    g is averaged over the bin. Edge effects are corrected by translation weights.
+    '''
+    three_d = pixelsize is not None
+    dh, N, window = _pair_distance_histogram(locs, info, bin_size, r_max, pixelsize, edge_correction)
+    volume = window[0] * window[1] * (window[2] if three_d else 1)
+    r = bin_size * _np.arange(1, len(dh) + 1)
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        K = 2 * volume / (N * (N - 1)) * _np.cumsum(dh)
+        if three_d:
+            L = _np.cbrt(3 * K / (4 * _np.pi))
+            shell = 4 / 3 * _np.pi * (r**3 - (r - bin_size)**3)
+        else:
+            L = _np.sqrt(K / _np.pi)
+            shell = _np.pi * (r**2 - (r - bin_size)**2)
+        g = _np.diff(K, prepend=0) / shell
+    return _np.rec.array((r, g, K, L, L - r), dtype=[('r', 'f4'), ('g', 'f4'), ('K', 'f4'), ('L', 'f4'), ('H', 'f4')])
 
 
 def nena(locs, info, callback=None):
@@ -205,45 +551,61 @@ def next_frame_neighbor_distance_histogram(locs, callback=None):
 
 
 def _nfndh(frame, x, y, group, d_max, bin_size, callback=None):
+    '''
+    Histogram of the distances of locs to the locs of the same group in the next frame, up to d_max.
+    frame must be sorted. Each thread fills its own histogram for a range of locs in one compiled call;
+    callback gets the progress in percent.
+    '''
     N = len(frame)
     bins = _np.arange(0, d_max, bin_size)
-    dnfl = _np.zeros(len(bins))
-    one_percent = int(N / 100)
-    starts = one_percent * _np.arange(100)
-    for k, start in enumerate(starts):
-        for i in range(start, start + one_percent):
-            _fill_dnfl(N, frame, x, y, group, i, d_max, dnfl, bin_size)
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    bounds = _np.linspace(0, N, n_workers + 1).astype(_np.int64)
+    dnfl = _np.zeros((n_workers, len(bins)))
+    progress = _np.zeros(n_workers, dtype=_np.int64)
+    with _ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(_fill_dnfl, frame, x, y, group, bounds[k], bounds[k + 1], d_max, bin_size, dnfl[k],
+                              progress, k) for k in range(n_workers)]
         if callback is not None:
-            callback(k+1)
+            while not all(_.done() for _ in fs):
+                callback(int(100 * progress.sum() / max(N, 1)))
+                _time.sleep(0.1)
+    for f in fs:
+        f.result()
+    if callback is not None:
+        callback(100)
     bin_centers = bins + bin_size / 2
-    return bin_centers, dnfl
+    return bin_centers, dnfl.sum(axis=0)
 
 
-@_numba.jit(nopython=True)
-def _fill_dnfl(N, frame, x, y, group, i, d_max, dnfl, bin_size):
-    frame_i = frame[i]
-    x_i = x[i]
-    y_i = y[i]
-    group_i = group[i]
-    min_frame = frame_i + 1
-    for min_index in range(i + 1, N):
-        if frame[min_index] >= min_frame:
-            break
-    max_frame = frame_i + 1
-    for max_index in range(min_index, N):
-        if frame[max_index] > max_frame:
-            break
+@_numba.jit(nopython=True, nogil=True)
+def _fill_dnfl(frame, x, y, group, start, end, d_max, bin_size, dnfl, progress, worker):
+    ''' Adds the next frame neighbor distances of locs start to end to dnfl. progress[worker] counts the locs done. '''
+    N = len(frame)
+    n_bins = len(dnfl)
     d_max_2 = d_max**2
-    for j in range(min_index, max_index):
-        if group[j] == group_i:
-            dx2 = (x_i - x[j])**2
-            if dx2 <= d_max_2:
-                dy2 = (y_i - y[j])**2
-                if dy2 <= d_max_2:
-                    d = _np.sqrt(dx2 + dy2)
-                    if d <= d_max:
-                        bin = int(d / bin_size)
-                        dnfl[bin] += 1
+    min_index = 0
+    max_index = 0
+    for i in range(start, end):
+        if i == start or frame[i] != frame[i - 1]:
+            min_index = _np.searchsorted(frame, frame[i] + 1)
+            max_index = _np.searchsorted(frame, frame[i] + 1, side='right')
+        x_i = x[i]
+        y_i = y[i]
+        group_i = group[i]
+        for j in range(min_index, max_index):
+            if group[j] == group_i:
+                dx2 = (x_i - x[j])**2
+                if dx2 <= d_max_2:
+                    dy2 = (y_i - y[j])**2
+                    if dy2 <= d_max_2:
+                        d = _np.sqrt(dx2 + dy2)
+                        if d <= d_max:
+                            bin = int(d / bin_size)
+                            if bin < n_bins:
+                                dnfl[bin] += 1
+        if (i - start) % 4096 == 4095:
+            progress[worker] = i - start + 1
+    progress[worker] = end - start
 
 
 def pair_correlation(locs, info, bin_size, r_max):
@@ -258,132 +620,244 @@ def pair_correlation(locs, info, bin_size, r_max):
     
     return bins_lower, dh / area
 
-def dbscan(locs, radius, min_density):
+
+@_numba.jit(nopython=True, nogil=True)
+def _neighbor_cells(cell_keys, key, L, M, ranges):
+    ''' Fills ranges with the (first, last + 1) cell numbers of the up to 9 occupied cell runs around the cell key '''
+    k = key // (L * M)
+    l = (key // M) % L
+    m = key % M
+    n = 0
+    for k_ in range(k - 1, k + 2):
+        if k_ < 0:
+            continue
+        for l_ in range(l - 1, l + 2):
+            if l_ < 0 or l_ >= L:
+                continue
+            base = (k_ * L + l_) * M
+            ranges[n, 0] = _np.searchsorted(cell_keys, base + max(m - 1, 0))
+            ranges[n, 1] = _np.searchsorted(cell_keys, base + min(m + 1, M - 1), side='right')
+            n += 1
+    return n
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _roots(parent, points):
+    roots = _np.empty(len(points), dtype=_np.int64)
+    for i in range(len(points)):
+        roots[i] = _find(parent, points[i])
+    return roots
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _dbscan_core(X, cell_keys, cell_starts, L, M, r2, min_samples, c0, c1, is_core):
+    ''' Marks the points of cells c0 to c1 with at least min_samples neighbors (including themselves) as core '''
+    ranges = _np.empty((9, 2), dtype=_np.int64)
+    for c in range(c0, c1):
+        n_ranges = _neighbor_cells(cell_keys, cell_keys[c], L, M, ranges)
+        for i in range(cell_starts[c], cell_starts[c + 1]):
+            n = 0
+            for r in range(n_ranges):
+                for j in range(cell_starts[ranges[r, 0]], cell_starts[ranges[r, 1]]):
+                    d2 = 0.0
+                    for d in range(X.shape[1]):
+                        d2 += (X[i, d] - X[j, d])**2
+                    if d2 <= r2:
+                        n += 1
+                if n >= min_samples:
+                    break
+            is_core[i] = n >= min_samples
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _dbscan_union(X, cell_keys, cell_starts, L, M, r2, is_core, c0, c1, j_min, j_max, parent):
+    ''' Merges the core points of cells c0 to c1 with their core neighbors j, j_min <= j < j_max '''
+    ranges = _np.empty((9, 2), dtype=_np.int64)
+    for c in range(c0, c1):
+        n_ranges = _neighbor_cells(cell_keys, cell_keys[c], L, M, ranges)
+        for i in range(cell_starts[c], cell_starts[c + 1]):
+            if not is_core[i]:
+                continue
+            for r in range(n_ranges):
+                start = max(cell_starts[ranges[r, 0]], j_min)
+                end = min(cell_starts[ranges[r, 1]], j_max)
+                for j in range(start, end):
+                    if is_core[j]:
+                        d2 = 0.0
+                        for d in range(X.shape[1]):
+                            d2 += (X[i, d] - X[j, d])**2
+                        if d2 <= r2:
+                            root_i = _find(parent, i)
+                            root_j = _find(parent, j)
+                            if root_i < root_j:
+                                parent[root_j] = root_i
+                            elif root_j < root_i:
+                                parent[root_i] = root_j
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _dbscan_border(X, cell_keys, cell_starts, L, M, r2, is_core, c0, c1, labels):
+    ''' Gives the non-core points of cells c0 to c1 the lowest label of their core neighbors '''
+    ranges = _np.empty((9, 2), dtype=_np.int64)
+    for c in range(c0, c1):
+        n_ranges = _neighbor_cells(cell_keys, cell_keys[c], L, M, ranges)
+        for i in range(cell_starts[c], cell_starts[c + 1]):
+            if is_core[i]:
+                continue
+            label = -1
+            for r in range(n_ranges):
+                for j in range(cell_starts[ranges[r, 0]], cell_starts[ranges[r, 1]]):
+                    if is_core[j] and (label == -1 or labels[j] < label):
+                        d2 = 0.0
+                        for d in range(X.shape[1]):
+                            d2 += (X[i, d] - X[j, d])**2
+                        if d2 <= r2:
+                            label = labels[j]
+            labels[i] = label
+
+
+def dbscan_labels(X, radius, min_samples):
+    '''
+    DBSCAN cluster labels (-1 for noise) of the points X (shape (N, dimensions)), identical to sklearn's DBSCAN.
+    Points are sorted into a grid of cells with side length radius, which is processed in parallel
+    in bands of cell rows, without neighbor lists.
+    '''
+    X = _np.ascontiguousarray(X, dtype=_np.float64)
+    N, n_dims = X.shape
+    if N == 0:
+        return _np.zeros(0, dtype=_np.int32)
+    # Slightly larger cells keep all neighbors within one cell, despite rounding
+    size = radius * (1 + 1e-9)
+    X_min = X.min(axis=0)
+    cell_index = ((X - X_min) / size).astype(_np.int64)
+    K = int(cell_index[:, 1].max()) + 1
+    L = int(cell_index[:, 0].max()) + 1
+    M = int(cell_index[:, 2].max()) + 1 if n_dims == 3 else 1
+    point_keys = (cell_index[:, 1] * L + cell_index[:, 0]) * M
+    if n_dims == 3:
+        point_keys += cell_index[:, 2]
+    order = _np.argsort(point_keys, kind='mergesort')
+    X = X[order]
+    point_keys = point_keys[order]
+    cell_keys, cell_starts = _np.unique(point_keys, return_index=True)
+    cell_starts = _np.append(cell_starts, N)
+    # Bands of whole cell rows with about equal numbers of points
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    rows = cell_keys // (L * M)
+    row_starts = _np.flatnonzero(_np.diff(rows, prepend=-1))
+    n_bands = min(4 * n_workers, len(row_starts))
+    targets = _np.linspace(0, N, n_bands + 1)[1:-1]
+    band_rows = _np.unique(_np.searchsorted(cell_starts[row_starts], targets))
+    band_starts = _np.unique(_np.concatenate(([0], row_starts[band_rows[band_rows < len(row_starts)]], [len(cell_keys)])))
+    bands = list(zip(band_starts[:-1], band_starts[1:]))
+    r2 = float(radius)**2
+
+    is_core = _np.zeros(N, dtype=_np.bool_)
+    parent = _np.arange(N)
+    with _ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(_dbscan_core, X, cell_keys, cell_starts, L, M, r2, min_samples, c0, c1, is_core)
+              for c0, c1 in bands]
+    for f in fs:
+        f.result()
+    with _ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(_dbscan_union, X, cell_keys, cell_starts, L, M, r2, is_core, c0, c1,
+                              cell_starts[c0], cell_starts[c1], parent) for c0, c1 in bands]
+    for f in fs:
+        f.result()
+    # Merge across band borders: the first row of each band with the last row of the band before
+    for c0, _ in bands[1:]:
+        c1 = _np.searchsorted(rows, rows[c0], side='right')
+        _dbscan_union(X, cell_keys, cell_starts, L, M, r2, is_core, c0, c1, 0, cell_starts[c0], parent)
+
+    # Clusters are numbered in the order of their first core point in the input, as in sklearn
+    labels = _np.full(N, -1, dtype=_np.int32)
+    core = _np.flatnonzero(is_core)
+    roots, core_cluster = _np.unique(_roots(parent, core), return_inverse=True)
+    first_core = _np.full(len(roots), N, dtype=_np.int64)
+    _np.minimum.at(first_core, core_cluster, order[core])
+    rank = _np.empty(len(roots), dtype=_np.int32)
+    rank[_np.argsort(first_core)] = _np.arange(len(roots), dtype=_np.int32)
+    labels[core] = rank[core_cluster]
+    with _ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(_dbscan_border, X, cell_keys, cell_starts, L, M, r2, is_core, c0, c1, labels)
+              for c0, c1 in bands]
+    for f in fs:
+        f.result()
+    unsorted_labels = _np.empty(N, dtype=_np.int32)
+    unsorted_labels[order] = labels
+    return unsorted_labels
+
+
+def dbscan(locs, radius, min_density, pixelsize=None):
+    ''' Clusters locs with DBSCAN. For 3D locs, z is scaled to camera pixels with the pixelsize (nm/px). '''
     print('Identifying clusters...')
     if hasattr(locs, 'z'):
         print('z-coordinates detected')
-        pixelsize = int(input("Enter the pixelsize in nm/px:"))
+        if pixelsize is None:
+            raise ValueError('3D localizations require a pixel size.')
         locs = locs[_np.isfinite(locs.x) & _np.isfinite(locs.y) & _np.isfinite(locs.z)]
         X = _np.vstack((locs.x, locs.y, locs.z/pixelsize)).T
-        db = _DBSCAN(eps=radius, min_samples=min_density).fit(X)
-        group = _np.int32(db.labels_)       # int32 for Origin compatiblity
-        locs = _lib.append_to_rec(locs, group, 'group')
-        locs = locs[locs.group != -1]
-        print('Generating cluster information...')
-        groups = _np.unique(locs.group)
-        n_groups = len(groups)
-        mean_frame = _np.zeros(n_groups)
-        std_frame = _np.zeros(n_groups)
-        com_x = _np.zeros(n_groups)
-        com_y = _np.zeros(n_groups)
-        com_z = _np.zeros(n_groups)
-        std_x = _np.zeros(n_groups)
-        std_y = _np.zeros(n_groups)
-        std_z = _np.zeros(n_groups)
-        convex_hull = _np.zeros(n_groups)
-        volume = _np.zeros(n_groups)
-        n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
-            mean_frame[i] = _np.mean(group_locs.frame)
-            com_x[i] = _np.mean(group_locs.x)
-            com_y[i] = _np.mean(group_locs.y)
-            com_z[i] = _np.mean(group_locs.z)
-            std_frame[i] = _np.std(group_locs.frame)
-            std_x[i] = _np.std(group_locs.x)
-            std_y[i] = _np.std(group_locs.y)
-            std_z[i] = _np.std(group_locs.z)
-            n[i] = len(group_locs)
-            X_group = _np.stack([group_locs.x,group_locs.y,group_locs.z/pixelsize], axis=0).T
-            volume[i] = _np.power((std_x[i]+std_y[i]+(std_z[i]/pixelsize))/3*2,3)*_np.pi*4/3
-            try:
-                hull = ConvexHull(X_group)
-                convex_hull[i] = hull.volume
-            except:
-                convex_hull[i] = 0
+    else:
+        locs = locs[_np.isfinite(locs.x) & _np.isfinite(locs.y)]
+        X = _np.vstack((locs.x, locs.y)).T
+    group = dbscan_labels(X, radius, min_density)       # int32 for Origin compatiblity
+    locs = _lib.append_to_rec(locs, group, 'group')
+    locs = locs[locs.group != -1]
+    print('Generating cluster information...')
+    return cluster_props(locs, pixelsize), locs
+
+
+def cluster_props(locs, pixelsize=None):
+    ''' Properties of the clusters given by locs.group. Locs with z need the pixelsize (nm/px) to scale z. '''
+    segments = GroupSegments(locs.group)
+    groups = segments.ids
+    mean_frame, std_frame = segments.mean_std(locs.frame)
+    com_x, std_x = segments.mean_std(locs.x)
+    com_y, std_y = segments.mean_std(locs.y)
+    n = _np.int32(segments.counts)
+    convex_hull = _np.zeros(len(segments))
+    if hasattr(locs, 'z'):
+        com_z, std_z = segments.mean_std(locs.z)
+        volume = _np.power((std_x + std_y + (std_z / pixelsize)) / 3 * 2, 3) * _np.pi * 4 / 3
+        X = _np.stack([locs.x, locs.y, locs.z / pixelsize], axis=1)
+    else:
+        area = _np.power((std_x + std_y), 2) * _np.pi
+        X = _np.stack([locs.x, locs.y], axis=1)
+    for i, X_group in enumerate(segments.segments(X)):
+        try:
+            hull = ConvexHull(X_group)
+            convex_hull[i] = hull.volume
+        except:
+            convex_hull[i] = 0
+    if hasattr(locs, 'z'):
         clusters = _np.rec.array((groups, convex_hull, volume, mean_frame, com_x, com_y, com_z, std_frame, std_x, std_y, std_z, n),
                                  dtype=[('groups', groups.dtype),('convex_hull', 'f4'),('volume', 'f4'), ('mean_frame', 'f4'), ('com_x', 'f4'), ('com_y', 'f4'),('com_z', 'f4'),
                                  ('std_frame', 'f4'), ('std_x', 'f4'), ('std_y', 'f4'),('std_z', 'f4'),('n', 'i4')])
     else:
-        locs = locs[_np.isfinite(locs.x) & _np.isfinite(locs.y)]
-        X = _np.vstack((locs.x, locs.y)).T
-        db = _DBSCAN(eps=radius, min_samples=min_density).fit(X)
-        group = _np.int32(db.labels_)       # int32 for Origin compatiblity
-        locs = _lib.append_to_rec(locs, group, 'group')
-        locs = locs[locs.group != -1]
-        print('Generating cluster information...')
-        groups = _np.unique(locs.group)
-        n_groups = len(groups)
-        mean_frame = _np.zeros(n_groups)
-        std_frame = _np.zeros(n_groups)
-        com_x = _np.zeros(n_groups)
-        com_y = _np.zeros(n_groups)
-        std_x = _np.zeros(n_groups)
-        std_y = _np.zeros(n_groups)
-        convex_hull = _np.zeros(n_groups)
-        area = _np.zeros(n_groups)
-        n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
-            mean_frame[i] = _np.mean(group_locs.frame)
-            com_x[i] = _np.mean(group_locs.x)
-            com_y[i] = _np.mean(group_locs.y)
-            std_frame[i] = _np.std(group_locs.frame)
-            std_x[i] = _np.std(group_locs.x)
-            std_y[i] = _np.std(group_locs.y)
-            n[i] = len(group_locs)
-            X_group = _np.stack([group_locs.x,group_locs.y], axis=0).T
-            area[i] = _np.power((std_x[i]+std_y[i]),2)*_np.pi
-            try:
-                hull = ConvexHull(X_group)
-                convex_hull[i] = hull.volume
-            except:
-                convex_hull[i] = 0
         clusters = _np.rec.array((groups, convex_hull, area, mean_frame, com_x, com_y, std_frame, std_x, std_y, n),
                                  dtype=[('groups', groups.dtype),('convex_hull', 'f4'),('area', 'f4'), ('mean_frame', 'f4'), ('com_x', 'f4'), ('com_y', 'f4'),
                                  ('std_frame', 'f4'), ('std_x', 'f4'), ('std_y', 'f4'), ('n', 'i4')])
-    return clusters, locs
-
-@_numba.jit(nopython=True, nogil=True)
-def _local_density(locs, radius, x_index, y_index, block_starts, block_ends, start, chunk):
-    x = locs.x
-    y = locs.y
-    N = len(x)
-    r2 = radius**2
-    end = min(start+chunk, N)
-    density = _np.zeros(N, dtype=_np.uint32)
-    for i in range(start, end):
-        yi = y[i]
-        xi = x[i]
-        ki = y_index[i]
-        li = x_index[i]
-        di = 0
-        for k in range(ki-1, ki+2):
-            for l in range(li-1, li+2):
-                j_min = block_starts[k, l]
-                j_max = block_ends[k, l]
-                for j in range(j_min, j_max):
-                    dx2 = (xi - x[j])**2
-                    if dx2 < r2:
-                        dy2 = (yi - y[j])**2
-                        if dy2 < r2:
-                            d2 = dx2 + dy2
-                            if d2 < r2:
-                                di += 1
-        density[i] = di
-    return density
+    return clusters
 
 
 def compute_local_density(locs, info, radius):
-    locs, x_index, y_index, block_starts, block_ends = get_index_blocks(locs, info, radius)
+    index = SpatialIndex(locs, info, radius)
+    locs = index.locs
     N = len(locs)
     n_threads = _multiprocessing.cpu_count()
-    chunk = int(N / n_threads)
-    starts = range(0, N, chunk)
-    args = [(locs, radius, x_index, y_index, block_starts, block_ends, start, chunk) for start in starts]
+    chunk = max(1, int(_np.ceil(N / n_threads)))
     with _ThreadPoolExecutor() as executor:
-        futures = [executor.submit(_local_density, *_) for _ in args]
-    density = _np.sum([future.result() for future in futures], axis=0)
+        futures = [executor.submit(index.count_in_radius, index.x[_:_+chunk], index.y[_:_+chunk], radius)
+                   for _ in range(0, N, chunk)]
+    density = _np.uint32(_np.concatenate([future.result() for future in futures] + [_np.zeros(0)]))
     locs = _lib.remove_from_rec(locs, 'density')
     return _lib.append_to_rec(locs, density, 'density')
 
@@ -396,31 +870,49 @@ def compute_dark_times(locs, group=None):
 
 
 def dark_times(locs, group=None):
+    '''
+    The dark time before each event: the gap to the latest event of the same group that ends before it starts.
+    Events without such an event get -1.
+    '''
     last_frame = locs.frame + locs.len - 1
     if group is None:
         if hasattr(locs, 'group'):
             group = locs.group
         else:
             group = _np.zeros(len(locs))
-    dark = _dark_times(locs, group, last_frame)
+    N = len(locs)
+    if N == 0:
+        return _np.zeros(0, dtype=_np.int32)
+    frame = _np.int64(locs.frame)
+    last_frame = _np.int64(last_frame)
+    # Sort once by group and last frame, then each event finds its predecessor by binary search within its group
+    order = _np.lexsort([last_frame, group])
+    sorted_last_frame = last_frame[order]
+    sorted_group = _np.asarray(group)[order]
+    group_starts = _np.flatnonzero(_np.concatenate([[True], sorted_group[1:] != sorted_group[:-1], [True]]))
+    max_frame = int(locs.frame.max())
+    dark = max_frame * _np.ones(N, dtype=_np.int32)
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    # Contiguous runs of groups with about the same number of events per worker
+    bounds = _np.unique(_np.searchsorted(group_starts, _np.linspace(0, N, n_workers + 1)))
+    with _ThreadPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(_dark_times, frame, sorted_last_frame, order, group_starts, start, end, dark)
+                   for start, end in zip(bounds[:-1], bounds[1:])]
+    for future in futures:
+        future.result()
+    dark[dark == max_frame] = -1
     return dark
 
 
-@_numba.jit(nopython=True)
-def _dark_times(locs, group, last_frame):
-    N = len(locs)
-    max_frame = locs.frame.max()
-    dark = max_frame * _np.ones(len(locs), dtype=_np.int32)
-    for i in range(N):
-        for j in range(N):
-            if (group[i] == group[j]) and (i != j):
-                dark_ij = locs.frame[i] - last_frame[j]
-                if (dark_ij > 0) and (dark_ij < dark[i]):
-                    dark[i] = dark_ij
-    for i in range(N):
-        if dark[i] == max_frame:
-            dark[i] = -1
-    return dark
+@_numba.jit(nopython=True, nogil=True)
+def _dark_times(frame, sorted_last_frame, order, group_starts, start, end, dark):
+    for g in range(start, end):
+        last_frames = sorted_last_frame[group_starts[g]:group_starts[g + 1]]
+        for t in range(group_starts[g], group_starts[g + 1]):
+            i = order[t]
+            k = _np.searchsorted(last_frames, frame[i]) - 1
+            if k >= 0 and frame[i] - last_frames[k] < dark[i]:
+                dark[i] = frame[i] - last_frames[k]
 
 
 def link(locs, info, r_max=0.05, max_dark_time=1, combine_mode='average', remove_ambiguous_lengths=True):
@@ -462,204 +954,204 @@ def weighted_variance(locs):
 #Combine localizations: calculate the properties of the group
 def cluster_combine(locs):
     print('Combining localizations...')
-    combined_locs = []
+    segments = GroupSegments(locs['group'], locs['cluster'])
+    group_id, cluster = segments.ids
+    n = _np.int32(segments.counts)
+    sqrt_n = _np.sqrt(n)
+    mean_frame, std_frame = segments.mean_std(locs.frame)
+    com_x, _ = segments.weighted_mean(locs.x, locs.photons)
+    com_y, _ = segments.weighted_mean(locs.y, locs.photons)
+    #variance_x, variance_y = weighted_variance(cluster_locs)
+    std_x = segments.std(locs.x) / sqrt_n
+    std_y = segments.std(locs.y) / sqrt_n
     if hasattr(locs[0], 'z'):
         print('z-mode')
-        for group in _tqdm(_np.unique(locs['group'])):
-            temp = locs[locs['group']==group]
-            cluster = _np.unique(temp['cluster'])
-            n_cluster = len(cluster)
-            mean_frame = _np.zeros(n_cluster)
-            std_frame = _np.zeros(n_cluster)
-            com_x = _np.zeros(n_cluster)
-            com_y = _np.zeros(n_cluster)
-            com_z = _np.zeros(n_cluster)
-            std_x = _np.zeros(n_cluster)
-            std_y = _np.zeros(n_cluster)
-            std_z = _np.zeros(n_cluster)
-            group_id = _np.zeros(n_cluster)
-            n = _np.zeros(n_cluster, dtype=_np.int32)
-            for i, clusterval in enumerate(cluster):
-                cluster_locs = temp[temp['cluster']== clusterval]
-                mean_frame[i] = _np.mean(cluster_locs.frame)
-                com_x[i] = _np.average(cluster_locs.x,weights = cluster_locs.photons)
-                com_y[i] = _np.average(cluster_locs.y,weights = cluster_locs.photons)
-                com_z[i] = _np.average(cluster_locs.z,weights = cluster_locs.photons)
-                std_frame[i] = _np.std(cluster_locs.frame)
-                #variance_x, variance_y = weighted_variance(cluster_locs)
-                std_x[i] = _np.std(cluster_locs.x)/_np.sqrt(len(cluster_locs))
-                std_y[i] = _np.std(cluster_locs.y)/_np.sqrt(len(cluster_locs))
-                std_z[i] = _np.std(cluster_locs.z)/_np.sqrt(len(cluster_locs))
-                n[i] = len(cluster_locs)
-                group_id[i] = group
-            clusters = _np.rec.array((group_id, cluster, mean_frame, com_x, com_y, com_z, std_frame, std_x, std_y, std_z, n),
-                                     dtype=[('group', group.dtype),('cluster', cluster.dtype), ('mean_frame', 'f4'), ('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
-                                     ('std_frame', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'), ('lpz', 'f4'), ('n', 'i4')])
-            combined_locs.append(clusters)
+        com_z, _ = segments.weighted_mean(locs.z, locs.photons)
+        std_z = segments.std(locs.z) / sqrt_n
+        combined_locs = _np.rec.array((group_id, cluster, mean_frame, com_x, com_y, com_z, std_frame, std_x, std_y, std_z, n),
+                                      dtype=[('group', group_id.dtype),('cluster', cluster.dtype), ('mean_frame', 'f4'), ('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
+                                      ('std_frame', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'), ('lpz', 'f4'), ('n', 'i4')])
     else:
-        for group in _tqdm(_np.unique(locs['group'])):
-            temp = locs[locs['group']==group]
-            cluster = _np.unique(temp['cluster'])
-            n_cluster = len(cluster)
-            mean_frame = _np.zeros(n_cluster)
-            std_frame = _np.zeros(n_cluster)
-            com_x = _np.zeros(n_cluster)
-            com_y = _np.zeros(n_cluster)
-            std_x = _np.zeros(n_cluster)
-            std_y = _np.zeros(n_cluster)
-            group_id = _np.zeros(n_cluster)
-            n = _np.zeros(n_cluster, dtype=_np.int32)
-            for i, clusterval in enumerate(cluster):
-                cluster_locs = temp[temp['cluster']== clusterval]
-                mean_frame[i] = _np.mean(cluster_locs.frame)
-                com_x[i] = _np.average(cluster_locs.x,weights = cluster_locs.photons)
-                com_y[i] = _np.average(cluster_locs.y,weights = cluster_locs.photons)
-                std_frame[i] = _np.std(cluster_locs.frame)
-                #variance_x, variance_y = weighted_variance(cluster_locs)
-                std_x[i] = _np.std(cluster_locs.x)/_np.sqrt(len(cluster_locs))
-                std_y[i] = _np.std(cluster_locs.y)/_np.sqrt(len(cluster_locs))
-                n[i] = len(cluster_locs)
-                group_id[i] = group
-            clusters = _np.rec.array((group_id, cluster, mean_frame, com_x, com_y, std_frame, std_x, std_y, n),
-                                     dtype=[('group', group.dtype),('cluster', cluster.dtype), ('mean_frame', 'f4'), ('x', 'f4'), ('y', 'f4'),
-                                     ('std_frame', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'), ('n', 'i4')])
-            combined_locs.append(clusters)
-
-    combined_locs = stack_arrays(combined_locs, asrecarray=True, usemask=False)
-
+        combined_locs = _np.rec.array((group_id, cluster, mean_frame, com_x, com_y, std_frame, std_x, std_y, n),
+                                      dtype=[('group', group_id.dtype),('cluster', cluster.dtype), ('mean_frame', 'f4'), ('x', 'f4'), ('y', 'f4'),
+                                      ('std_frame', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'), ('n', 'i4')])
     return combined_locs
 
 
-def cluster_combine_dist(locs):
+def nearest_neighbors(points, k=1, groups=None, exclude_duplicates=False):
+    '''
+    Distances and indices of the k nearest other points of each point (points has shape (N, dimensions)),
+    sorted by distance, from a KD-tree. The arrays have shape (N, k).
+    With groups, only points of the same group are neighbors. With exclude_duplicates, points at the same
+    position are not neighbors. Missing neighbors have distance inf and index N.
+    '''
+    points = _np.asarray(points, dtype=_np.float64)
+    N = len(points)
+    if N == 0:
+        return _np.zeros((0, k)), _np.zeros((0, k), dtype=_np.int64)
+    if groups is not None:
+        # Groups are stacked along an extra axis, further apart than any two points of a group
+        spacing = 2 * _np.sqrt(_np.sum((points.max(axis=0) - points.min(axis=0))**2)) + 1
+        group_rank = _np.unique(groups, return_inverse=True)[1].ravel()
+        points = _np.column_stack((points, spacing * group_rank))
+    tree = _cKDTree(points)
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    chunks = _np.array_split(_np.arange(N), max(1, min(4 * n_workers, N // 1000)))
+    if exclude_duplicates:
+        # All points at the position of a point come first, followed by at least k others
+        n_query = k + _np.unique(points, axis=0, return_counts=True)[1].max()
+    else:
+        # The point itself is among the k + 1 nearest, unless k or more points share its position
+        n_query = k + 1
+    with _ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(tree.query, points[_], n_query) for _ in chunks]
+    distances = _np.concatenate([_.result()[0] for _ in fs]).reshape(N, n_query)
+    indices = _np.concatenate([_.result()[1] for _ in fs]).reshape(N, n_query)
+    if exclude_duplicates:
+        neighbors = _np.argsort(distances == 0, axis=1, kind='mergesort')[:, :k]
+        distances = _np.take_along_axis(distances, neighbors, axis=1)
+        indices = _np.take_along_axis(indices, neighbors, axis=1)
+    else:
+        is_self = indices == _np.arange(N)[:, _np.newaxis]
+        is_self[~is_self.any(axis=1), -1] = True
+        distances = distances[~is_self].reshape(N, k)
+        indices = indices[~is_self].reshape(N, k)
+    if groups is not None:
+        other_group = distances >= spacing
+        distances[other_group] = _np.inf
+        indices[other_group] = N
+    return distances, indices
+
+
+def cluster_combine_dist(locs, pixelsize=None):
+    '''
+    Adds the distance of each combined cluster to the nearest other cluster of its group.
+    3D clusters (with z in nm) also get the nearest distance in xy, and need the pixelsize (nm/px) to scale z.
+    Clusters without a neighbor get inf.
+    '''
     print('Calculating distances...')
-
+    order = _np.lexsort((locs['cluster'], locs['group']))
+    locs = locs[order]
     if hasattr(locs, 'z'):
         print('XYZ')
-        pixelsize = int(input("Enter the pixelsize in nm/px:"))
-
-        combined_locs = []
-        for group in _tqdm(_np.unique(locs['group'])):
-            temp = locs[locs['group']==group]
-            cluster = _np.unique(temp['cluster'])
-            n_cluster = len(cluster)
-            mean_frame = temp['mean_frame']
-            std_frame = temp['std_frame']
-            com_x = temp['x']
-            com_y = temp['y']
-            com_z = temp['z']
-            std_x = temp['lpx']
-            std_y = temp['lpy']
-            std_z = temp['lpz']
-            group_id = temp['group']
-            n = temp['n']
-            min_dist = _np.zeros(n_cluster)
-            min_distz = _np.zeros(n_cluster)
-            for i, clusterval in enumerate(cluster):
-                #find nearest neighbor in xyz
-                group_locs = temp[temp['cluster']!= clusterval]
-                cluster_locs = temp[temp['cluster']== clusterval]
-                ref_point = _np.array([cluster_locs.x, cluster_locs.y, cluster_locs.z/pixelsize])
-                all_points = _np.array([group_locs.x, group_locs.y, group_locs.z/pixelsize])
-                distances = distance.cdist(ref_point.transpose(), all_points.transpose())
-                min_dist[i] = _np.amin(distances)
-                #find nearest neighbor in xy 
-
-                ref_point_xy = _np.array([cluster_locs.x, cluster_locs.y])
-                all_points_xy = _np.array([group_locs.x, group_locs.y])
-                distances_xy = distance.cdist(ref_point_xy.transpose(), all_points_xy.transpose())
-                min_dist_xy[i] = _np.amin(distances_xy)
-
-            clusters = _np.rec.array((group_id, cluster, mean_frame, com_x, com_y, com_z, std_frame, std_x, std_y, std_z, n, min_dist, min_dist_xy),
-                                     dtype=[('group', group.dtype),('cluster', cluster.dtype), ('mean_frame', 'f4'), ('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
-                                     ('std_frame', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'), ('lpz', 'f4'), ('n', 'i4'), ('min_dist', 'f4'), ('mind_dist_xy', 'f4')])
-            combined_locs.append(clusters)
-
+        if pixelsize is None:
+            raise ValueError('3D localizations require a pixel size.')
+        min_dist = nearest_neighbors(_np.stack((locs.x, locs.y, locs.z / pixelsize), axis=1), groups=locs.group)[0][:, 0]
+        min_dist_xy = nearest_neighbors(_np.stack((locs.x, locs.y), axis=1), groups=locs.group)[0][:, 0]
+        combined_locs = _np.rec.array((locs.group, locs.cluster, locs.mean_frame, locs.x, locs.y, locs.z, locs.std_frame,
+                                       locs.lpx, locs.lpy, locs.lpz, locs.n, min_dist, min_dist_xy),
+                                      dtype=[('group', locs.group.dtype),('cluster', locs.cluster.dtype), ('mean_frame', 'f4'), ('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
+                                      ('std_frame', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'), ('lpz', 'f4'), ('n', 'i4'), ('min_dist', 'f4'), ('mind_dist_xy', 'f4')])
     else: #2D Case
         print('XY')
-        combined_locs = []
-        for group in _tqdm(_np.unique(locs['group'])):
-            temp = locs[locs['group']==group]
-            cluster = _np.unique(temp['cluster'])
-            n_cluster = len(cluster)
-            mean_frame = temp['mean_frame']
-            std_frame = temp['std_frame']
-            com_x = temp['x']
-            com_y = temp['y']
-            std_x = temp['lpx']
-            std_y = temp['lpy']
-            group_id = temp['group']
-            n = temp['n']
-            min_dist = _np.zeros(n_cluster)
-
-            for i, clusterval in enumerate(cluster):
-                #find nearest neighbor in xyz
-                group_locs = temp[temp['cluster']!= clusterval]
-                cluster_locs = temp[temp['cluster']== clusterval]
-                ref_point_xy = _np.array([cluster_locs.x, cluster_locs.y])
-                all_points_xy = _np.array([group_locs.x, group_locs.y])
-                distances_xy = distance.cdist(ref_point_xy.transpose(), all_points_xy.transpose())
-                min_dist[i] = _np.amin(distances_xy)
-
-            clusters = _np.rec.array((group_id, cluster, mean_frame, com_x, com_y, std_frame, std_x, std_y, n, min_dist),
-                                     dtype=[('group', group.dtype),('cluster', cluster.dtype), ('mean_frame', 'f4'), ('x', 'f4'), ('y', 'f4'),
-                                     ('std_frame', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'), ('n', 'i4'), ('min_dist', 'f4')])
-            combined_locs.append(clusters)
-
-    combined_locs = stack_arrays(combined_locs, asrecarray=True, usemask=False)
+        min_dist = nearest_neighbors(_np.stack((locs.x, locs.y), axis=1), groups=locs.group)[0][:, 0]
+        combined_locs = _np.rec.array((locs.group, locs.cluster, locs.mean_frame, locs.x, locs.y, locs.std_frame,
+                                       locs.lpx, locs.lpy, locs.n, min_dist),
+                                      dtype=[('group', locs.group.dtype),('cluster', locs.cluster.dtype), ('mean_frame', 'f4'), ('x', 'f4'), ('y', 'f4'),
+                                      ('std_frame', 'f4'), ('lpx', 'f4'), ('lpy', 'f4'), ('n', 'i4'), ('min_dist', 'f4')])
     return combined_locs
 
 
+def get_link_groups(locs, d_max, max_dark_time, group):
+    '''
+    Assumes that locs are sorted by frame. Each loc is linked to the first unlinked loc (in frame order)
+    of the same group within d_max in the next max_dark_time + 1 frames.
+    Locs of each frame and group are hashed into a grid of cell size d_max, and groups are linked in parallel.
+    '''
+    N = len(locs)
+    if N == 0:
+        return _np.zeros(0, dtype=_np.int32)
+    frame = _np.ascontiguousarray(locs.frame).astype(_np.int64)
+    x = _np.ascontiguousarray(locs.x)
+    y = _np.ascontiguousarray(locs.y)
+    _, group_rank = _np.unique(group, return_inverse=True)
+    group_rank = group_rank.astype(_np.int64)
+    # Slightly larger than d_max, so that rounding cannot put locs at distance d_max two cells apart
+    cell_size = d_max * (1 + 1e-9) if d_max > 0 else 1.0
+    # Offset by one so that the neighbour cells of all locs have non-negative coordinates
+    x_64 = x.astype(_np.float64)
+    y_64 = y.astype(_np.float64)
+    cell_x = _np.int64(_np.floor((x_64 - x_64.min()) / cell_size)) + 1
+    cell_y = _np.int64(_np.floor((y_64 - y_64.min()) / cell_size)) + 1
+    n_cells_x = int(cell_x.max()) + 2
+    cell = cell_y * n_cells_x + cell_x
+    # The hash: locs sorted by group, frame and cell (and by index within a cell)
+    hash_order = _np.lexsort([cell, frame, group_rank])
+    n_frames = int(frame.max()) + 1
+    hash_key = group_rank[hash_order] * n_frames + frame[hash_order]
+    hash_cell = cell[hash_order]
+    # The locs of each group in frame order, for the parallel groups
+    partition_order = _np.argsort(group_rank, kind='mergesort')
+    partition_starts = _np.searchsorted(group_rank[partition_order], _np.arange(group_rank.max() + 2))
+    link_group = -_np.ones(N, dtype=_np.int64)
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    # Contiguous runs of groups with about the same number of locs per worker
+    bounds = _np.searchsorted(partition_starts, _np.linspace(0, N, n_workers + 1)[1:-1])
+    bounds = _np.unique(_np.concatenate([[0], bounds, [len(partition_starts) - 1]]))
+    args = (frame, x, y, group_rank, cell, n_cells_x, n_frames, d_max, max_dark_time,
+            hash_order, hash_key, hash_cell, partition_order, partition_starts, link_group)
+    with _ThreadPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(_link_partitions, *args, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+    for future in futures:
+        future.result()
+    # link_group holds the first loc of each link group. Number link groups in the order of their first loc.
+    first_locs, link_group = _np.unique(link_group, return_inverse=True)
+    return link_group.astype(_np.int32)
 
 
-
-@_numba.jit(nopython=True)
-def get_link_groups(locs, d_max, max_dark_time, group):
-    ''' Assumes that locs are sorted by frame '''
-    frame = locs.frame
-    x = locs.x
-    y = locs.y
-    N = len(x)
-    link_group = -_np.ones(N, dtype=_np.int32)
-    current_link_group = -1
-    for i in range(N):
-        if link_group[i] == -1:  # loc has no group yet
-            current_link_group += 1
-            link_group[i] = current_link_group
-            current_index = i
-            next_loc_index_in_group = _get_next_loc_index_in_link_group(current_index, link_group, N, frame, x, y, d_max, max_dark_time, group)
-            while next_loc_index_in_group != -1:
-                link_group[next_loc_index_in_group] = current_link_group
-                current_index = next_loc_index_in_group
-                next_loc_index_in_group = _get_next_loc_index_in_link_group(current_index, link_group, N, frame, x, y, d_max, max_dark_time, group)
-    return link_group
+@_numba.jit(nopython=True, nogil=True)
+def _link_partitions(frame, x, y, group_rank, cell, n_cells_x, n_frames, d_max, max_dark_time,
+                     hash_order, hash_key, hash_cell, partition_order, partition_starts, link_group, start, end):
+    ''' Links the locs of groups start to end. Each loc is labeled with the index of its link group's first loc. '''
+    for p in range(start, end):
+        for t in range(partition_starts[p], partition_starts[p + 1]):
+            i = partition_order[t]
+            if link_group[i] == -1:
+                link_group[i] = i
+                current_index = i
+                next_index = _get_next_loc_index_in_link_group(current_index, frame, x, y, group_rank, cell, n_cells_x,
+                                                               n_frames, d_max, max_dark_time, hash_order, hash_key,
+                                                               hash_cell, link_group)
+                while next_index != -1:
+                    link_group[next_index] = i
+                    current_index = next_index
+                    next_index = _get_next_loc_index_in_link_group(current_index, frame, x, y, group_rank, cell,
+                                                                   n_cells_x, n_frames, d_max, max_dark_time,
+                                                                   hash_order, hash_key, hash_cell, link_group)
 
 
-@_numba.jit(nopython=True)
-def _get_next_loc_index_in_link_group(current_index, link_group, N, frame, x, y, d_max, max_dark_time, group):
-    current_frame = frame[current_index]
+@_numba.jit(nopython=True, nogil=True)
+def _get_next_loc_index_in_link_group(current_index, frame, x, y, group_rank, cell, n_cells_x, n_frames, d_max,
+                                      max_dark_time, hash_order, hash_key, hash_cell, link_group):
     current_x = x[current_index]
     current_y = y[current_index]
-    current_group = group[current_index]
-    min_frame = current_frame + 1
-    for min_index in range(current_index + 1, N):
-        if frame[min_index] >= min_frame:
-            break
-    max_frame = current_frame + max_dark_time + 1
-    for max_index in range(min_index, N):
-        if frame[max_index] > max_frame:
-            break
-    else:
-        max_index = N
+    current_cell = cell[current_index]
     d_max_2 = d_max**2
-    for j in range(min_index, max_index):
-        if group[j] == current_group:
-            if link_group[j] == -1:
-                dx2 = (current_x - x[j])**2
-                if dx2 <= d_max_2:
-                    dy2 = (current_y - y[j])**2
-                    if dy2 <= d_max_2:
-                        if _np.sqrt(dx2 + dy2) <= d_max:
-                            return j
+    for next_frame in range(frame[current_index] + 1, min(frame[current_index] + max_dark_time + 2, n_frames)):
+        key = group_rank[current_index] * n_frames + next_frame
+        lo = _np.searchsorted(hash_key, key)
+        hi = _np.searchsorted(hash_key, key, side='right')
+        if lo == hi:
+            continue
+        cells = hash_cell[lo:hi]
+        best = -1
+        for dy in range(-1, 2):
+            for dx in range(-1, 2):
+                c = current_cell + dy * n_cells_x + dx
+                for h in range(lo + _np.searchsorted(cells, c), lo + _np.searchsorted(cells, c, side='right')):
+                    j = hash_order[h]
+                    if best != -1 and j > best:
+                        break
+                    if link_group[j] == -1:
+                        dx2 = (current_x - x[j])**2
+                        if dx2 <= d_max_2:
+                            dy2 = (current_y - y[j])**2
+                            if dy2 <= d_max_2:
+                                if _np.sqrt(dx2 + dy2) <= d_max:
+                                    best = j
+                                    break
+        if best != -1:
+            return best
     return -1
 
 
@@ -786,8 +1278,8 @@ def localization_precision(photons, s, bg, em):
 def undrift(locs, info, segmentation, display=True, segmentation_callback=None, rcc_callback=None):
     bounds, segments = _render.segment(locs, info, segmentation,
                                        {'blur_method': 'gaussian', 'min_blur_width': 1},
-                                       segmentation_callback)
-    shift_y, shift_x = _imageprocess.rcc(segments, 32, rcc_callback)
+                                       segmentation_callback, stream=True)
+    shift_y, shift_x = _imageprocess.rcc(segments, 32, rcc_callback, n_segments=len(bounds) - 1)
     t = (bounds[1:] + bounds[:-1]) / 2
     drift_x_pol = _interpolate.InterpolatedUnivariateSpline(t, shift_x, k=3)
     drift_y_pol = _interpolate.InterpolatedUnivariateSpline(t, shift_y, k=3)
@@ -837,23 +1329,20 @@ def groupprops(locs, callback=None):
         locs = locs[locs.dark != -1]
     except AttributeError:
         pass
-    group_ids = _np.unique(locs.group)
-    n = len(group_ids)
+    segments = GroupSegments(locs.group)
+    n = len(segments)
     n_cols = len(locs.dtype)
     names = ['group', 'n_events'] + list(_itertools.chain(*[(_ + '_mean', _ + '_std') for _ in locs.dtype.names]))
     formats = ['i4', 'i4'] + 2 * n_cols * ['f4']
     groups = _np.recarray(n, formats=formats, names=names)
     if callback is not None:
         callback(0)
-    for i, group_id in enumerate(_tqdm(group_ids, desc='Calculating group statistics', unit='Groups')):
-        group_locs = locs[locs.group == group_id]
-        groups['group'][i] = group_id
-        groups['n_events'][i] = len(group_locs)
-        for name in locs.dtype.names:
-            groups[name + '_mean'][i] = _np.mean(group_locs[name])
-            groups[name + '_std'][i] = _np.std(group_locs[name])
-        if callback is not None:
-            callback(i+1)
+    groups['group'] = segments.ids
+    groups['n_events'] = segments.counts
+    for name in _tqdm(locs.dtype.names, desc='Calculating group statistics', unit='Columns'):
+        groups[name + '_mean'], groups[name + '_std'] = segments.mean_std(locs[name])
+    if callback is not None:
+        callback(n)
     return groups
 
 #FRET functions
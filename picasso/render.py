@@ -11,9 +11,19 @@ import numpy as _np
 import numba as _numba
 import scipy.signal as _signal
 from tqdm import trange as _trange
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+import multiprocessing as _multiprocessing
+from collections import OrderedDict as _OrderedDict
+import threading as _threading
 
 
 _DRAW_MAX_SIGMA = 3
+# Render in a single thread below this number of locs per band of rows
+_MIN_LOCS_PER_BAND = 1000
+# Tile pyramid: tile edge in pixels, finest level (oversampling 2**level) and memory bound
+TILE_SIZE = 256
+TILE_MAX_LEVEL = 5
+TILE_CACHE_BYTES = 2**28
 
 
 def render(locs, info=None, oversampling=1, viewport=None, blur_method=None, min_blur_width=0):
@@ -118,59 +128,111 @@ def render_hist3d(locs, oversampling, y_min, x_min, y_max, x_max, z_min, z_max,
     _fill3d(image, x, y, z)
     return len(x), image
 
-@_numba.jit(nopython=True, nogil=True)
 def render_gaussian(locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width):
     image, n_pixel_y, n_pixel_x, x, y, in_view = _render_setup(locs, oversampling, y_min, x_min, y_max, x_max)
     blur_width = oversampling * _np.maximum(locs.lpx, min_blur_width)
     blur_height = oversampling * _np.maximum(locs.lpy, min_blur_width)
     sy = blur_height[in_view]
     sx = blur_width[in_view]
-    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
-        max_y = _DRAW_MAX_SIGMA * sy_
-        i_min = _np.int32(y_ - max_y)
-        if i_min < 0:
-            i_min = 0
-        i_max = _np.int32(y_ + max_y + 1)
-        if i_max > n_pixel_y:
-            i_max = n_pixel_y
-        max_x = _DRAW_MAX_SIGMA * sx_
-        j_min = _np.int32(x_ - max_x)
-        if j_min < 0:
-            j_min = 0
-        j_max = _np.int32(x_ + max_x) + 1
-        if j_max > n_pixel_x:
-            j_max = n_pixel_x
-        for i in range(i_min, i_max):
-            for j in range(j_min, j_max):
-                image[i, j] += _np.exp(-((j - x_ + 0.5)**2/(2 * sx_**2) + (i - y_ + 0.5)**2/(2 * sy_**2))) / (2 * _np.pi * sx_ * sy_)
+    _draw_gaussians(image, x, y, sx, sy)
     return len(x), image
 
-@_numba.jit(nopython=True, nogil=True)
+
 def render_gaussian_iso(locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width):
     image, n_pixel_y, n_pixel_x, x, y, in_view = _render_setup(locs, oversampling, y_min, x_min, y_max, x_max)
     blur_width = oversampling * _np.maximum(locs.lpx, min_blur_width)
     blur_height = oversampling * _np.maximum(locs.lpy, min_blur_width)
     sy = (blur_height[in_view] + blur_width[in_view])/2
     sx = sy
-    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
+    _draw_gaussians(image, x, y, sx, sy)
+    return len(x), image
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _gaussian_rows(y, sy, n_pixel_y):
+    ''' First and last + 1 image row of each Gaussian '''
+    i_min = _np.empty(len(y), dtype=_np.int32)
+    i_max = _np.empty(len(y), dtype=_np.int32)
+    for k in range(len(y)):
+        max_y = _DRAW_MAX_SIGMA * sy[k]
+        i_min[k] = max(_np.int32(y[k] - max_y), 0)
+        i_max[k] = min(_np.int32(y[k] + max_y + 1), n_pixel_y)
+    return i_min, i_max
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _band_members(i_min, i_max, band_height, n_bands):
+    ''' Indices of the Gaussians that reach into each band of rows, in their original order '''
+    starts = _np.zeros(n_bands + 1, dtype=_np.int64)
+    for k in range(len(i_min)):
+        if i_max[k] > i_min[k]:
+            for b in range(i_min[k] // band_height, (i_max[k] - 1) // band_height + 1):
+                starts[b + 1] += 1
+    for b in range(n_bands):
+        starts[b + 1] += starts[b]
+    position = starts[:-1].copy()
+    members = _np.empty(starts[-1], dtype=_np.int64)
+    for k in range(len(i_min)):
+        if i_max[k] > i_min[k]:
+            for b in range(i_min[k] // band_height, (i_max[k] - 1) // band_height + 1):
+                members[position[b]] = k
+                position[b] += 1
+    return members, starts
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _draw_gaussians_in_rows(image, x, y, sx, sy, members, row_start, row_end):
+    ''' Adds the Gaussians members to the rows row_start to row_end of image, as outer products of 1D kernels '''
+    n_pixel_x = image.shape[1]
+    max_width = 1
+    for k in members:
+        max_width = max(max_width, int(2 * _DRAW_MAX_SIGMA * max(sx[k], sy[k])) + 3)
+    gx = _np.empty(max_width)
+    gy = _np.empty(max_width)
+    for k in members:
+        x_ = x[k]
+        y_ = y[k]
+        sx_ = sx[k]
+        sy_ = sy[k]
         max_y = _DRAW_MAX_SIGMA * sy_
-        i_min = _np.int32(y_ - max_y)
-        if i_min < 0:
-            i_min = 0
-        i_max = _np.int32(y_ + max_y + 1)
-        if i_max > n_pixel_y:
-            i_max = n_pixel_y
+        i_min = max(_np.int32(y_ - max_y), row_start)
+        i_max = min(_np.int32(y_ + max_y + 1), row_end)
         max_x = _DRAW_MAX_SIGMA * sx_
-        j_min = _np.int32(x_ - max_x)
-        if j_min < 0:
-            j_min = 0
-        j_max = _np.int32(x_ + max_x) + 1
-        if j_max > n_pixel_x:
-            j_max = n_pixel_x
+        j_min = max(_np.int32(x_ - max_x), 0)
+        j_max = min(_np.int32(x_ + max_x) + 1, n_pixel_x)
+        norm = 1 / (2 * _np.pi * sx_ * sy_)
+        for j in range(j_min, j_max):
+            gx[j - j_min] = _np.exp(-(j - x_ + 0.5)**2/(2 * sx_**2))
+        for i in range(i_min, i_max):
+            gy[i - i_min] = norm * _np.exp(-(i - y_ + 0.5)**2/(2 * sy_**2))
         for i in range(i_min, i_max):
+            gy_ = gy[i - i_min]
             for j in range(j_min, j_max):
-                image[i, j] += _np.exp(-((j - x_ + 0.5)**2/(2 * sx_**2) + (i - y_ + 0.5)**2/(2 * sy_**2))) / (2 * _np.pi * sx_ * sy_)
-    return len(x), image
+                image[i, j] += gy_ * gx[j - j_min]
+
+
+def _draw_gaussians(image, x, y, sx, sy):
+    '''
+    Adds Gaussians with centers (x, y) and widths (sx, sy) to image, up to _DRAW_MAX_SIGMA.
+    The image is split into bands of rows that threads draw independently.
+    '''
+    n_pixel_y = image.shape[0]
+    if len(x) == 0 or n_pixel_y == 0:
+        return
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    n_bands = max(1, min(4 * n_workers, n_pixel_y, len(x) // _MIN_LOCS_PER_BAND))
+    band_height = int(_np.ceil(n_pixel_y / n_bands))
+    n_bands = int(_np.ceil(n_pixel_y / band_height))
+    i_min, i_max = _gaussian_rows(y, sy, n_pixel_y)
+    members, starts = _band_members(i_min, i_max, band_height, n_bands)
+    if n_bands == 1:
+        _draw_gaussians_in_rows(image, x, y, sx, sy, members, 0, n_pixel_y)
+        return
+    with _ThreadPoolExecutor(n_workers) as executor:
+        fs = [executor.submit(_draw_gaussians_in_rows, image, x, y, sx, sy, members[starts[b]:starts[b + 1]],
+                              b * band_height, min((b + 1) * band_height, n_pixel_y)) for b in range(n_bands)]
+    for f in fs:
+        f.result()
 
 
 def render_convolve(locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width):
@@ -205,21 +267,258 @@ def _fftconvolve(image, blur_width, blur_height):
     return _signal.fftconvolve(image, kernel, mode='same')
 
 
-def segment(locs, info, segmentation, kwargs={}, callback=None):
-    Y = info[0]['Height']
-    X = info[0]['Width']
+@_numba.jit(nopython=True, nogil=True)
+def _morton_code(tx, ty, n_bits):
+    ''' Interleaves the bits of the tile indices tx and ty '''
+    code = 0
+    for b in range(n_bits):
+        code |= ((tx >> b) & 1) << (2 * b)
+        code |= ((ty >> b) & 1) << (2 * b + 1)
+    return code
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _tile_codes(x, y, x_origin, y_origin, scale, tile_size, n_bits):
+    ''' Morton codes of the tiles at oversampling scale that contain the locs '''
+    codes = _np.empty(len(x), dtype=_np.int64)
+    for k in range(len(x)):
+        tx = _np.int64(_np.floor(scale * (x[k] - x_origin))) // tile_size
+        ty = _np.int64(_np.floor(scale * (y[k] - y_origin))) // tile_size
+        codes[k] = _morton_code(tx, ty, n_bits)
+    return codes
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _fill_tile(tile, x, y, x_origin, y_origin, scale, j0, i0):
+    ''' Histograms the locs into tile, whose first pixel is (i0, j0) at oversampling scale '''
+    n_i, n_j = tile.shape
+    for k in range(len(x)):
+        i = _np.int64(_np.floor(scale * (y[k] - y_origin))) - i0
+        j = _np.int64(_np.floor(scale * (x[k] - x_origin))) - j0
+        if 0 <= i < n_i and 0 <= j < n_j:
+            tile[i, j] += 1
+
+
+class TileCache:
+    '''
+    A pyramid of histogram tiles of locs at oversamplings 2**level, for levels up to max_level.
+    On first use, the locs are sorted by the Morton code of their finest tile, so that the locs
+    of any tile are a contiguous range. Tiles are rendered on first use and the least recently
+    used ones are dropped when the tiles take more than max_bytes.
+    Tiles are served only when the viewport lies on the pixel grid of a pyramid level; other
+    views are rendered with render_hist from the locs of the covering tiles.
+    A cache can be shared by threads.
+    '''
+
+    def __init__(self, locs, tile_size=TILE_SIZE, max_level=TILE_MAX_LEVEL, max_bytes=TILE_CACHE_BYTES):
+        self.locs = locs
+        self.tile_size = tile_size
+        self.max_level = max_level
+        self.max_bytes = max_bytes
+        self.codes = None
+        self.tiles = _OrderedDict()
+        self.n_bytes = 0
+        self._lock = _threading.RLock()
+
+    def _index(self):
+        ''' Sorts the locs by tile '''
+        with self._lock:
+            if self.codes is None:
+                self._sort()
+
+    def _sort(self):
+        locs = self.locs
+        max_level = self.max_level
+        tile_size = self.tile_size
+        if len(locs):
+            self.x_origin = min(0, float(_np.floor(locs.x.min())))
+            self.y_origin = min(0, float(_np.floor(locs.y.min())))
+            n_tiles = 2**max_level * max(locs.x.max() - self.x_origin, locs.y.max() - self.y_origin) / tile_size
+        else:
+            self.x_origin = self.y_origin = 0.0
+            n_tiles = 1
+        self.n_bits = int(_np.ceil(_np.log2(n_tiles + 1)))
+        if 2 * self.n_bits > 62:
+            raise ValueError('Localizations span too many tiles.')
+        codes = _tile_codes(locs.x, locs.y, self.x_origin, self.y_origin, 2.0**max_level, tile_size, self.n_bits)
+        order = _np.argsort(codes)
+        self.codes = codes[order]
+        self.x = _np.ascontiguousarray(locs.x[order])
+        self.y = _np.ascontiguousarray(locs.y[order])
+
+    def _render_tile(self, key):
+        ''' The histogram of tile (level, ty, tx), or None if it has no locs '''
+        level, ty, tx = key
+        if (max(tx, ty) << (self.max_level - level)) >> self.n_bits:
+            # Beyond the locs, where the Morton code would wrap around
+            return None
+        shift = 2 * (self.max_level - level)
+        code = _morton_code(tx, ty, self.n_bits) << shift
+        start, end = _np.searchsorted(self.codes, [code, code + (1 << shift)])
+        if start == end:
+            return None
+        tile = _np.zeros((self.tile_size, self.tile_size), dtype=_np.float32)
+        _fill_tile(tile, self.x[start:end], self.y[start:end], self.x_origin, self.y_origin,
+                   2.0**level, tx * self.tile_size, ty * self.tile_size)
+        return tile
+
+    def get_tiles(self, keys):
+        ''' The tiles of keys (level, ty, tx), rendering the missing ones in parallel '''
+        with self._lock:
+            return self._get_tiles(keys)
+
+    def _get_tiles(self, keys):
+        self._index()
+        missing = [key for key in keys if key not in self.tiles]
+        n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+        if len(missing) > 1 and n_workers > 1:
+            with _ThreadPoolExecutor(n_workers) as executor:
+                rendered = list(executor.map(self._render_tile, missing))
+        else:
+            rendered = [self._render_tile(key) for key in missing]
+        tiles = {key: self.tiles[key] for key in keys if key in self.tiles}
+        tiles.update(zip(missing, rendered))
+        for key in keys:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+            else:
+                self.tiles[key] = tiles[key]
+                if tiles[key] is not None:
+                    self.n_bytes += tiles[key].nbytes
+        while self.n_bytes > self.max_bytes and len(self.tiles) > 1:
+            tile = self.tiles.popitem(last=False)[1]
+            if tile is not None:
+                self.n_bytes -= tile.nbytes
+        return [tiles[key] for key in keys]
+
+    def _tile_keys(self, level, viewport):
+        ''' The keys (level, ty, tx) of the tiles that hold locs and overlap the viewport '''
+        (y_min, x_min), (y_max, x_max) = viewport
+        scale = 2.0**level
+        i_min = max(int(_np.floor(scale * (y_min - self.y_origin))), 0)
+        j_min = max(int(_np.floor(scale * (x_min - self.x_origin))), 0)
+        i_max = int(_np.ceil(scale * (y_max - self.y_origin)))
+        j_max = int(_np.ceil(scale * (x_max - self.x_origin)))
+        # Tiles beyond the locs, where the Morton code would wrap around, are left out
+        n_tiles = (((1 << self.n_bits) - 1) >> (self.max_level - level)) + 1
+        T = self.tile_size
+        tiles_y = range(i_min // T, min((i_max - 1) // T + 1, n_tiles))
+        tiles_x = range(j_min // T, min((j_max - 1) // T + 1, n_tiles))
+        return [(level, ty, tx) for ty in tiles_y for tx in tiles_x]
+
+    def _locs_in_tiles(self, keys):
+        ''' x and y of the locs in the tiles of keys, from the contiguous ranges of the sorted locs '''
+        starts = []
+        ends = []
+        for level, ty, tx in keys:
+            shift = 2 * (self.max_level - level)
+            code = _morton_code(tx, ty, self.n_bits) << shift
+            start, end = _np.searchsorted(self.codes, [code, code + (1 << shift)])
+            if start < end:
+                starts.append(start)
+                ends.append(end)
+        order = _np.argsort(starts)
+        x = _np.concatenate([self.x[:0]] + [self.x[starts[_]:ends[_]] for _ in order])
+        y = _np.concatenate([self.y[:0]] + [self.y[starts[_]:ends[_]] for _ in order])
+        return x, y
+
+    def _is_aligned(self, level, oversampling, viewport):
+        ''' Whether the image pixels of oversampling and viewport are the tile pixels of level '''
+        if not 0 <= level <= self.max_level or oversampling != 2.0**level:
+            return False
+        (y_min, x_min), (y_max, x_max) = viewport
+        edges = oversampling * (_np.array([y_min, y_max, x_min, x_max]) -
+                                [self.y_origin, self.y_origin, self.x_origin, self.x_origin])
+        return bool(_np.all(edges == _np.round(edges)))
+
+    def render(self, oversampling, viewport):
+        '''
+        Returns the number of locs and the histogram of the viewport, equal to render_hist.
+        If oversampling is a level of the pyramid and the viewport is on its pixel grid, the image is
+        composited from the cached tiles. Otherwise only the locs of the tiles that overlap the viewport
+        are histogrammed, which are contiguous in the sorted locs.
+        '''
+        (y_min, x_min), (y_max, x_max) = viewport
+        self._index()
+        level = int(_np.ceil(_np.log2(oversampling) - 1e-9))
+        keys = self._tile_keys(min(max(level, 0), self.max_level), viewport)
+        x, y = self._locs_in_tiles(keys)
+        if not self._is_aligned(level, oversampling, viewport):
+            return render_hist(_np.rec.fromarrays((x, y), names=('x', 'y')), oversampling, y_min, x_min, y_max, x_max)
+        n_pixel_y = int(_np.ceil(oversampling * (y_max - y_min)))
+        n_pixel_x = int(_np.ceil(oversampling * (x_max - x_min)))
+        image = _np.zeros((n_pixel_y, n_pixel_x), dtype=_np.float32)
+        i0 = int(round(oversampling * (y_min - self.y_origin)))
+        j0 = int(round(oversampling * (x_min - self.x_origin)))
+        T = self.tile_size
+        for (_, ty, tx), tile in zip(keys, self.get_tiles(keys)):
+            if tile is None:
+                continue
+            # The part of the tile in the image
+            i_start = max(ty * T, i0)
+            i_end = min((ty + 1) * T, i0 + n_pixel_y)
+            j_start = max(tx * T, j0)
+            j_end = min((tx + 1) * T, j0 + n_pixel_x)
+            if i_start < i_end and j_start < j_end:
+                image[i_start - i0:i_end - i0, j_start - j0:j_end - j0] += \
+                    tile[i_start - ty * T:i_end - ty * T, j_start - tx * T:j_end - tx * T]
+        # render_hist leaves out locs on the lower viewport borders, which the tiles hold
+        on_border = ((x == x_min) | (y == y_min)) & (x >= x_min) & (y >= y_min) & (x < x_max) & (y < y_max)
+        if _np.any(on_border):
+            rows = _np.int64(oversampling * (y[on_border] - y_min))
+            columns = _np.int64(oversampling * (x[on_border] - x_min))
+            _np.subtract.at(image, (rows, columns), 1)
+        n_locs = int(_np.count_nonzero((x > x_min) & (y > y_min) & (x < x_max) & (y < y_max)))
+        return n_locs, image
+
+
+def segment(locs, info, segmentation, kwargs={}, callback=None, stream=False):
+    '''
+    Renders the locs of consecutive time segments of segmentation frames, with the render kwargs.
+    Returns the segment bounds (frames) and the float32 stack of segment images.
+    Segments are sliced from the frame-sorted locs and rendered in parallel.
+    With stream, an iterator over the segment images is returned instead of the stack,
+    which renders only a few segments ahead, so the stack is never held in memory.
+    '''
     n_frames = info[0]['Frames']
     n_seg = n_segments(info, segmentation)
     bounds = _np.linspace(0, n_frames-1, n_seg+1, dtype=_np.uint32)
-    segments = _np.zeros((n_seg, Y, X))
+    if _np.any(locs.frame[1:] < locs.frame[:-1]):
+        locs = locs[_np.argsort(locs.frame, kind='mergesort')]
+    starts = _np.searchsorted(locs.frame, bounds)
+    images = _render_segments(locs, info, starts, kwargs, callback)
+    if stream:
+        return bounds, images
+    segments = None
+    for i, image in enumerate(images):
+        if segments is None:
+            segments = _np.empty((n_seg,) + image.shape, dtype=_np.float32)
+        segments[i] = image
+    if segments is None:
+        segments = _np.zeros((0, info[0]['Height'], info[0]['Width']), dtype=_np.float32)
+    return bounds, segments
+
+
+def _render_segments(locs, info, starts, kwargs, callback):
+    ''' Yields the images of the locs between consecutive starts, in order, rendered by a pool of threads '''
+    n_seg = len(starts) - 1
+    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+
+    def render_segment(i):
+        return _np.float32(render(locs[starts[i]:starts[i+1]], info, **kwargs)[1])
+
     if callback is not None:
         callback(0)
-    for i in _trange(n_seg, desc='Generating segments', unit='segments'):
-        segment_locs = locs[(locs.frame >= bounds[i]) & (locs.frame < bounds[i+1])]
-        _, segments[i] = render(segment_locs, info, **kwargs)
-        if callback is not None:
-            callback(i+1)
-    return bounds, segments
+    with _ThreadPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(render_segment, i) for i in range(min(2 * n_workers, n_seg))]
+        for i in _trange(n_seg, desc='Generating segments', unit='segments'):
+            image = futures[i].result()
+            futures[i] = None
+            if len(futures) < n_seg:
+                futures.append(executor.submit(render_segment, len(futures)))
+            if callback is not None:
+                callback(i+1)
+            yield image
 
 
 def n_segments(info, segmentation):
@@ -2,8 +2,7 @@ import numpy as _np
 import numba as _numba
 import multiprocessing as _multiprocessing
 import concurrent.futures as _futures
-from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
-from scipy.optimize import minimize_scalar as _minimize_scalar
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 from tqdm import tqdm as _tqdm
 import yaml as _yaml
 import matplotlib.pyplot as _plt
@@ -19,10 +18,8 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
     frame_range = _np.arange(n_frames)
     z_range = -(frame_range * d - range / 2)    # negative so that the first frames of a bottom-to-up scan are positive z coordinates.
 
-    mean_sx = _np.array([_np.mean(locs.sx[locs.frame == _]) for _ in frame_range])
-    mean_sy = _np.array([_np.mean(locs.sy[locs.frame == _]) for _ in frame_range])
-    var_sx = _np.array([_np.var(locs.sx[locs.frame == _]) for _ in frame_range])
-    var_sy = _np.array([_np.var(locs.sy[locs.frame == _]) for _ in frame_range])
+    _, mean_sx, var_sx = _lib.frame_moments(locs.frame, locs.sx, n_frames)
+    _, mean_sy, var_sy = _lib.frame_moments(locs.frame, locs.sy, n_frames)
 
     keep_x = (locs.sx - mean_sx[locs.frame])**2 < var_sx[locs.frame]
     keep_y = (locs.sy - mean_sy[locs.frame])**2 < var_sy[locs.frame]
@@ -30,8 +27,8 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
     locs = locs[keep]
 
     # Fits calibration curve to the mean of each frame
-    mean_sx = _np.array([_np.mean(locs.sx[locs.frame == _]) for _ in frame_range])
-    mean_sy = _np.array([_np.mean(locs.sy[locs.frame == _]) for _ in frame_range])
+    _, mean_sx, _ = _lib.frame_moments(locs.frame, locs.sx, n_frames)
+    _, mean_sy, _ = _lib.frame_moments(locs.frame, locs.sy, n_frames)
     cx = _np.polyfit(z_range, mean_sx, 6, full=False)
     cy = _np.polyfit(z_range, mean_sy, 6, full=False)
 
@@ -40,7 +37,8 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
     # cx = _np.polyfit(true_z, locs.sx, 6, full=False)
     # cy = _np.polyfit(true_z, locs.sy, 6, full=False)
 
-    calibration = {'X Coefficients': [float(_) for _ in cx], 'Y Coefficients': [float(_) for _ in cy]}
+    calibration = {'X Coefficients': [float(_) for _ in cx], 'Y Coefficients': [float(_) for _ in cy],
+                   'Z Range': [float(z_range.min()), float(z_range.max())]}
     if path is not None:
         with open(path, 'w') as f:
             _yaml.dump(calibration, f, default_flow_style=False)
@@ -103,7 +101,7 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
 
     ax = _plt.subplot(236)
     square_deviation = deviation**2
-    mean_square_deviation_frame = [_np.mean(square_deviation[locs.frame == _]) for _ in frame_range]
+    _, mean_square_deviation_frame, _ = _lib.frame_moments(locs.frame, square_deviation, n_frames)
     rmsd_frame = _np.sqrt(mean_square_deviation_frame)
     _plt.plot(z_range, rmsd_frame, '.-', color='0.3')
     _plt.xlim(z_range.min(), z_range.max())
@@ -148,17 +146,142 @@ def _fit_z_target(z, sx, sy, cx, cy):
     # return (sx-wx)**2 + (sy-wy)**2
 
 
+# Number of calibration grid points for the initial z estimate of fit_z
+Z_GRID_SIZE = 256
+# Newton steps that refine the grid estimate
+Z_NEWTON_STEPS = 8
+# Search range (+/-) for calibrations without 'Z Range'
+Z_RANGE_DEFAULT = 1000
+
+
+def _z_range(cx, cy, calibration):
+    '''
+    The z range of the calibration grid of fit_z. For calibrations without 'Z Range', it extends from z = 0
+    outwards until one of the calibrated widths becomes non-positive, at most Z_RANGE_DEFAULT in each direction.
+    If a width is already non-positive at z = 0, it is the full +/-Z_RANGE_DEFAULT.
+    '''
+    if 'Z Range' in calibration:
+        z_min, z_max = calibration['Z Range']
+        if z_min >= z_max:
+            raise ValueError('Z Range of the calibration is empty or reversed.')
+        return z_min, z_max
+    z = _np.arange(0, Z_RANGE_DEFAULT + 1)
+    if _np.polyval(cx, 0) <= 0 or _np.polyval(cy, 0) <= 0:
+        return -Z_RANGE_DEFAULT, Z_RANGE_DEFAULT
+    limits = []
+    for sign in (-1, 1):
+        valid = (_np.polyval(cx, sign * z) > 0) & (_np.polyval(cy, sign * z) > 0)
+        limits.append(sign * (z[-1] if valid.all() else z[_np.argmin(valid)] - 1))
+    return limits
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _polyval_derivatives(c, z):
+    ''' Value, first and second derivative of the polynomial with coefficients c (highest power first) '''
+    p = 0.0
+    dp = 0.0
+    d2p = 0.0
+    for k in range(len(c)):
+        d2p = d2p * z + 2.0 * dp
+        dp = dp * z + p
+        p = p * z + c[k]
+    return p, dp, d2p
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _fit_z_newton_step(z, sx, sy, cx, cy):
+    ''' The Newton step of _fit_z_target at z. Returns 0 if the target is not convex at z. '''
+    wx, dwx, d2wx = _polyval_derivatives(cx, z)
+    wy, dwy, d2wy = _polyval_derivatives(cy, z)
+    if wx <= 0 or wy <= 0:
+        return 0.0
+    u = wx**0.5
+    v = wy**0.5
+    du = dwx / (2 * u)
+    dv = dwy / (2 * v)
+    d2u = d2wx / (2 * u) - dwx**2 / (4 * u**3)
+    d2v = d2wy / (2 * v) - dwy**2 / (4 * v**3)
+    a = sx**0.5 - u
+    b = sy**0.5 - v
+    gradient = -2 * (a * du + b * dv)
+    curvature = 2 * (du**2 - a * d2u + dv**2 - b * d2v)
+    if curvature <= 0:
+        return 0.0
+    return -gradient / curvature
+
+
+@_numba.jit(nopython=True, nogil=True)
+def _fit_z(sx, sy, cx, cy, z_grid, sqrt_wx, sqrt_wy, k_start, z, square_d_zcalib):
+    '''
+    Minimizes _fit_z_target for each localization: the best point of the calibration grid or, if k_start
+    is not negative, the grid point reached by descending from k_start. It is refined by Newton steps
+    that stay within one grid spacing of it.
+    '''
+    step = z_grid[1] - z_grid[0]
+    for i in range(len(sx)):
+        a = sx[i]**0.5
+        b = sy[i]**0.5
+        if k_start < 0:
+            best = _np.inf
+            k_best = 0
+            for k in range(len(z_grid)):
+                d = (a - sqrt_wx[k])**2 + (b - sqrt_wy[k])**2
+                if d < best:
+                    best = d
+                    k_best = k
+        else:
+            k_best = k_start
+            best = (a - sqrt_wx[k_best])**2 + (b - sqrt_wy[k_best])**2
+            k_last = -1
+            while k_best != k_last:
+                k_last = k_best
+                for k in (k_last - 1, k_last + 1):
+                    if 0 <= k < len(z_grid):
+                        d = (a - sqrt_wx[k])**2 + (b - sqrt_wy[k])**2
+                        if d < best:
+                            best = d
+                            k_best = k
+        z_ = z_grid[k_best]
+        lower = max(z_ - step, z_grid[0])
+        upper = min(z_ + step, z_grid[-1])
+        for it in range(Z_NEWTON_STEPS):
+            z_new = min(max(z_ + _fit_z_newton_step(z_, sx[i], sy[i], cx, cy), lower), upper)
+            d = _fit_z_target(z_new, sx[i], sy[i], cx, cy)
+            if not d < best:
+                break
+            best = d
+            z_ = z_new
+        z[i] = z_
+        square_d_zcalib[i] = best
+
+
 def fit_z(locs, info, calibration, magnification_factor, filter=2):
+    '''
+    Fits z of each localization from its widths sx and sy with the calibration.
+    The best point of a Z_GRID_SIZE grid over the calibrated z range is refined by Newton steps. This replaced
+    scipy's minimize_scalar (Brent), which returned the local minimum downhill from z = 0. Within 'Z Range',
+    the search is global, so localizations whose widths match the calibration at several z can get a different
+    z than before. Calibrations without 'Z Range' keep the minimum downhill from z = 0, as the polynomials are
+    extrapolated outside the calibrated z.
+    '''
     cx = _np.array(calibration['X Coefficients'])
     cy = _np.array(calibration['Y Coefficients'])
+    z_min, z_max = _z_range(cx, cy, calibration)
+    z_grid = _np.linspace(z_min, z_max, Z_GRID_SIZE)
+    with _np.errstate(invalid='ignore'):
+        sqrt_wx = _np.sqrt(_np.polyval(cx, z_grid))
+        sqrt_wy = _np.sqrt(_np.polyval(cy, z_grid))
+    # Grid points with non-positive widths never match
+    sqrt_wx[~_np.isfinite(sqrt_wx)] = _np.inf
+    sqrt_wy[~_np.isfinite(sqrt_wy)] = _np.inf
+    k_start = -1
+    if 'Z Range' not in calibration:
+        k_zero = int(_np.argmin(_np.abs(z_grid)))
+        if _np.isfinite(sqrt_wx[k_zero]) and _np.isfinite(sqrt_wy[k_zero]):
+            k_start = k_zero
     z = _np.zeros_like(locs.x)
     square_d_zcalib = _np.zeros_like(z)
-    sx = locs.sx
-    sy = locs.sy
-    for i in range(len(z)):
-        result = _minimize_scalar(_fit_z_target, args=(sx[i], sy[i], cx, cy))
-        z[i] = result.x
-        square_d_zcalib[i] = result.fun
+    _fit_z(locs.sx, locs.sy, cx, cy, z_grid, sqrt_wx, sqrt_wy, k_start, z, square_d_zcalib)
     z *= magnification_factor
     locs = _lib.append_to_rec(locs, z, 'z')
     locs = _lib.append_to_rec(locs, _np.sqrt(square_d_zcalib), 'd_zcalib')
@@ -173,7 +296,7 @@ def fit_z_parallel(locs, info, calibration, magnification_factor, filter=2, asyn
     spots_per_task = [int(n_locs / n_tasks + 1) if _ < n_locs % n_tasks else int(n_locs / n_tasks) for _ in range(n_tasks)]
     start_indices = _np.cumsum([0] + spots_per_task[:-1])
     fs = []
-    executor = _ProcessPoolExecutor(n_workers)
+    executor = _ThreadPoolExecutor(n_workers)
     for i, n_locs_task in zip(start_indices, spots_per_task):
         fs.append(executor.submit(fit_z, locs[i:i+n_locs_task], info, calibration, magnification_factor, filter=0))
     if async:
@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def user_settings_home(tmp_path, monkeypatch):
+    ''' Keeps the user settings that picasso writes (e.g. the identify CPU utilization) out of the real home '''
+    monkeypatch.setenv('HOME', str(tmp_path))
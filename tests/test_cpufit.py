@@ -0,0 +1,41 @@
+import numpy as np
+
+from picasso import cpufit, gausslq
+
+
+def test_solve_matches_numpy():
+    rng = np.random.default_rng(0)
+    for n in (1, 3, 6):
+        A = rng.normal(size=(n, n)) + n * np.eye(n)
+        b = rng.normal(size=n)
+        x = np.empty(n)
+        assert cpufit.solve(A.copy(), b.copy(), x)
+        assert np.allclose(x, np.linalg.solve(A, b))
+    assert not cpufit.solve(np.zeros((2, 2)), np.ones(2), np.empty(2))
+
+
+def test_fit_gauss_2d_elliptic():
+    rng = np.random.default_rng(1)
+    size, N = 9, 200
+    grid = np.arange(size)
+    truth = np.column_stack([rng.uniform(500, 1000, N), rng.uniform(3.5, 4.5, (N, 2)),
+                             rng.uniform(1.0, 1.6, (N, 2)), rng.uniform(5, 20, N)])
+    data = np.empty((N, size * size), dtype=np.float32)
+    for n, (a, x, y, sx, sy, bg) in enumerate(truth):
+        model = a * np.outer(np.exp(-0.5 * ((grid - y) / sy)**2), np.exp(-0.5 * ((grid - x) / sx)**2)) + bg
+        data[n] = (model + rng.normal(0, 1, model.shape)).ravel()
+    initial = truth * rng.uniform(0.9, 1.1, truth.shape)
+    parameters, states, chi_squares, number_iterations, execution_time = \
+        cpufit.fit(data, None, cpufit.ModelID.GAUSS_2D_ELLIPTIC, np.float32(initial), tolerance=1e-6,
+                   max_number_iterations=50)
+    assert np.all(states == cpufit.State.CONVERGED)
+    assert np.abs(parameters[:, 1:3] - truth[:, 1:3]).max() < 0.05
+    assert np.allclose(parameters[:, 3:5], truth[:, 3:5], rtol=0.05)
+
+
+def test_fit_spots_gpufit_keeps_spots_shape():
+    spots = np.float32(np.random.default_rng(2).poisson(20, (10, 7, 7)))
+    spots[:, 3, 3] += 200
+    theta = gausslq.fit_spots_gpufit(spots)
+    assert spots.shape == (10, 7, 7)
+    assert theta.shape == (10, 6)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from picasso import gausslq, localize
+
+
+def make_spots(N, box=7, photons=2000, bg=20, seed=0):
+    ''' Poisson spots of elliptic Gaussians, with the true [x, y] centers relative to the box center '''
+    rng = np.random.default_rng(seed)
+    grid = np.arange(box) - box // 2
+    truth = np.column_stack([rng.uniform(-0.5, 0.5, (N, 2)), rng.uniform(0.9, 1.5, (N, 2))])
+    spots = np.empty((N, box, box), dtype=np.float32)
+    for n, (x, y, sx, sy) in enumerate(truth):
+        gx = np.exp(-0.5 * ((grid - x) / sx)**2) / (np.sqrt(2 * np.pi) * sx)
+        gy = np.exp(-0.5 * ((grid - y) / sy)**2) / (np.sqrt(2 * np.pi) * sy)
+        spots[n] = rng.poisson(photons * np.outer(gy, gx) + bg)
+    return spots, truth
+
+
+def chi2(spots, theta):
+    grid = np.arange(spots.shape[1]) - spots.shape[1] // 2
+    x, y, n, bg, sx, sy = [theta[:, _, None] for _ in range(6)]
+    gx = np.exp(-0.5 * ((grid - x) / sx)**2) / (np.sqrt(2 * np.pi) * sx)
+    gy = np.exp(-0.5 * ((grid - y) / sy)**2) / (np.sqrt(2 * np.pi) * sy)
+    model = n[:, :, None] * gy[:, :, None] * gx[:, None, :] + bg[:, :, None]
+    return ((spots - model)**2).sum(axis=(1, 2))
+
+
+def test_fit_spots_lm_matches_leastsq():
+    spots, truth = make_spots(300)
+    reference = gausslq.fit_spots(spots)
+    theta = gausslq.fit_spots_lm(spots)
+    assert np.all(np.isfinite(theta))
+    # At least as good a least squares fit as scipy's leastsq
+    assert np.all(chi2(spots, theta) <= 1.02 * chi2(spots, reference))
+    assert np.median(np.abs(theta[:, :2] - reference[:, :2])) < 0.01
+    assert np.median(np.abs(theta[:, :2] - truth[:, :2])) < 0.05
+    assert np.median(np.abs(theta[:, 4:] - truth[:, 2:])) < 0.05
+
+
+def test_fit_spots_lm_raises_worker_errors():
+    spots = np.zeros((10, 7), dtype=np.float32)     # not a stack of boxes
+    with pytest.raises(Exception):
+        gausslq.fit_spots_lm(spots)
+
+
+def test_fit_block_forwards_convergence_settings():
+    box = 7
+    spots, truth = make_spots(20, box)
+    identifications = np.rec.array((np.arange(20), np.full(20, 10), np.full(20, 10), np.ones(20)),
+                                   dtype=[('frame', 'i'), ('x', 'i'), ('y', 'i'), ('net_gradient', 'f4')])
+    camera_info = {'baseline': 0, 'sensitivity': 1, 'gain': 1, 'qe': 1}
+    locs = localize._fit_block(spots, identifications, box, camera_info, 'lq', 1e-2, 0, 'sigma')
+    # No iterations: the initial parameters
+    initial = np.array([gausslq._initial_parameters(_, box, box // 2) for _ in spots])
+    assert np.allclose(locs.x, initial[:, 0] + 10)
+    locs = localize._fit_block(spots, identifications, box, camera_info, 'lq', 1e-2, 100, 'sigma')
+    assert np.allclose(locs.x, gausslq.fit_spots_lm(spots, 1e-2, 100)[:, 0] + 10)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from scipy.special import erf
+
+from picasso import gaussmle
+
+
+def make_spots(N, box=7, photons=2000, bg=20, sigma=1.2, seed=0):
+    ''' Poisson spots of integrated Gaussians, with the true [y, x] centers '''
+    rng = np.random.default_rng(seed)
+    r = box // 2
+    centers = r + rng.uniform(-0.5, 0.5, (N, 2))
+    edges = np.arange(box + 1) - 0.5
+    spots = np.empty((N, box, box), dtype=np.float32)
+    for n, (y, x) in enumerate(centers):
+        py = np.diff(0.5 * erf((edges - y) / (np.sqrt(2) * sigma)))
+        px = np.diff(0.5 * erf((edges - x) / (np.sqrt(2) * sigma)))
+        spots[n] = rng.poisson(photons * np.outer(py, px) + bg)
+    return spots, centers
+
+
+@pytest.mark.parametrize('method', ['sigma', 'sigmaxy'])
+def test_gaussmle_parallel_matches_serial(method):
+    spots, centers = make_spots(500)
+    serial = gaussmle.gaussmle(spots, 0.001, 100, method=method)
+    parallel = gaussmle.gaussmle_parallel(spots, 0.001, 100, method=method, block_size=37)
+    for a, b in zip(serial, parallel):
+        assert np.array_equal(a, b)
+
+
+@pytest.mark.parametrize('method', ['sigma', 'sigmaxy'])
+def test_gaussmle_recovers_centers(method):
+    spots, centers = make_spots(500)
+    thetas, CRLBs, likelihoods, iterations = gaussmle.gaussmle_parallel(spots, 0.001, 100, method=method)
+    error = thetas[:, :2] - centers
+    assert np.all(np.isfinite(CRLBs[:, :2]))
+    # Errors scale with the CRLB (in px^2)
+    assert np.abs(np.mean(error, axis=0)).max() < 0.01
+    assert np.allclose(np.std(error, axis=0), np.sqrt(np.median(CRLBs[:, :2], axis=0)), rtol=0.2)
+    assert np.allclose(np.median(thetas[:, 2]), 2000, rtol=0.05)
+
+
+def test_gaussmle_parallel_raises_worker_errors():
+    spots = np.zeros((10, 7), dtype=np.float32)     # not a stack of boxes
+    with pytest.raises(Exception):
+        gaussmle.gaussmle_parallel(spots, 0.001, 100)
+
+
+def test_axis_terms_derivatives():
+    # The per-axis derivatives against central differences of photons * PSFc * _gaussian_integral
+    size, photons, PSFc, h = 7, 1500.0, 0.3, 1e-4
+    terms = np.zeros((8, size))
+
+    def model(mu, sigma):
+        return np.array([photons * PSFc * gaussmle._gaussian_integral(k, mu, sigma) for k in range(size)])
+
+    for mu, sigma in [(3.0, 1.0), (2.6, 1.4), (4.1, 0.8)]:
+        gaussmle._axis_terms(size, mu, sigma, terms)
+        assert np.allclose(terms[gaussmle._PSF], model(mu, sigma) / (photons * PSFc))
+        position = np.array([gaussmle._derivative_position(terms, k, sigma, photons, PSFc) for k in range(size)])
+        sigma_ = np.array([gaussmle._derivative_sigma(terms, k, sigma, photons, PSFc) for k in range(size)])
+        d_mu = (model(mu + h, sigma) - model(mu - h, sigma)) / (2 * h)
+        d2_mu = (model(mu + h, sigma) - 2 * model(mu, sigma) + model(mu - h, sigma)) / h**2
+        d_sigma = (model(mu, sigma + h) - model(mu, sigma - h)) / (2 * h)
+        d2_sigma = (model(mu, sigma + h) - 2 * model(mu, sigma) + model(mu, sigma - h)) / h**2
+        assert np.allclose(position[:, 0], d_mu, atol=1e-4)
+        assert np.allclose(position[:, 1], d2_mu, atol=1e-1)
+        assert np.allclose(sigma_[:, 0], d_sigma, atol=1e-4)
+        assert np.allclose(sigma_[:, 1], d2_sigma, atol=1e-1)
@@ -0,0 +1,67 @@
+import numpy as np
+
+from picasso import imageprocess, lib
+
+
+def blob_images(shifts, size=64, n_blobs=30, sigma=1.5, seed=0):
+    ''' Images of the same random Gaussian blobs, moved by the (y, x) shifts '''
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(12, size - 12, (n_blobs, 2))
+    grid = np.arange(size)
+    images = []
+    for dy, dx in shifts:
+        image = np.zeros((size, size), dtype=np.float32)
+        for y, x in centers + (dy, dx):
+            image += np.outer(np.exp(-0.5 * ((grid - y) / sigma)**2), np.exp(-0.5 * ((grid - x) / sigma)**2))
+        images.append(image)
+    return images
+
+
+def test_rcc_recovers_shifts():
+    shifts = np.array([(0, 0), (0.4, -1.3), (2.7, 0.6), (-1.2, 3.1), (0.9, 0.9)])
+    images = blob_images(shifts)
+    shift_y, shift_x = imageprocess.rcc(images)
+    # Shifts are relative to the mean
+    assert np.allclose(shift_y - shift_y.mean(), shifts[:, 0] - shifts[:, 0].mean(), atol=0.05)
+    assert np.allclose(shift_x - shift_x.mean(), shifts[:, 1] - shifts[:, 1].mean(), atol=0.05)
+
+
+def test_rcc_stream_matches_list():
+    shifts = [(0, 0), (1.5, 0.5), (-0.5, 2.0)]
+    images = blob_images(shifts)
+    from_list = imageprocess.rcc(images, 16)
+    from_stream = imageprocess.rcc(iter(images), 16, n_segments=len(images))
+    assert np.allclose(from_list, from_stream)
+
+
+def test_rcc_pairs_match_get_image_shift():
+    # The batched correlations of rcc equal the pairwise full FFT correlation
+    images = blob_images([(0, 0), (1.3, -0.7)]) + [np.zeros((64, 64), dtype=np.float32)]
+    n = len(images)
+    shifts_y = np.zeros((n, n))
+    shifts_x = np.zeros((n, n))
+    for i in range(n - 1):
+        for j in range(i + 1, n):
+            shifts_y[i, j], shifts_x[i, j] = imageprocess.get_image_shift(images[i], images[j], 5)
+    assert np.allclose(imageprocess.rcc(images), lib.minimize_shifts(shifts_x, shifts_y), atol=1e-4)
+
+
+def test_xcorr_peak_gaussian_on_background():
+    # Exact for a sampled Gaussian above a constant background
+    grid = np.arange(21)
+    for yc, xc in [(10.3, 9.8), (10.0, 10.45), (9.6, 10.1)]:
+        XCorr = 2.0 + 5 * np.outer(np.exp(-0.5 * ((grid - yc) / 1.3)**2), np.exp(-0.5 * ((grid - xc) / 0.9)**2))
+        y, x = imageprocess._xcorr_peak(XCorr, 5)
+        assert np.isclose(y, yc, atol=1e-3)
+        assert np.isclose(x, xc, atol=1e-3)
+
+
+def test_xcorr_peak_neighbour_below_background():
+    # The left neighbour of the peak is the lowest pixel of the box: the offset is not snapped to 0
+    XCorr = np.ones((9, 9))
+    XCorr[4, 4] = 10
+    XCorr[4, 3] = 0.5
+    XCorr[4, 5] = 3
+    y, x = imageprocess._xcorr_peak(XCorr, 5)
+    assert y == 4
+    assert np.isclose(x, 4 + 0.5 * (0.5 - 3) / (0.5 - 2 * 10 + 3))
@@ -0,0 +1,22 @@
+import warnings
+
+import numpy as np
+
+from picasso import lib
+
+
+def test_frame_moments_match_per_frame_masks():
+    rng = np.random.default_rng(0)
+    n_frames = 50
+    frame = rng.integers(0, n_frames, 5000)
+    frame = frame[frame != 7]      # one frame without values
+    values = rng.normal(1.5, 0.3, len(frame)).astype(np.float32)
+    count, mean, var = lib.frame_moments(frame, values, n_frames)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected_mean = np.array([np.mean(values[frame == _]) for _ in range(n_frames)])
+        expected_var = np.array([np.var(values[frame == _]) for _ in range(n_frames)])
+    assert np.array_equal(count, np.bincount(frame, minlength=n_frames))
+    assert np.isnan(mean[7]) and np.isnan(var[7])
+    assert np.allclose(mean, expected_mean, rtol=1e-5, equal_nan=True)
+    assert np.allclose(var, expected_var, rtol=1e-4, equal_nan=True)
@@ -0,0 +1,114 @@
+import threading
+
+import numpy as np
+import pytest
+
+from picasso import localize
+
+
+def tied_frames():
+    rng = np.random.default_rng(0)
+    # Few gray levels, so that boxes often hold several equal maxima
+    yield np.float32(rng.integers(0, 4, (64, 80)))
+    yield np.float32(rng.integers(0, 2, (33, 47)))
+    plateau = np.zeros((40, 40), dtype=np.float32)
+    plateau[10:13, 10:13] = 5
+    plateau[20, 20:24] = 3
+    plateau[30:34, 5] = 7
+    yield plateau
+    yield np.float32(rng.poisson(100, (128, 128)))
+
+
+@pytest.mark.parametrize('box', [3, 5, 7, 9])
+def test_local_maxima_filter_matches_scan(box):
+    for frame in tied_frames():
+        y_scan, x_scan = localize.local_maxima(frame, box)
+        y_filter, x_filter = localize.local_maxima_filter(frame, box)
+        assert np.array_equal(y_scan, y_filter)
+        assert np.array_equal(x_scan, x_filter)
+
+
+def test_identify_in_frame_maxima_methods():
+    frame = np.uint16(np.random.default_rng(1).poisson(100, (128, 128)))
+    scan = localize.identify_in_frame(frame, 50, 7, maxima_method='scan')
+    filter_ = localize.identify_in_frame(frame, 50, 7, maxima_method='filter')
+    for a, b in zip(scan, filter_):
+        assert np.array_equal(a, b)
+    with pytest.raises(ValueError):
+        localize.identify_in_frame(frame, 50, 7, maxima_method='unknown')
+
+
+class FrameMovie:
+    ''' A movie that is not an array, read frame by frame like a TiffMap '''
+
+    def __init__(self, movie):
+        self.movie = movie
+
+    def __len__(self):
+        return len(self.movie)
+
+    def __getitem__(self, frame_number):
+        return self.movie[frame_number]
+
+
+def test_get_spots_in_photons():
+    rng = np.random.default_rng(2)
+    movie = np.uint16(rng.poisson(400, (6, 32, 40)))
+    box = 5
+    N = 50
+    frame = np.sort(rng.integers(0, 6, N))
+    identifications = np.rec.array((frame, rng.integers(2, 38, N), rng.integers(2, 30, N), np.ones(N)),
+                                   dtype=[('frame', 'i'), ('x', 'i'), ('y', 'i'), ('net_gradient', 'f4')])
+    camera_info = {'baseline': 100, 'sensitivity': 0.5, 'gain': 3, 'qe': 0.9}
+    expected = np.empty((N, box, box), dtype=np.float32)
+    for k, (f, x, y) in enumerate(zip(identifications.frame, identifications.x, identifications.y)):
+        spot = np.float32(movie[f, y - 2:y + 3, x - 2:x + 3])
+        expected[k] = (spot - np.float32(100)) * np.float32(0.5) / np.float32(3 * 0.9)
+    for movie_ in (movie, FrameMovie(movie)):
+        spots = localize.get_spots(movie_, identifications, box, camera_info)
+        assert spots.dtype == np.float32
+        assert np.array_equal(spots, expected)
+
+
+def make_movie(n_frames=40, seed=3):
+    ''' Frames with a few bright spots on a Poisson background '''
+    rng = np.random.default_rng(seed)
+    movie = rng.poisson(20, (n_frames, 32, 32)).astype(np.uint16)
+    for frame in movie:
+        for y, x in rng.integers(5, 27, (4, 2)):
+            frame[y - 1:y + 2, x - 1:x + 2] += 300
+    return movie
+
+
+def test_localize_chunks_stops_producer_on_early_exit():
+    movie = make_movie()
+    camera_info = {'baseline': 0, 'sensitivity': 1, 'gain': 1, 'qe': 1}
+    n_threads = threading.active_count()
+    chunks = localize.localize_chunks(movie, camera_info, 1000, 7, max_memory=3 * 500 * 10)
+    next(chunks)
+    chunks.close()
+    assert threading.active_count() == n_threads
+
+
+def test_fit_chunks_stops_producer_on_fit_error():
+    movie = make_movie()
+    camera_info = {'baseline': 0, 'sensitivity': 1, 'gain': 1, 'qe': 1}
+    identifications = localize.identify(movie, 1000, 7, threaded=False)
+    assert len(identifications) > 10
+    n_threads = threading.active_count()
+    with pytest.raises(ValueError):
+        list(localize.fit_chunks(movie, camera_info, identifications, 7, method='unknown', max_memory=3 * 500 * 10))
+    assert threading.active_count() == n_threads
+
+
+@pytest.mark.parametrize('method', ['mle', 'lq', 'lq-gpufit', 'avg'])
+def test_empty_locs_have_the_fit_columns(method):
+    movie = make_movie()
+    camera_info = {'baseline': 0, 'sensitivity': 1, 'gain': 1, 'qe': 1}
+    identifications = localize.identify(movie, 1000, 7, threaded=False)
+    empty = localize.empty_locs(identifications[:0], 7, camera_info, method)
+    assert list(localize.fit_chunks(movie, camera_info, identifications[:0], 7, method=method)) == []
+    chunks = localize.fit_chunks(movie, camera_info, identifications[:5], 7, method=method)
+    locs = np.hstack([_[1] for _ in chunks])
+    assert len(empty) == 0
+    assert empty.dtype == locs.dtype
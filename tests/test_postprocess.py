@@ -0,0 +1,339 @@
+import numpy as np
+import pytest
+
+from picasso import lib, postprocess
+
+
+def make_locs(N, width=32, height=32, z_range=None, seed=0):
+    rng = np.random.default_rng(seed)
+    dtype = [('frame', 'u4'), ('x', 'f4'), ('y', 'f4'), ('lpx', 'f4'), ('lpy', 'f4')]
+    if z_range is not None:
+        dtype.append(('z', 'f4'))
+    locs = np.rec.array(np.zeros(N, dtype=dtype))
+    locs.frame = rng.integers(0, 100, N)
+    locs.x = rng.uniform(0.5, width - 0.5, N)
+    locs.y = rng.uniform(0.5, height - 0.5, N)
+    locs.lpx = locs.lpy = 0.1
+    if z_range is not None:
+        locs.z = rng.uniform(-z_range / 2, z_range / 2, N)
+    info = [{'Width': width, 'Height': height, 'Frames': 100}]
+    return locs, info
+
+
+def test_spatial_index_radius_matches_brute_force():
+    locs, info = make_locs(2000)
+    index = postprocess.SpatialIndex(locs, info, 2)
+    qx = np.array([0.3, 10.0, 31.7, 16.2])
+    qy = np.array([5.0, 0.2, 31.9, 16.8])
+    for r in (0.5, 2, 5.5):
+        counts = index.count_in_radius(qx, qy, r)
+        indices, groups = index.indices_in_radius(qx, qy, r)
+        for q in range(len(qx)):
+            d2 = (index.x - qx[q])**2 + (index.y - qy[q])**2
+            expected = np.flatnonzero(d2 < r**2)
+            assert counts[q] == len(expected)
+            assert np.array_equal(indices[groups == q], expected)
+
+
+def test_spatial_index_3d_single_z_cell():
+    # z range smaller than z_size: all locs fall into one z cell, but queries must stay 3D
+    locs, info = make_locs(2000, z_range=1.0)
+    index = postprocess.SpatialIndex(locs, info, 2, z_size=10)
+    assert index.M == 1
+    assert index.three_d
+    assert len(index.z) == len(index)
+    qx, qy, qz = np.array([16.0]), np.array([16.0]), np.array([0.4])
+    r, r_z = 3, 0.2
+    indices, groups = index.indices_in_radius(qx, qy, r, qz, r_z)
+    d = (index.x - 16)**2 / r**2 + (index.y - 16)**2 / r**2 + (index.z - 0.4)**2 / r_z**2
+    assert np.array_equal(indices, np.flatnonzero(d < 1))
+
+
+def test_index_blocks_wrappers():
+    locs, info = make_locs(500)
+    index_blocks = postprocess.get_index_blocks(locs, info, 4)
+    locs_sorted, size, x_index, y_index, block_starts, block_ends, K, L = index_blocks
+    assert block_starts.shape == (K, L)
+    for x, y in [(0.1, 0.1), (15.0, 17.0), (31.9, 2.0)]:
+        block_locs = postprocess.get_block_locs_at(x, y, index_blocks)
+        n = postprocess.n_block_locs_at(x, y, size, K, L, block_starts, block_ends)
+        inside = (np.abs(np.floor(locs_sorted.x / 4) - np.floor(x / 4)) <= 1) & \
+                 (np.abs(np.floor(locs_sorted.y / 4) - np.floor(y / 4)) <= 1)
+        assert n == inside.sum() == len(block_locs)
+
+
+def brute_force_pair_histogram(x, y, z, bin_size, r_max):
+    d2 = (x[:, None] - x[None, :])**2 + (y[:, None] - y[None, :])**2
+    if z is not None:
+        d2 += (z[:, None] - z[None, :])**2
+    d = np.sqrt(d2[np.triu_indices(len(x), 1)])
+    return np.histogram(d[d < r_max], bins=int(r_max / bin_size), range=(0, r_max))[0]
+
+
+def test_distance_histogram_matches_brute_force():
+    locs, info = make_locs(1500)
+    dh = postprocess.distance_histogram(locs, info, 0.25, 3)
+    expected = brute_force_pair_histogram(locs.x.astype('f8'), locs.y.astype('f8'), None, 0.25, 3)
+    assert np.array_equal(dh, expected)
+
+
+def test_spatial_statistics_3d_small_z_range():
+    # 800 nm z range against r_max = 10 px of 130 nm: all locs in one z cell
+    pixelsize = 130
+    locs, info = make_locs(1500, z_range=800)
+    dh, N, window = postprocess._pair_distance_histogram(locs, info, 0.5, 10, pixelsize)
+    z = locs.z.astype('f8') / pixelsize
+    expected = brute_force_pair_histogram(locs.x.astype('f8'), locs.y.astype('f8'), z, 0.5, 10)
+    assert np.allclose(dh, expected)
+    assert np.isclose(window[2], (locs.z.max() - locs.z.min()) / pixelsize)
+    stats = postprocess.spatial_statistics(locs, info, 0.5, 10, pixelsize)
+    assert np.all(np.isfinite(stats.K))
+    assert np.all(stats.K > 0)
+    # Uniform random locs: L(r) = r where the window is larger than r
+    assert np.allclose(stats.L[3:10], stats.r[3:10], rtol=0.1)
+
+
+def test_picked_locs_match_per_pick_selection():
+    locs, info = make_locs(3000)
+    # Overlapping picks and a pick at the border
+    x = np.array([5.0, 6.0, 20.0, 0.5])
+    y = np.array([5.0, 5.5, 12.0, 31.0])
+    r = 1.5
+    picked = postprocess.picked_locs(locs, info, x, y, r)
+    split = postprocess.picked_locs(locs, info, x, y, r, add_group=False, split=True)
+    assert len(split) == len(x)
+    for i in range(len(x)):
+        expected = locs[(locs.x - x[i])**2 + (locs.y - y[i])**2 < r**2]
+        pick_locs = picked[picked.group == i]
+        for result in (pick_locs, split[i]):
+            assert len(result) == len(expected)
+            assert np.array_equal(np.sort(result.x), np.sort(expected.x))
+            assert np.array_equal(np.sort(result.y), np.sort(expected.y))
+    assert np.all(np.diff(picked.group) >= 0)
+    index = postprocess.SpatialIndex(locs, info, r)
+    reused = postprocess.picked_locs(None, None, x, y, r, index=index)
+    assert np.array_equal(reused, picked)
+
+
+def make_blinking_locs(n_sites=40, n_locs=3000, n_frames=300, n_groups=3, seed=1):
+    ''' Locs scattered tightly around a few sites, so that many of them link '''
+    rng = np.random.default_rng(seed)
+    site_x = rng.uniform(1, 31, n_sites)
+    site_y = rng.uniform(1, 31, n_sites)
+    site = rng.integers(0, n_sites, n_locs)
+    locs = np.rec.array(np.zeros(n_locs, dtype=[('frame', 'u4'), ('x', 'f4'), ('y', 'f4'), ('photons', 'f4'),
+                                                ('lpx', 'f4'), ('lpy', 'f4'), ('group', 'i4')]))
+    locs.frame = rng.integers(0, n_frames, n_locs)
+    locs.x = site_x[site] + rng.normal(0, 0.03, n_locs)
+    locs.y = site_y[site] + rng.normal(0, 0.03, n_locs)
+    locs.photons = rng.uniform(500, 2000, n_locs)
+    locs.lpx = rng.uniform(0.01, 0.05, n_locs)
+    locs.lpy = rng.uniform(0.01, 0.05, n_locs)
+    locs.group = rng.integers(0, n_groups, n_locs)
+    locs.sort(kind='mergesort', order='frame')
+    info = [{'Width': 32, 'Height': 32, 'Frames': n_frames}]
+    return locs, info
+
+
+def reference_link_groups(frame, x, y, group, d_max, max_dark_time):
+    ''' The sequential linking scan over frame-sorted locs '''
+    N = len(frame)
+    link_group = -np.ones(N, dtype=np.int32)
+    current_link_group = -1
+    for i in range(N):
+        if link_group[i] != -1:
+            continue
+        current_link_group += 1
+        link_group[i] = current_link_group
+        current = i
+        while current != -1:
+            candidates = np.flatnonzero((frame > frame[current]) & (frame <= frame[current] + max_dark_time + 1) &
+                                        (group == group[current]) & (link_group == -1) &
+                                        (np.sqrt((x - x[current])**2 + (y - y[current])**2) <= d_max))
+            current = candidates[0] if len(candidates) else -1
+            if current != -1:
+                link_group[current] = current_link_group
+    return link_group
+
+
+def test_link_groups_match_sequential_scan():
+    locs, info = make_blinking_locs()
+    x = locs.x.astype('f8')
+    y = locs.y.astype('f8')
+    for d_max, max_dark_time in [(0.05, 1), (0.1, 3), (0.02, 0)]:
+        link_group = postprocess.get_link_groups(locs, d_max, max_dark_time, locs.group)
+        expected = reference_link_groups(np.int64(locs.frame), x, y, locs.group, d_max, max_dark_time)
+        assert link_group.max() < len(locs) - 1     # some locs were linked
+        assert np.array_equal(link_group, expected)
+    linked = postprocess.link(locs.copy(), info, 0.05, 1)
+    expected = postprocess.link_loc_groups(locs, info, reference_link_groups(np.int64(locs.frame), x, y, locs.group, 0.05, 1))
+    assert np.array_equal(linked, expected)
+
+
+def test_dark_times_match_pairwise_gaps():
+    locs, info = make_blinking_locs()
+    linked = postprocess.link(locs, info, 0.05, 1, remove_ambiguous_lengths=False)
+    dark = postprocess.dark_times(linked)
+    last_frame = np.int64(linked.frame) + linked.len - 1
+    gaps = np.int64(linked.frame)[:, None] - last_frame[None, :]
+    valid = (gaps > 0) & (linked.group[:, None] == linked.group[None, :])
+    expected = np.where(valid, gaps, np.iinfo(np.int64).max).min(axis=1)
+    expected[~valid.any(axis=1)] = -1
+    assert np.array_equal(dark, expected)
+    # Without a group column all events belong to one group
+    ungrouped = postprocess.dark_times(linked, group=np.zeros(len(linked)))
+    gaps[gaps <= 0] = np.iinfo(np.int64).max
+    expected = gaps.min(axis=1)
+    expected[expected == np.iinfo(np.int64).max] = -1
+    assert np.array_equal(ungrouped, expected)
+
+
+def test_group_segments_match_per_group_reductions():
+    rng = np.random.default_rng(2)
+    group = rng.integers(0, 30, 4000)
+    values = rng.normal(10, 2, 4000).astype(np.float32)
+    weights = rng.uniform(0.5, 2, 4000)
+    segments = postprocess.GroupSegments(group)
+    assert np.array_equal(segments.ids, np.unique(group))
+    mean, std = segments.mean_std(values)
+    weighted_mean, sum_weights = segments.weighted_mean(values, weights)
+    min_, max_ = segments.min_max(values)
+    first, last = segments.first_last(values)
+    for i, g in enumerate(segments.ids):
+        group_values = values[group == g]
+        assert segments.counts[i] == len(group_values)
+        assert np.isclose(mean[i], np.mean(group_values, dtype=np.float64))
+        assert np.isclose(std[i], np.std(group_values, dtype=np.float64), rtol=1e-5)
+        assert np.isclose(weighted_mean[i], np.average(group_values, weights=weights[group == g]))
+        assert np.isclose(sum_weights[i], weights[group == g].sum())
+        assert min_[i] == group_values.min() and max_[i] == group_values.max()
+        assert first[i] == group_values[0] and last[i] == group_values[-1]
+
+
+def test_cluster_combine_and_groupprops_match_per_group_loops():
+    locs, info = make_blinking_locs()
+    rng = np.random.default_rng(3)
+    locs = lib.append_to_rec(locs, rng.integers(0, 5, len(locs)).astype(np.int32), 'cluster')
+    combined = postprocess.cluster_combine(locs)
+    i = 0
+    for group in np.unique(locs.group):
+        for cluster in np.unique(locs.cluster[locs.group == group]):
+            cluster_locs = locs[(locs.group == group) & (locs.cluster == cluster)]
+            n = len(cluster_locs)
+            assert combined.group[i] == group and combined.cluster[i] == cluster and combined.n[i] == n
+            assert np.isclose(combined.mean_frame[i], np.mean(cluster_locs.frame))
+            assert np.isclose(combined.std_frame[i], np.std(cluster_locs.frame))
+            assert np.isclose(combined.x[i], np.average(cluster_locs.x, weights=cluster_locs.photons))
+            assert np.isclose(combined.y[i], np.average(cluster_locs.y, weights=cluster_locs.photons))
+            assert np.isclose(combined.lpx[i], np.std(cluster_locs.x) / np.sqrt(n), rtol=1e-4)
+            assert np.isclose(combined.lpy[i], np.std(cluster_locs.y) / np.sqrt(n), rtol=1e-4)
+            i += 1
+    assert i == len(combined)
+    groups = postprocess.groupprops(locs)
+    for i, group in enumerate(np.unique(locs.group)):
+        group_locs = locs[locs.group == group]
+        assert groups.group[i] == group and groups.n_events[i] == len(group_locs)
+        for name in locs.dtype.names:
+            assert np.isclose(groups[name + '_mean'][i], np.mean(group_locs[name], dtype=np.float64))
+            assert np.isclose(groups[name + '_std'][i], np.std(group_locs[name], dtype=np.float64), rtol=1e-4)
+
+
+@pytest.mark.parametrize('n_dims', [2, 3])
+def test_dbscan_labels_match_sklearn(n_dims):
+    cluster = pytest.importorskip('sklearn.cluster')
+    rng = np.random.default_rng(4)
+    centers = rng.uniform(0, 20, (60, n_dims))
+    X = np.concatenate([centers[rng.integers(0, 60, 5000)] + rng.normal(0, 0.15, (5000, n_dims)),
+                        rng.uniform(0, 20, (1000, n_dims))])
+    for radius, min_samples in [(0.2, 5), (0.3, 10), (0.5, 3)]:
+        labels = postprocess.dbscan_labels(X, radius, min_samples)
+        expected = cluster.DBSCAN(eps=radius, min_samples=min_samples).fit(X).labels_
+        assert labels.max() > 0
+        assert np.array_equal(labels, expected)
+
+
+def test_nearest_neighbors_match_brute_force():
+    rng = np.random.default_rng(5)
+    points = rng.uniform(0, 10, (1500, 2))
+    group = rng.integers(0, 4, len(points))
+    d = np.sqrt(((points[:, None] - points[None, :])**2).sum(axis=2))
+    np.fill_diagonal(d, np.inf)
+    distances, indices = postprocess.nearest_neighbors(points, k=3)
+    assert np.allclose(distances, np.sort(d, axis=1)[:, :3])
+    assert np.allclose(np.take_along_axis(d, indices, axis=1), distances)
+    d[group[:, None] != group[None, :]] = np.inf
+    distances, indices = postprocess.nearest_neighbors(points, groups=group)
+    assert np.allclose(distances[:, 0], d.min(axis=1))
+    assert np.array_equal(indices[:, 0], d.argmin(axis=1))
+    # A group with a single point has no neighbor
+    distances, indices = postprocess.nearest_neighbors(points[:3], groups=[0, 1, 1])
+    assert distances[0, 0] == np.inf and indices[0, 0] == 3
+    assert np.isclose(distances[1, 0], np.sqrt(((points[1] - points[2])**2).sum()))
+
+
+def test_cluster_combine_dist_matches_per_group_distances():
+    rng = np.random.default_rng(6)
+    N = 600
+    combined = np.rec.array(np.zeros(N, dtype=[('group', 'i4'), ('cluster', 'i4'), ('mean_frame', 'f4'), ('x', 'f4'),
+                                               ('y', 'f4'), ('z', 'f4'), ('std_frame', 'f4'), ('lpx', 'f4'),
+                                               ('lpy', 'f4'), ('lpz', 'f4'), ('n', 'i4')]))
+    combined.group = rng.integers(0, 10, N)
+    combined.cluster = rng.permutation(N)
+    combined.x = rng.uniform(0, 30, N)
+    combined.y = rng.uniform(0, 30, N)
+    combined.z = rng.uniform(-300, 300, N)
+    pixelsize = 130
+    result = postprocess.cluster_combine_dist(combined, pixelsize)
+    for i in range(len(result)):
+        others = combined[(combined.group == result.group[i]) & (combined.cluster != result.cluster[i])]
+        d_xy = np.sqrt((others.x - result.x[i])**2 + (others.y - result.y[i])**2)
+        d = np.sqrt(d_xy**2 + ((others.z - result.z[i]) / pixelsize)**2)
+        assert np.isclose(result.min_dist[i], d.min(), rtol=1e-5)
+        assert np.isclose(result.mind_dist_xy[i], d_xy.min(), rtol=1e-5)
+    with pytest.raises(ValueError):
+        postprocess.cluster_combine_dist(combined)
+
+
+def test_next_frame_neighbor_histogram_matches_pairs():
+    locs, info = make_blinking_locs()
+    progress = []
+    bin_centers, histogram = postprocess.next_frame_neighbor_distance_histogram(locs, progress.append)
+    next_frame = (np.int64(locs.frame)[None, :] == np.int64(locs.frame)[:, None] + 1) & \
+                 (locs.group[None, :] == locs.group[:, None])
+    i, j = np.nonzero(next_frame)
+    d = np.sqrt((locs.x[i] - locs.x[j])**2 + (locs.y[i] - locs.y[j])**2)
+    d = d[d <= 1.0]
+    expected = np.bincount((d / 0.001).astype(np.int64), minlength=len(bin_centers))[:len(bin_centers)]
+    assert histogram.sum() > 100
+    assert np.array_equal(histogram, expected)
+    assert np.allclose(bin_centers, np.arange(0, 1, 0.001) + 0.0005)
+    assert progress[-1] == 100
+
+
+
+def test_link_groups_at_exactly_d_max():
+    # The last two locs are exactly d_max apart. Cells computed from float32 coordinates are two apart.
+    locs = np.rec.array(np.zeros(3, dtype=[('frame', 'u4'), ('x', 'f4'), ('y', 'f4')]))
+    locs.frame = [0, 5, 6]
+    locs.x = [0.0276, 16.0276, 16.1526]
+    locs.y = 3
+    assert locs.x[2] - locs.x[1] == 0.125
+    link_group = postprocess.get_link_groups(locs, 0.125, 0, np.zeros(3))
+    assert np.array_equal(link_group, [0, 1, 1])
+
+
+def test_nearest_neighbors_exclude_duplicates():
+    rng = np.random.default_rng(7)
+    points = rng.uniform(0, 10, (500, 2))
+    points[100:200] = points[:100]
+    points[200:210] = points[0]
+    d = np.sqrt(((points[:, None] - points[None, :])**2).sum(axis=2))
+    d[d == 0] = np.inf
+    distances, indices = postprocess.nearest_neighbors(points, k=3, exclude_duplicates=True)
+    assert np.allclose(distances, np.sort(d, axis=1)[:, :3])
+    assert np.allclose(np.take_along_axis(d, indices, axis=1), distances)
+    # Without exclude_duplicates, duplicates are neighbors at distance 0
+    assert np.all(postprocess.nearest_neighbors(points)[0][:200, 0] == 0)
+    # Points that all share one position have no neighbors
+    distances, indices = postprocess.nearest_neighbors(np.ones((4, 2)), exclude_duplicates=True)
+    assert np.all(distances == np.inf) and np.all(indices == 4)
@@ -0,0 +1,107 @@
+import numpy as np
+
+from picasso import lib, render
+
+
+def make_locs(N, width=64, height=64, seed=0):
+    rng = np.random.default_rng(seed)
+    locs = np.rec.array(np.zeros(N, dtype=[('x', 'f4'), ('y', 'f4'), ('lpx', 'f4'), ('lpy', 'f4')]))
+    locs.x = rng.uniform(0, width, N)
+    locs.y = rng.uniform(0, height, N)
+    locs.lpx = rng.uniform(0.02, 0.1, N)
+    locs.lpy = rng.uniform(0.02, 0.1, N)
+    return locs
+
+
+def test_tile_cache_power_of_two_matches_render_hist():
+    locs = make_locs(20000)
+    cache = render.TileCache(locs, tile_size=64)
+    for oversampling, viewport in [(1, ((0, 0), (64, 64))), (4, ((8, 16), (40, 48))), (8, ((10.5, 3.25), (20.5, 13.25)))]:
+        (y_min, x_min), (y_max, x_max) = viewport
+        n, image = render.render_hist(locs, oversampling, y_min, x_min, y_max, x_max)
+        n_tiles, tile_image = cache.render(oversampling, viewport)
+        assert np.array_equal(image, tile_image)
+        assert n == n_tiles
+
+
+def test_tile_cache_non_aligned_matches_render_hist():
+    # Dynamic (non power of two) oversamplings, viewports off the tile grid or beyond the locs,
+    # and oversamplings beyond the levels of the pyramid
+    locs = make_locs(100000)
+    cache = render.TileCache(locs, tile_size=64)
+    for oversampling, y_min, x_min in [(2.7, 3.17, 5.41), (5.3, 40.2, 0.3), (11.9, 60.5, 61.5), (0.37, -5.5, -3.1),
+                                       (64, 20.01, 30.02), (100.3, 10.5, 10.5), (8, 10.3, 4.0), (3, 70.0, 10.0)]:
+        viewport = ((y_min, x_min), (y_min + 80 / oversampling, x_min + 96 / oversampling))
+        n, image = render.render_hist(locs, oversampling, y_min, x_min, *viewport[1])
+        n_tiles, tile_image = cache.render(oversampling, viewport)
+        assert np.array_equal(image, tile_image)
+        assert n == n_tiles
+
+
+def test_tile_cache_locs_on_the_viewport_border():
+    locs = make_locs(5000)
+    locs.x[:50] = 16
+    locs.y[50:100] = 8
+    locs.x[100:110] = 48
+    cache = render.TileCache(locs, tile_size=64)
+    for oversampling, viewport in [(4, ((8, 16), (40, 48))), (4.5, ((8, 16), (40, 48)))]:
+        n, image = render.render_hist(locs, oversampling, *viewport[0], *viewport[1])
+        n_tiles, tile_image = cache.render(oversampling, viewport)
+        assert np.array_equal(image, tile_image)
+        assert n == n_tiles
+
+
+def test_segment_matches_per_segment_masks():
+    rng = np.random.default_rng(1)
+    locs = make_locs(20000)
+    locs = lib.append_to_rec(locs, rng.integers(0, 500, len(locs)).astype('u4'), 'frame')
+    info = [{'Width': 64, 'Height': 64, 'Frames': 500}]
+    kwargs = {'blur_method': 'gaussian', 'min_blur_width': 1}
+    bounds, segments = render.segment(locs, info, 100, kwargs)
+    assert len(segments) == render.n_segments(info, 100) == len(bounds) - 1
+    assert segments.dtype == np.float32
+    streamed = render.segment(locs, info, 100, kwargs, stream=True)[1]
+    for i, image in enumerate(streamed):
+        segment_locs = locs[(locs.frame >= bounds[i]) & (locs.frame < bounds[i + 1])]
+        expected = render.render(segment_locs, info, **kwargs)[1]
+        assert np.allclose(segments[i], expected, rtol=1e-5, atol=1e-6)
+        assert np.array_equal(image, segments[i])
+    assert i == len(segments) - 1
+
+
+def direct_gaussians(shape, x, y, sx, sy):
+    ''' The blobs as the original per-pixel loop drew them, cut off at _DRAW_MAX_SIGMA '''
+    image = np.zeros(shape)
+    n_pixel_y, n_pixel_x = shape
+    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
+        max_y = render._DRAW_MAX_SIGMA * sy_
+        max_x = render._DRAW_MAX_SIGMA * sx_
+        i = np.arange(max(np.int32(y_ - max_y), 0), min(np.int32(y_ + max_y + 1), n_pixel_y))
+        j = np.arange(max(np.int32(x_ - max_x), 0), min(np.int32(x_ + max_x) + 1, n_pixel_x))
+        image[i[:, None], j[None, :]] += np.exp(-((j[None, :] - x_ + 0.5)**2 / (2 * sx_**2) +
+                                                  (i[:, None] - y_ + 0.5)**2 / (2 * sy_**2))) / (2 * np.pi * sx_ * sy_)
+    return image
+
+
+def test_render_gaussian_matches_direct_sum():
+    rng = np.random.default_rng(2)
+    locs = make_locs(8000)
+    # Some wide blobs that reach across several bands of rows
+    locs.lpx[:50] = rng.uniform(0.5, 2, 50)
+    locs.lpy[:50] = rng.uniform(0.5, 2, 50)
+    oversampling, min_blur_width = 4, 0.05
+    viewport = ((2.5, 1.25), (60.5, 63.25))
+    (y_min, x_min), (y_max, x_max) = viewport
+    in_view = (locs.x > x_min) & (locs.y > y_min) & (locs.x < x_max) & (locs.y < y_max)
+    x = oversampling * (locs.x[in_view] - x_min)
+    y = oversampling * (locs.y[in_view] - y_min)
+    sx = oversampling * np.maximum(locs.lpx[in_view], min_blur_width)
+    sy = oversampling * np.maximum(locs.lpy[in_view], min_blur_width)
+    for blur_method in ('gaussian', 'gaussian_iso'):
+        n, image = render.render(locs, oversampling=oversampling, viewport=viewport, blur_method=blur_method,
+                                 min_blur_width=min_blur_width)
+        if blur_method == 'gaussian_iso':
+            sx = sy = (sx + sy) / 2
+        expected = direct_gaussians(image.shape, x, y, sx, sy)
+        assert n == in_view.sum()
+        assert np.allclose(image, expected, rtol=1e-4, atol=1e-5 * expected.max())
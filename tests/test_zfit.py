@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from scipy.optimize import minimize_scalar
+
+from picasso import zfit
+
+
+def astigmatic_calibration():
+    # Widths (px) over z (nm) of a typical astigmatic PSF, as 6th order polynomials
+    z = np.linspace(-600, 600, 121)
+    sx = 1.2 + 0.5 * ((z - 250) / 400)**2
+    sy = 1.2 + 0.5 * ((z + 250) / 400)**2
+    calibration = {'X Coefficients': [float(_) for _ in np.polyfit(z, sx, 6)],
+                   'Y Coefficients': [float(_) for _ in np.polyfit(z, sy, 6)],
+                   'Z Range': [-600.0, 600.0]}
+    return calibration
+
+
+def make_locs(calibration, N=500, seed=0):
+    rng = np.random.default_rng(seed)
+    z = rng.uniform(-500, 500, N)
+    locs = np.rec.array(np.zeros(N, dtype=[('frame', 'u4'), ('x', 'f4'), ('y', 'f4'), ('sx', 'f4'), ('sy', 'f4'),
+                                           ('lpx', 'f4'), ('lpy', 'f4')]))
+    locs.x = locs.y = 16
+    locs.lpx = locs.lpy = 0.1
+    locs.sx = np.polyval(calibration['X Coefficients'], z) + rng.normal(0, 0.02, N)
+    locs.sy = np.polyval(calibration['Y Coefficients'], z) + rng.normal(0, 0.02, N)
+    info = [{'Width': 32, 'Height': 32, 'Frames': 1}]
+    return locs, info, z
+
+
+def test_fit_z_matches_minimize_scalar():
+    calibration = astigmatic_calibration()
+    locs, info, z_true = make_locs(calibration)
+    locs_z = zfit.fit_z(locs, info, calibration, 1.0, filter=0)
+    cx = np.array(calibration['X Coefficients'])
+    cy = np.array(calibration['Y Coefficients'])
+    reference = np.array([minimize_scalar(zfit._fit_z_target, bounds=(-600, 600), method='bounded',
+                                          args=(sx, sy, cx, cy), options={'xatol': 1e-4}).x
+                          for sx, sy in zip(locs.sx, locs.sy)])
+    # The bounded search can stop in a local minimum, the grid search finds the global one
+    target = np.array([zfit._fit_z_target(_, sx, sy, cx, cy) for _, sx, sy in zip(locs_z.z, locs.sx, locs.sy)])
+    target_ref = np.array([zfit._fit_z_target(_, sx, sy, cx, cy) for _, sx, sy in zip(reference, locs.sx, locs.sy)])
+    assert np.all(target <= target_ref + 1e-6)
+    same = np.abs(target - target_ref) < 1e-6
+    assert same.mean() > 0.95
+    assert np.abs(locs_z.z[same] - reference[same]).max() < 0.5
+    assert np.allclose(locs_z.d_zcalib, np.sqrt(target), atol=1e-5)
+    assert np.median(np.abs(locs_z.z - z_true)) < 30
+
+
+def test_z_range_without_calibrated_range():
+    calibration = astigmatic_calibration()
+    cx = np.array(calibration['X Coefficients'])
+    cy = np.array(calibration['Y Coefficients'])
+    del calibration['Z Range']
+    z_min, z_max = zfit._z_range(cx, cy, calibration)
+    assert z_min < 0 < z_max
+    # A width that is not positive at z = 0 searches the full default range
+    z_min, z_max = zfit._z_range(cx - np.polyval(cx, 0), cy, calibration)
+    assert (z_min, z_max) == (-zfit.Z_RANGE_DEFAULT, zfit.Z_RANGE_DEFAULT)
+    with pytest.raises(ValueError):
+        zfit._z_range(cx, cy, {'Z Range': [600.0, -600.0]})
+
+
+
+def test_fit_z_without_calibrated_range_matches_minimize_scalar():
+    # Calibrations without 'Z Range' keep the minimum downhill from z = 0, like the former minimize_scalar,
+    # even if the extrapolated widths match better far from the calibrated z
+    w = np.poly1d([0.08 / 400**6, 0, -0.6 / 400**4, 0, 1 / 400**2, 0, 1])
+    wx = w(np.poly1d([1, -100]))
+    wy = w(np.poly1d([1, 100]))
+    calibration = {'X Coefficients': list(wx.coeffs), 'Y Coefficients': list(wy.coeffs)}
+    rng = np.random.default_rng(0)
+    locs, info, _ = make_locs(calibration, seed=1)
+    z_true = rng.uniform(-300, 300, len(locs))
+    locs.sx = wx(z_true) + rng.normal(0, 0.05, len(locs))
+    locs.sy = wy(z_true) + rng.normal(0, 0.05, len(locs))
+    reference = [minimize_scalar(zfit._fit_z_target, args=(sx, sy, wx.coeffs, wy.coeffs))
+                 for sx, sy in zip(locs.sx, locs.sy)]
+    locs_z = zfit.fit_z(locs, info, calibration, 1.0, filter=0)
+    assert np.abs(locs_z.z - [_.x for _ in reference]).max() < 0.5
+    assert np.allclose(locs_z.d_zcalib, np.sqrt([_.fun for _ in reference]), atol=1e-5)
+    # A search over the whole default range finds other minima
+    calibration['Z Range'] = [-zfit.Z_RANGE_DEFAULT, zfit.Z_RANGE_DEFAULT]
+    locs_z = zfit.fit_z(locs, info, calibration, 1.0, filter=0)
+    assert np.abs(locs_z.z - [_.x for _ in reference]).max() > 100